@@ -3,15 +3,89 @@
 
 import os
 import re
+import shlex
 import shutil
 import time
 from xml.etree import ElementTree
-from common import samples, nsc, taskmgr, samples, remote, utilities
+from common import samples, nsc, taskmgr, samples, remote, utilities, checksums
 
 TASK_NAME = "50. QC analysis"
 TASK_DESCRIPTION = """Run QC tools on the demultiplexed files."""
 TASK_ARGS = ['work_dir', 'sample_sheet', 'threads', 'lanes']
 
+# Packing of small files: FastQC files smaller than PACK_MAX_FILE_SIZE are run in
+# groups of up to PACK_MAX_FILES files, using one thread per file, instead of one
+# job per file.
+PACK_MAX_FILE_SIZE = 50 * 1024**2
+PACK_MAX_FILES = 4
+
+
+def pack_files(paths, sizes, max_files):
+    """Group files into bins with similar total size, with at most max_files
+    in each bin.
+
+    The files are assigned largest first, each to the bin with the smallest
+    total. Files with the same name are put in different bins, as FastQC
+    names the output after the file name.
+
+    Returns a list of bins, each a list of indexes into paths / sizes."""
+
+    n_bins = (len(paths) + max_files - 1) // max_files
+    bins = [[] for _ in range(n_bins)]
+    totals = [0] * n_bins
+    for i in sorted(range(len(paths)), key=lambda i: -sizes[i]):
+        name = os.path.basename(paths[i])
+        candidates = [
+                b for b in range(len(bins))
+                if len(bins[b]) < max_files and
+                    all(os.path.basename(paths[j]) != name for j in bins[b])
+                ]
+        if candidates:
+            b = min(candidates, key=lambda b: totals[b])
+        else:
+            bins.append([])
+            totals.append(0)
+            b = len(bins) - 1
+        bins[b].append(i)
+        totals[b] += sizes[i]
+    return [b for b in bins if b]
+
+
+def with_md5(command, fq_paths, md5_path):
+    """Wrap a FastQC command, to compute the MD5 checksums of the fastq files in
+    the same job, in the background. The checksums are written to md5_path when
+    both are done, and are used by the checksum task instead of reading the files
+    again at the end of the QC."""
+
+    md5_tmp_path = md5_path + ".tmp"
+    return ["bash", "-c",
+            " ".join(shlex.quote(arg) for arg in nsc.MD5 + fq_paths) +
+            " > " + shlex.quote(md5_tmp_path) + " & " +
+            " ".join(shlex.quote(arg) for arg in command) +
+            " && wait $! && mv " + shlex.quote(md5_tmp_path) + " " + shlex.quote(md5_path)]
+
+
+def import_md5(md5_paths, cache):
+    """Add the checksums computed with the FastQC jobs to the cache, for the
+    checksum task (80_md5sum), and remove the checksum files. Missing files are
+    ignored: those checksums are then computed by the checksum task."""
+
+    for md5_path in md5_paths:
+        try:
+            with open(md5_path) as md5_file:
+                for line in md5_file:
+                    digest, path = line.rstrip("\n").split(None, 1)
+                    cache.add_file(path, digest)
+        except (IOError, OSError, ValueError):
+            pass
+        # Partial output of failed jobs
+        for path in [md5_path, md5_path + ".tmp"]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
 def main(task):
     task.running()
 
@@ -39,9 +113,10 @@ def main(task):
     #   (Dupe commands are the same for scheduler mode and normal mode.)
     # - Create the directory structure for results for FastQC and fastdup
     dup_commands = []
-    fqc_commands = []
+    fqc_files = []
     fastqc_zipfiles = []
     file_sizes = []
+    dup_file_sizes = []
     for project in projects:
         if not project.is_undetermined:
             project_dir = os.path.join(output_dir, project.name)
@@ -56,13 +131,11 @@ def main(task):
                         file_fastqc_dir = samples.get_fastqc_dir(project, sample, f)
                         fqc_basedir = os.path.join( output_dir, os.path.dirname(file_fastqc_dir))
                         fq_path = os.path.join(bc_dir, f.path)
-                        fqc_commands.append([nsc.FASTQC, "--extract",
-                                "--outdir=" + fqc_basedir,
-                                fq_path
-                                ])
+                        fqc_files.append((fq_path, fqc_basedir))
                         file_sizes.append(os.path.getsize(fq_path))
                         fastqc_zipfiles.append(os.path.join(output_dir, file_fastqc_dir + ".zip"))
                         if f.i_read == 1:
+                            dup_file_sizes.append(file_sizes[-1])
                             output_path = os.path.join(
                                     output_dir,
                                     samples.get_fastdup_path(project, sample, f),
@@ -83,19 +156,75 @@ def main(task):
                                             ]
                                         )
     
+    # Small files are packed into multi-file FastQC commands. The output of each
+    # pack is written to a temporary directory, and moved into place afterwards.
+    small_files = [i for i, size in enumerate(file_sizes) if size < PACK_MAX_FILE_SIZE]
+    if len(small_files) < 2:
+        small_files = []
+    packs = pack_files(
+            [fqc_files[i][0] for i in small_files],
+            [file_sizes[i] for i in small_files],
+            PACK_MAX_FILES
+            )
+    packs = [[small_files[i] for i in pack] for pack in packs]
+    packed = set(small_files)
+    single_files = [i for i in range(len(fqc_files)) if i not in packed]
+
+    # The checksums of the fastq files are computed in the FastQC jobs
+    md5_paths = []
+    fqc_commands = []
+    for i in single_files:
+        fq_path, fqc_basedir = fqc_files[i]
+        md5_paths.append(os.path.join(output_dir, "fastqc_md5.{0}.txt".format(i)))
+        fqc_commands.append(with_md5([nsc.FASTQC, "--extract",
+                "--outdir=" + fqc_basedir,
+                fq_path
+                ], [fq_path], md5_paths[-1]))
+    pack_commands = []
+    pack_dirs = []
+    for i_pack, pack in enumerate(packs):
+        pack_dir = os.path.join(output_dir, "fastqc_pack.{0}".format(i_pack))
+        if not os.path.exists(pack_dir):
+            os.mkdir(pack_dir)
+        pack_dirs.append(pack_dir)
+        md5_paths.append(os.path.join(pack_dir, "md5.txt"))
+        pack_commands.append(with_md5([nsc.FASTQC, "--extract",
+                "-t", str(len(pack)),
+                "--outdir=" + pack_dir
+                ] + [fqc_files[i][0] for i in pack],
+                [fqc_files[i][0] for i in pack], md5_paths[-1]))
+
     fqc = remote.ArrayJob(fqc_commands, "fastqc", "2-0",
             fqc_log_path.replace(".txt", ".%a.txt"))
     fqc.mem_per_task = 1900
     fqc.cpus_per_task = 1
     fqc.comment = run_id
-    jobs = []
+    fqc.task_costs = [file_sizes[i] for i in single_files] # Start the largest files first
+    # The packs are run in one array job per number of files, so the CPUs and
+    # memory requested match the threads used by FastQC
+    fqc_jobs = []
+    for n_files in sorted(set(len(pack) for pack in packs), reverse=True):
+        i_packs = [i_pack for i_pack, pack in enumerate(packs) if len(pack) == n_files]
+        fqc_pack = remote.ArrayJob([pack_commands[i_pack] for i_pack in i_packs],
+                "fastqc_pack", "2-0",
+                task.logfile("fastqc_pack{0}".format(n_files)).replace(".txt", ".%a.txt"))
+        # FastQC uses 250 MB for each additional thread
+        fqc_pack.mem_per_task = 1900 + 250 * (n_files - 1)
+        fqc_pack.cpus_per_task = n_files
+        fqc_pack.comment = run_id
+        fqc_pack.task_costs = [sum(file_sizes[i] for i in packs[i_pack]) for i_pack in i_packs]
+        fqc_pack.max_simultaneous = 10
+        fqc_jobs.append(fqc_pack)
+    if fqc_commands or not fqc_jobs:
+        fqc_jobs.append(fqc)
 
     # FastQC crashes is too many jobs complete on the same node at the same time
     # For small jobs (< about 500k reads), this may be a problem, and we reduce the max
     # simultaneous jobs to be safe. Use median size 50MB as cut-off; parameters may need
     # tuning.
     try:
-        median_size = list(sorted(file_sizes))[len(file_sizes)//2]
+        single_file_sizes = [file_sizes[i] for i in single_files]
+        median_size = list(sorted(single_file_sizes))[len(single_file_sizes)//2]
         if median_size < 50 * 1024**2:
             fqc.max_simultaneous = 10
         else:
@@ -123,12 +252,13 @@ def main(task):
                 dup_log_path.replace(".txt", ".%a.txt"))
         dup.mem_per_task = 500
         dup.cpus_per_task = 1
+        dup.task_costs = dup_file_sizes
         # Limit parallelism to reduce load on storage cluster
         dup.max_simultaneous = 26 # reduce to 5 if LIMS crash
         dup.comment = run_id
-        jobs = [fqc, dup]
+        jobs = fqc_jobs + [dup]
     else:
-        jobs = [fqc]
+        jobs = fqc_jobs
         dup = None
 
     remote.ArrayJob.start_jobs(jobs, max_local_threads=task.threads)
@@ -141,17 +271,39 @@ def main(task):
         remote.ArrayJob.update_status(jobs)
         task.array_job_status(jobs)
     
+    cache = checksums.DigestCache(checksums.get_cache_path(task.work_dir))
+    import_md5(md5_paths, cache)
+    cache.save()
+
+    # Move the output of packed FastQC commands into the directories for each file.
+    # This is also done if a job failed, so no temporary files are left behind.
+    for pack, pack_dir in zip(packs, pack_dirs):
+        for i in pack:
+            fq_path, fqc_basedir = fqc_files[i]
+            fqc_name = re.sub(r".fastq.gz$", "_fastqc", os.path.basename(fq_path))
+            dest = os.path.join(fqc_basedir, fqc_name)
+            if os.path.isdir(os.path.join(pack_dir, fqc_name)) and os.path.isdir(dest):
+                shutil.rmtree(dest)
+            for src_name, dest_path in [(fqc_name, dest), (fqc_name + ".zip", dest + ".zip"),
+                                        (fqc_name + ".html", dest + ".html")]:
+                try:
+                    os.rename(os.path.join(pack_dir, src_name), dest_path)
+                except OSError:
+                    pass
+        shutil.rmtree(pack_dir, ignore_errors=True)
+
     fail = ""
     detail = ""
-    if list(fqc.summary.keys()) != ["COMPLETED"]:
-        fail += "fastqc failure "
-        detail = str(fqc.summary)
+    for fqc_job in fqc_jobs:
+        if list(fqc_job.summary.keys()) != ["COMPLETED"]:
+            fail = "fastqc failure "
+            detail = str(fqc_job.summary)
     if dup and list(dup.summary.keys()) != ["COMPLETED"]:
         fail += "fastdup failure "
         detail = str(dup.summary)
     if fail:
         task.fail(fail, detail)
-	
+
     for zipfile in fastqc_zipfiles:
         try:
             os.remove(zipfile)
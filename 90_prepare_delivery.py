@@ -2,14 +2,15 @@
 # delivery type of the project.
 # - portable hard drive -> Hard-links to delivery/ dir on secondary storage
 # - diagnostics -> Copies run to diagnostics area, sets permissions
-# - norstore -> tars the project, computes md5 of tar, saves the tar and md5 
-#               in delivery/
+# - norstore -> tars the project, computing the md5 of the tar while it is
+#               written, saves the tar and md5 in delivery/
 
 import sys
 import os
 import re
 import shutil
 import crypt
+import tarfile
 import time
 import subprocess
 import datetime
@@ -20,7 +21,7 @@ from jinja2 import Environment, FileSystemLoader
 import demultiplex_stats
 from genologics.lims import *
 from common import nsc
-from common import utilities, taskmgr, remote, samples
+from common import utilities, taskmgr, remote, samples, checksums, transfer
 
 TASK_NAME = "90. Prepare delivery"
 TASK_DESCRIPTION = """Prepare for delivery."""
@@ -32,6 +33,10 @@ else:
     sys.stderr.write("Using dummy security module\n")
     from common import secure_dummy as secure
 
+# Size of writes to the tar file, and interval between progress messages (seconds)
+TAR_BUFFER_SIZE = 8 * 1024 * 1024
+TAR_PROGRESS_INTERVAL = 300
+
 hardlink = "l"
 # Disable hard linking if running on MacOS
 if sys.platform == "darwin":
@@ -137,24 +142,24 @@ def delivery_diag_move(task, project, basecalls_dir, project_path):
     # Move data into delivery area for NSC
     transfer_cmd_args = ['mv']
 
-    if os.path.exists(dest_dir):
-        raise RuntimeError("Destination directory '" + dest_dir + "' already exists")
-    args = transfer_cmd_args + [project_path.rstrip("/"), nsc.DIAGNOSTICS_DELIVERY]
-    subprocess.check_call(args)
+    # An existing destination is only accepted if it is an interrupted move (see move_tree)
+    transfer.move_tree(project_path, nsc.DIAGNOSTICS_DELIVERY,
+            task.logfile("transfer-" + project.name, "json"), task=task)
 
     # Now copy quality control data. The Stats and Reports belong to all projects, so
     # we make hard links, not move them.
-    cp_copy_args = ['cp', f'-r{hardlink}']
     # Diagnostics wants the QC info in a particular format (file names, etc.). Do not
     # change without consultiing with them. 
     source_qc_dir = os.path.join(basecalls_dir, "QualityControl" + task.suffix)
 
     qc_dir = os.path.join(dest_dir, "QualityControl")
-    os.mkdir(qc_dir)
+    if not os.path.isdir(qc_dir):
+        os.mkdir(qc_dir)
 
     for subdir in ["Stats" + task.suffix, "Reports" + task.suffix]:
         source = os.path.join(basecalls_dir, subdir)
-        subprocess.call(cp_copy_args + [source, dest_dir])
+        if os.path.isdir(source):
+            transfer.transfer_tree(source, dest_dir, link=bool(hardlink))
 
     # The locations of the fastqc directories are defined by the get_fastqc_dir() 
     # function in the samples module. These directories will then be moved to a 
@@ -296,9 +301,10 @@ def delivery_external_user(task, lims_project, project_path, project_name, deliv
     copy_qc_files(task, project_name, dest_dir)
 
 
-def delivery_harddrive(project_name, source_path):
-    # Copy to delivery area
-    subprocess.check_call(["/bin/cp", f"-r{hardlink}", source_path, nsc.DELIVERY_DIR])
+def delivery_harddrive(task, project_name, source_path):
+    # Copy to delivery area. The manifest allows resuming after a failure.
+    transfer.transfer_tree(source_path, nsc.DELIVERY_DIR,
+            task.logfile("transfer-" + project_name, "json"), link=bool(hardlink), task=task)
     #log_path = task.logfile("rsync-" + project_name)
     #args = [nsc.RSYNC, '-rlt', '--chmod=ug+rwX,o-rwx'] # chmod 660
     #args += [source_path.rstrip("/"), nsc.DELIVERY_DIR]
@@ -336,8 +342,39 @@ require user {username}
     open(save_path + "/.htpasswd", "w").write(htpasswd)
 
 
+def write_tar(task, source_path, tar_path):
+    """Write a tar file of the directory source_path, and compute its MD5
+    checksum while writing. The progress is reported with task.info.
+
+    Returns the hex MD5 digest."""
+
+    name = os.path.basename(tar_path)
+    start_time = time.time()
+    last_report = [start_time]
+    with open(tar_path, 'wb') as tar_file:
+        writer = checksums.HashingWriter(tar_file)
+
+        def report_progress(tarinfo):
+            now = time.time()
+            if now - last_report[0] >= TAR_PROGRESS_INTERVAL:
+                task.info("Tar {0}: {1:.1f} GB written ({2:.0f} MB/s)".format(
+                    name, writer.bytes_written / 1024.0**3,
+                    writer.bytes_written / 1024.0**2 / (now - start_time)))
+                last_report[0] = now
+            return tarinfo
+
+        with tarfile.open(fileobj=writer, mode="w|", bufsize=TAR_BUFFER_SIZE,
+                format=tarfile.GNU_FORMAT) as tar:
+            tar.add(source_path, arcname=os.path.basename(source_path), filter=report_progress)
+    elapsed = max(time.time() - start_time, 0.001)
+    task.info("Tar {0}: {1:.1f} GB in {2:.0f} s ({3:.0f} MB/s)".format(
+        name, writer.bytes_written / 1024.0**3, elapsed,
+        writer.bytes_written / 1024.0**2 / elapsed))
+    return writer.hexdigest()
+
+
 def delivery_norstore(process, project_name, source_path, task):
-    """Create a tar file"""
+    """Create a tar file and its checksum file"""
 
     project_dir = os.path.basename(source_path).rstrip("/")
     save_path = os.path.join(nsc.DELIVERY_DIR, project_dir)
@@ -346,25 +383,17 @@ def delivery_norstore(process, project_name, source_path, task):
     except OSError:
         pass
     tarname = project_dir + ".tar"
-    args = ["/bin/tar", "cf", save_path + "/" + tarname , project_dir]
-    rcode = remote.run_command(
-            args, task, "tar", "10:00:00",
-            cwd=os.path.dirname(source_path),
-            comment=task.run_id
-            ) # dirname = parent dir
-    if rcode != 0:
-        raise RuntimeError('Failed to run "tar" to prepare for Norstore delivery')
-
-    md5_path = os.path.join(save_path + "/md5sum.txt")
-    # would use normal md5sum, but we have md5deep as a dependency already
-    rcode = remote.run_command(
-            nsc.MD5 + [tarname], task,
-            "md5deep_tar", "16:00:00", cwd=save_path, stdout=md5_path,
-            comment=task.run_id
-            )
-    if rcode != 0:
-        raise RuntimeError("Failed to compute checksum for tar file for Norstore, "+
-                "md5deep returned an error")
+    tar_path = os.path.join(save_path, tarname)
+    try:
+        digest = write_tar(task, source_path.rstrip("/"), tar_path)
+    except (IOError, OSError, tarfile.TarError) as e:
+        raise RuntimeError("Failed to create tar file for Norstore delivery: " + str(e))
+
+    checksums.write_md5sum(os.path.join(save_path, "md5sum.txt"), [(tarname, digest)])
+    # The checksum of the tar is cached, for verification of the delivery
+    cache = checksums.DigestCache(checksums.get_cache_path(task.work_dir))
+    cache.add_file(tar_path, digest)
+    cache.save()
 
     try:
         create_htaccess_files(process, project_name, project_dir, save_path) 
@@ -390,7 +419,8 @@ def fhi_mik_seq_delivery(task, project_type, project, lims_project, lims_process
                          os.path.join(output_path, "extendedSampleList.csv"))
 
     #### RUN covid analysis pipeline ####
-    subprocess.check_call(["/bin/cp", f"-r{hardlink}", project_path, delivery_base_dir])
+    transfer.transfer_tree(project_path, delivery_base_dir,
+            task.logfile("transfer-" + project.name, "json"), link=bool(hardlink), task=task)
     # Prepare script
     template_dir = os.path.join(os.path.dirname(__file__), "template")
     jinja_env = Environment(loader=FileSystemLoader(template_dir))
@@ -534,13 +564,13 @@ def main(task):
             fhi_mik_seq_delivery(task, project_type, project, lims_project, task.process, lims_samples, project_path, "/data/runScratch.boston/analysis/covid")
         elif delivery_type in ["User HDD", "New HDD", "TSD project"]:
             task.info("Hard-linking " + project.name + " to delivery area...")
-            delivery_harddrive(project.name, project_path)
+            delivery_harddrive(task, project.name, project_path)
         elif delivery_type == "NeLS project":
             task.info("Hard-linking " + project.name + " to delivery area (NeLS)...")
             if project_type != "Non-Sensitive":
                 sensitive_fail.append(project.name)
                 continue
-            delivery_harddrive(project.name, project_path)
+            delivery_harddrive(task, project.name, project_path)
         elif delivery_type == "Norstore":
             if project_type != "Non-Sensitive":
                 sensitive_fail.append(project.name)
@@ -0,0 +1,144 @@
+# Checksum engine
+
+# Computes MD5 checksums of files in a thread pool. hashlib releases the GIL
+# while hashing large buffers, so the threads run in parallel, and the reads of
+# the different files overlap.
+
+# Digests are cached in a JSON file in the log directory of the run, keyed by
+# the device, inode, size and modification time of the file. The key is taken
+# before the file is read, so a file modified while it is hashed gets a new key
+# on the next lookup. The cache lets re-runs and later tasks (tar files for
+# delivery, verification) reuse the checksums instead of reading the data again.
+
+# HashingWriter computes the checksum of a file while it is written, so that
+# files produced by the pipeline (tar files) don't have to be read back.
+
+import os
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import nsc
+
+# Size of reads when hashing
+READ_SIZE = 8 * 1024 * 1024
+
+
+def get_cache_path(work_dir):
+    return os.path.join(work_dir, nsc.RUN_LOG_DIR, "md5_cache.json")
+
+
+def get_key(st):
+    """Cache key for the result of os.stat()."""
+
+    return "{0}:{1}:{2}:{3}".format(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class DigestCache(object):
+    """MD5 digests by file identity (see get_key). If path is None, the cache
+    is only kept in memory."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.digests = {}
+        self.modified = False
+        self._lock = threading.Lock()
+        if path:
+            try:
+                with open(path) as cache_file:
+                    self.digests = json.load(cache_file)
+            except (IOError, ValueError):
+                pass
+
+    def get(self, st):
+        return self.digests.get(get_key(st))
+
+    def put(self, st, digest):
+        with self._lock:
+            self.digests[get_key(st)] = digest
+            self.modified = True
+
+    def add_file(self, path, digest):
+        """Add a digest computed elsewhere, e.g. in the QC analysis jobs."""
+
+        self.put(os.stat(path), digest)
+
+    def save(self):
+        """Write the cache file, if it has changed. Errors are ignored: the cache is
+        only an optimisation."""
+
+        if not self.path or not self.modified:
+            return
+        tmp_path = "{0}.{1}.tmp".format(self.path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as cache_file:
+                json.dump(self.digests, cache_file)
+            os.replace(tmp_path, self.path)
+            self.modified = False
+        except (IOError, OSError):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+def md5_file(path, cache=None):
+    """Get the hex MD5 digest of the file, from the cache if possible."""
+
+    st = os.stat(path)
+    if cache is not None:
+        digest = cache.get(st)
+        if digest:
+            return digest
+    md5 = hashlib.md5()
+    with open(path, 'rb') as input_file:
+        while True:
+            data = input_file.read(READ_SIZE)
+            if not data:
+                break
+            md5.update(data)
+    digest = md5.hexdigest()
+    if cache is not None:
+        cache.put(st, digest)
+    return digest
+
+
+def md5_files(paths, threads=1, cache=None):
+    """Get the digests of the files, computed with up to threads files at a time.
+
+    Returns a list of digests in the same order as paths. Raises IOError / OSError
+    if a file can't be read."""
+
+    if threads <= 1 or len(paths) <= 1:
+        return [md5_file(path, cache) for path in paths]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(lambda path: md5_file(path, cache), paths))
+
+
+class HashingWriter(object):
+    """File-like object which passes the data to fileobj, and computes the MD5
+    of the data on the way. Used to checksum a file while it is written, e.g. a
+    tar stream."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.md5 = hashlib.md5()
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.md5.update(data)
+        self.bytes_written += len(data)
+        return self.fileobj.write(data)
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+
+def write_md5sum(path, entries):
+    """Write a checksum file in the format of md5sum / md5deep -l. entries is
+    a list of (path, digest)."""
+
+    with open(path, 'w') as md5sum_file:
+        for entry_path, digest in entries:
+            md5sum_file.write("{0}  {1}\n".format(digest, entry_path))
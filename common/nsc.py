@@ -146,6 +146,7 @@ elif SITE == "ous":
     # * Command line to run slurm *
     SBATCH_ARGLIST=["/usr/bin/sbatch", "--partition=main", "--qos=high"]
     SQUEUE=["/usr/bin/squeue"]
+    SACCT=["/usr/bin/sacct"]
 
 else:
     BCL2FASTQ2="bcl2fastq"
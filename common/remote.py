@@ -6,7 +6,10 @@ import getpass
 import tempfile
 import io
 import itertools
+import functools
+import asyncio
 import multiprocessing
+import threading
 import time
 
 from . import nsc
@@ -14,6 +17,141 @@ from . import utilities
 
 local_job_id = 1
 
+# Job states which are final
+FINISHED_STATES = set((
+    'COMPLETED', 'FAILED', 'CANCELLED', 'TIMEOUT', 'OUT_OF_MEMORY',
+    'NODE_FAIL', 'BOOT_FAIL', 'DEADLINE', 'PREEMPTED'
+    ))
+
+class SlurmPoller(object):
+    """Shared monitor of Slurm job states.
+
+    Jobs are registered with subscribe(). Each poll runs a single squeue command
+    for all registered jobs, instead of one per job. Jobs which are no longer
+    listed by squeue (they are removed some minutes after finishing) are looked
+    up with sacct.
+
+    The interval between polls starts at MIN_DELAY, and increases by a factor
+    BACKOFF each time no job changed state, up to MAX_DELAY. It is reset when a
+    job changes state or a new job is subscribed.
+
+    The states are stored per job ID as a dict of array task ID => (state, node).
+    The task ID is None for jobs which are not job arrays.
+
+    The poller can be used from multiple threads."""
+
+    MIN_DELAY = 2
+    MAX_DELAY = 60
+    BACKOFF = 1.5
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {} # Job ID => number of subscribers
+        self.states = {}
+        self.delay = self.MIN_DELAY
+        self.last_poll = 0
+
+    def subscribe(self, job_id):
+        with self.lock:
+            self.subscribers[job_id] = self.subscribers.get(job_id, 0) + 1
+            self.states.setdefault(job_id, {})
+            self.delay = self.MIN_DELAY
+
+    def unsubscribe(self, job_id):
+        with self.lock:
+            self.subscribers[job_id] -= 1
+            if self.subscribers[job_id] == 0:
+                del self.subscribers[job_id]
+                del self.states[job_id]
+
+    def get_states(self, job_id):
+        with self.lock:
+            return dict(self.states.get(job_id, {}))
+
+    def wait(self):
+        """Sleep until the next poll is due, then poll."""
+
+        with self.lock:
+            due = self.last_poll + self.delay
+        time.sleep(max(0, due - time.time()))
+        self.poll()
+
+    def poll(self, force=False):
+        """Refresh the states of all jobs, if the poll interval has passed since
+        the last poll (or force is True)."""
+
+        with self.lock:
+            if not self.subscribers:
+                return
+            if not force and time.time() < self.last_poll + self.delay:
+                return
+            job_ids = sorted(self.subscribers)
+            new_states = self._query_squeue(job_ids)
+            missing = [job_id for job_id in job_ids if job_id not in new_states]
+            if missing:
+                for job_id, job_states in self._query_sacct(missing).items():
+                    new_states[job_id] = job_states
+
+            changed = False
+            for job_id, job_states in new_states.items():
+                if job_id not in self.states:
+                    continue
+                for array_task_id, state_node in job_states.items():
+                    if self.states[job_id].get(array_task_id) != state_node:
+                        changed = True
+                        self.states[job_id][array_task_id] = state_node
+            if changed:
+                self.delay = self.MIN_DELAY
+            else:
+                self.delay = min(self.MAX_DELAY, self.delay * self.BACKOFF)
+            self.last_poll = time.time()
+
+    @staticmethod
+    def _query_squeue(job_ids):
+        try:
+            squeue_out = utilities.check_output(nsc.SQUEUE + [
+                '-j', ",".join(job_ids), '-h', '-t', 'all', '-r', '-o', '%F|%K|%T|%N'
+                ])
+        except subprocess.CalledProcessError:
+            return {}
+        result = {}
+        for line in squeue_out.splitlines():
+            parts = line.strip().split("|")
+            if len(parts) != 4:
+                continue
+            job_id, array_task_id, state, node = parts
+            if array_task_id == "N/A":
+                array_task_id = None
+            result.setdefault(job_id, {})[array_task_id] = (state, node or None)
+        return result
+
+    @staticmethod
+    def _query_sacct(job_ids):
+        try:
+            sacct_out = utilities.check_output(nsc.SACCT + [
+                '-j', ",".join(job_ids), '-n', '-P', '-X', '-o', 'JobID,State,NodeList'
+                ])
+        except (subprocess.CalledProcessError, OSError): # sacct is only a fallback
+            return {}
+        result = {}
+        for line in sacct_out.splitlines():
+            parts = line.strip().split("|")
+            if len(parts) != 3 or not parts[1]:
+                continue
+            job_task_id, state, node = parts
+            if "[" in job_task_id: # Unexpanded pending array tasks
+                continue
+            job_id, _, array_task_id = job_task_id.partition("_")
+            state = state.split()[0] # "CANCELLED by 1234"
+            if node in ("", "None assigned"):
+                node = None
+            result.setdefault(job_id, {})[array_task_id or None] = (state, node)
+        return result
+
+
+slurm_poller = SlurmPoller()
+
+
 def srun_command(
         args, task, jobname, jobtime, logfile,
         cpus_per_task=1, mem=1024, cwd=None, stdout=None, 
@@ -39,23 +177,18 @@ def srun_command(
     cmd = "'" + "' '".join(arg.replace("'", "'\\''") for arg in args) + "'"
 
     job_id = utilities.check_output(arglist + sbatch_other_args + ['--wrap', cmd] , cwd=cwd).strip()
-    complete = False
-    delay = 2
-    while not complete:
-        time.sleep(delay)
-        delay = min(30, delay + 1)
-        try:
-            data = utilities.check_output(nsc.SQUEUE + ['-j', job_id, '-O', 'State,NodeList', '-h', '-t', 'all'])
-            parts = data.split()
-            if len(parts) == 2:
-                state, node = parts
-            else:
-                state, node = (parts[0], None)
-        except (subprocess.CalledProcessError, ValueError):
-            state = "UNKNOWN"
-        complete = state in ['FAILED', 'CANCELLED', 'COMPLETED', 'TIMEOUT']
-        if task:
-            task.job_status(job_id, jobname, state.lower(), node)
+    slurm_poller.subscribe(job_id)
+    try:
+        complete = False
+        state = "UNKNOWN"
+        while not complete:
+            slurm_poller.wait()
+            state, node = slurm_poller.get_states(job_id).get(None, (state, None))
+            complete = state in FINISHED_STATES
+            if task:
+                task.job_status(job_id, jobname, state.lower(), node)
+    finally:
+        slurm_poller.unsubscribe(job_id)
 
     if state == "COMPLETED":
         return 0
@@ -111,6 +244,42 @@ class JobMonitoringException(Exception):
 # Do use the static methods start_jobs() and update_status(), and not _start and
 # _check_status. The latter methods are not implemented for LocalArrayJob.
 
+def get_task_order(job):
+    """Get the order in which to dispatch the tasks of an array job.
+
+    If the job has task_costs (an estimate of the run time of each task, e.g.
+    the input file size), the most costly tasks are started first (longest
+    processing time first), so that a few large tasks don't end up running
+    alone at the end. Otherwise the tasks are run in order."""
+
+    if job.task_costs is None:
+        return list(range(len(job.arg_lists)))
+    return sorted(range(len(job.arg_lists)), key=lambda i: -job.task_costs[i])
+
+
+# Size of each entry in the index of the arguments file of SlurmArrayJob
+ARGS_INDEX_ENTRY_SIZE = 40
+
+# Body of the batch script for SlurmArrayJob. The task reads the position of its
+# record from the index, and then the record, seeking directly to it with
+# tail -c +N. The first field of the record is the log file, and the rest is the
+# command. Until the output is redirected to the log file, it goes to the
+# fallback log given to Slurm, which is removed when the redirection succeeds.
+ARGS_DISPATCH_SCRIPT = """
+ARGS_FILE={args_path}
+FALLBACK_LOG={fallback_prefix}"${{SLURM_ARRAY_JOB_ID}}_${{SLURM_ARRAY_TASK_ID}}.txt"
+read -r OFFSET LENGTH < <(tail -c +$((SLURM_ARRAY_TASK_ID * {entry_size} + 1)) "$ARGS_FILE" | head -c {entry_size})
+if [ -z "$LENGTH" ]; then
+    echo "No arguments for task $SLURM_ARRAY_TASK_ID in $ARGS_FILE" >&2
+    exit 1
+fi
+mapfile -d '' -t ARGV < <(tail -c +$((OFFSET + 1)) "$ARGS_FILE" | head -c "$LENGTH") || exit 1
+exec > "${{ARGV[0]}}" 2>&1
+rm -f "$FALLBACK_LOG"
+"${{ARGV[@]:1}}" && exit 0
+exit 1
+"""
+
 class SlurmArrayJob(object):
     def __init__(self, arg_lists, jobname, time, stdout_pattern):
         
@@ -123,18 +292,71 @@ class SlurmArrayJob(object):
         self.mem_per_task = 1024
         self.cwd = None
         self.comment = None
+        self.task_costs = None
+        # Log of the tasks which fail before their output is redirected to their
+        # own log file, completed with the job ID and array index
+        self.fallback_log_prefix = os.path.join(
+                os.path.dirname(os.path.abspath(stdout_pattern)), jobname + ".dispatch."
+                )
 
         self.job_id = None
         self.states = {}
         self.summary = {}
+        self.subscribed = False
+        self.args_path = None
+
+    def _write_args_file(self):
+        """Write the argument lists to the arguments file, which is read by the tasks.
+
+        The file starts with an index of fixed-size entries (offset and length of
+        the record for each task), followed by the records. Each record contains
+        the arguments, each terminated by a NUL byte. A task can thus read its
+        own arguments directly, whatever the number of tasks. The file is put
+        next to the log files, so it is visible to the compute nodes.
+
+        The records are in the order given by get_task_order, as Slurm starts
+        the array tasks in order of the array index. The array index is thus the
+        position in that order. The log file is written by the task itself, with
+        %a replaced by the original index of the task, so the log files have the
+        same names as with LocalArrayJob."""
+
+        records = [
+                b"".join(
+                    os.fsencode(arg) + b"\0"
+                    for arg in [self.stdout_pattern.replace("%a", str(i))] + self.arg_lists[i]
+                    )
+                for i in get_task_order(self)
+                ]
+        handle, self.args_path = tempfile.mkstemp(
+                prefix=self.jobname + ".", suffix=".args",
+                dir=os.path.dirname(os.path.abspath(self.stdout_pattern))
+                )
+        with os.fdopen(handle, 'wb') as args_file:
+            offset = ARGS_INDEX_ENTRY_SIZE * len(records)
+            for record in records:
+                args_file.write("{0:19d} {1:19d}\n".format(offset, len(record)).encode('ascii'))
+                offset += len(record)
+            for record in records:
+                args_file.write(record)
+
+    def _remove_args_file(self):
+        if self.args_path:
+            try:
+                os.remove(self.args_path)
+            except OSError:
+                pass
+            self.args_path = None
 
     def _start(self):
-        handle, path = tempfile.mkstemp(text=True)
+        if not self.arg_lists:
+            raise ValueError("Starting SLURM array job {}: The list of jobs is empty (check sample sheet).".format(self.jobname))
+        self._write_args_file()
         with tempfile.NamedTemporaryFile(mode='w') as outputfile:
             outputfile.write("#!/bin/bash\n\n")
             outputfile.write("#SBATCH --job-name=\"{0}\"\n".format(self.jobname))
             outputfile.write("#SBATCH --time={0}\n".format(self.time))
-            outputfile.write("#SBATCH --output=\"{0}\"\n".format(self.stdout_pattern))
+            # The output is redirected by the task to its log file (see ARGS_DISPATCH_SCRIPT)
+            outputfile.write("#SBATCH --output=\"{0}%A_%a.txt\"\n".format(self.fallback_log_prefix))
             if self.cpus_per_task:
                 outputfile.write("#SBATCH --cpus-per-task={0}\n".format(self.cpus_per_task))
             if self.mem_per_task:
@@ -142,32 +364,37 @@ class SlurmArrayJob(object):
             if self.comment:
                 outputfile.write("#SBATCH --comment=\"{0}\"\n".format(self.comment))
 
-
-            for i, arg_list in enumerate(self.arg_lists):
-                argv = " ".join("'" + s.replace("'", "'\\''") + "'" for s in arg_list)
-                outputfile.write("[ $SLURM_ARRAY_TASK_ID == {0} ] && {1} && exit 0\n".format(i, argv))
-            outputfile.write("exit 1\n")
+            outputfile.write(ARGS_DISPATCH_SCRIPT.format(
+                args_path="'" + self.args_path.replace("'", "'\\''") + "'",
+                fallback_prefix="'" + self.fallback_log_prefix.replace("'", "'\\''") + "'",
+                entry_size=ARGS_INDEX_ENTRY_SIZE
+                ))
             outputfile.flush()
 
-            if not self.arg_lists:
-                raise ValueError("Starting SLURM array job {}: The list of jobs is empty (check sample sheet).".format(self.jobname))
             array = '--array=0-'+str(len(self.arg_lists) - 1)
             if self.max_simultaneous is not None:
                 array += "%%%d" % (self.max_simultaneous)
-            self.job_id = utilities.check_output(nsc.SBATCH_ARGLIST + ['--parsable', array, outputfile.name], cwd=self.cwd).strip()
+            try:
+                self.job_id = utilities.check_output(nsc.SBATCH_ARGLIST + ['--parsable', array, outputfile.name], cwd=self.cwd).strip()
+            except Exception:
+                self._remove_args_file()
+                raise
             self.states = dict((str(j), 'PENDING') for j in range(len(self.arg_lists)))
             self.summary = {'PENDING': len(self.arg_lists)}
+            slurm_poller.subscribe(self.job_id)
+            self.subscribed = True
 
     def _check_status(self):
         """Refresh status of jobs. Should be called periodically (every minute)."""
-        try:
-            squeue_out = utilities.check_output(nsc.SQUEUE + ['-j', self.job_id, '-O', 'ArrayTaskID,State', '-h', '-t', 'all', '-r'])
-        except subprocess.CalledProcessError:
-            squeue_out = ""
-        new_states = dict(line.split() for line in squeue_out.splitlines() if line)
+        slurm_poller.poll()
+        new_states = dict(
+                (array_task_id, state)
+                for array_task_id, (state, _) in slurm_poller.get_states(self.job_id).items()
+                if array_task_id is not None
+                )
     
         # If this job cancelled, make sure others are marked as the same state too.
-        if new_states and all(state in set(('COMPLETED', 'FAILED', 'CANCELLED')) for state in list(new_states.values())):
+        if new_states and all(state in FINISHED_STATES for state in list(new_states.values())):
             for jix in list(self.states.keys()):
                 if not jix in list(new_states.keys()) and self.states[jix] == "PENDING":
                     self.states[jix] = 'CANCELLED'
@@ -176,10 +403,14 @@ class SlurmArrayJob(object):
         #if not squeue_out and "RUNNING" in self.states.values():
         #    raise JobMonitoringException()
         self.summary = dict((key, len(list(group))) for key, group in itertools.groupby(sorted(self.states.values())))
+        if self.is_finished and self.subscribed:
+            slurm_poller.unsubscribe(self.job_id)
+            self.subscribed = False
+            self._remove_args_file()
 
     @property
     def is_finished(self):
-        return all(state in set(('COMPLETED', 'FAILED', 'CANCELLED')) for state in list(self.states.values()))
+        return all(state in FINISHED_STATES for state in list(self.states.values()))
 
     @staticmethod
     def start_jobs(jobs, max_local_threads):
@@ -198,11 +429,136 @@ def local_execute(arg_list, logfile, cwd):
         raise subprocess.CalledProcessError(res, str(arg_list))
 
 
+def get_mem_mb(mem):
+    """Convert a Slurm-style memory specification (int in MB, or string with
+    optional K/M/G/T suffix) to MB."""
+
+    if isinstance(mem, str):
+        units = {'K': 1.0/1024, 'M': 1, 'G': 1024, 'T': 1024**2}
+        if mem[-1:].upper() in units:
+            return int(float(mem[:-1]) * units[mem[-1:].upper()])
+        return int(mem)
+    return int(mem or 0)
+
+
+def get_local_mem_mb():
+    """Get the physical memory of this machine in MB."""
+
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 1024**2
+    except (ValueError, OSError):
+        return None
+
+
+class LocalExecutor(object):
+    """Runs commands as subprocesses from an asyncio event loop.
+
+    The event loop runs in a background thread, which is started on first use.
+    The subprocesses are started directly from the loop (no worker processes),
+    with stdout and stderr written to a log file, like local_command. The
+    callback is called with the exit code when the command finishes (None if it
+    could not be started). It is called in the thread of the event loop."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loop = None
+
+    def _get_loop(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=self.loop.run_forever)
+                thread.daemon = True
+                thread.start()
+            return self.loop
+
+    def submit(self, args, logfile, cwd, callback):
+        asyncio.run_coroutine_threadsafe(
+                self._run(args, logfile, cwd, callback),
+                self._get_loop()
+                )
+
+    @staticmethod
+    async def _run(args, logfile, cwd, callback):
+        try:
+            with open(logfile, "w") as log:
+                process = await asyncio.create_subprocess_exec(
+                        *args, stdout=log, stderr=log, cwd=cwd or os.getcwd()
+                        )
+                returncode = await process.wait()
+        except (OSError, ValueError):
+            returncode = None
+        callback(returncode)
+
+
+local_executor = LocalExecutor()
+
+
+class LocalScheduler(object):
+    """Runs the tasks of local array jobs within a global budget of CPUs and memory.
+
+    Tasks are started in the order in which they are submitted. start_jobs
+    submits the most costly tasks first, across all the jobs (see
+    get_task_order). A task which does not fit in the free resources does not block smaller tasks later
+    in the queue. A task which requires more than the whole budget is run when
+    nothing else is running. The tasks are run by local_executor, and the next
+    tasks are started as soon as a task finishes."""
+
+    def __init__(self, cpus, mem):
+        self.lock = threading.Lock()
+        self.cpus = cpus
+        self.mem = mem
+        self.used_cpus = 0
+        self.used_mem = 0
+        self.pending = []
+
+    def submit(self, job, index):
+        with self.lock:
+            self.pending.append((job, index))
+        self._dispatch()
+
+    def _requirements(self, job):
+        cpus = min(job.cpus_per_task or 1, self.cpus)
+        mem = get_mem_mb(job.mem_per_task)
+        if self.mem is not None:
+            mem = min(mem, self.mem)
+        return cpus, mem
+
+    def _dispatch(self):
+        with self.lock:
+            still_pending = []
+            for job, index in self.pending:
+                cpus, mem = self._requirements(job)
+                fits_cpus = self.used_cpus + cpus <= self.cpus
+                fits_mem = self.mem is None or self.used_mem + mem <= self.mem
+                if fits_cpus and fits_mem:
+                    self.used_cpus += cpus
+                    self.used_mem += mem
+                    job.states[index] = 'RUNNING'
+                    local_executor.submit(
+                            job.arg_lists[index],
+                            job.stdout_pattern.replace("%a", str(index)),
+                            job.cwd,
+                            functools.partial(self._finished, job, index, cpus, mem)
+                            )
+                else:
+                    still_pending.append((job, index))
+            self.pending = still_pending
+
+    def _finished(self, job, index, cpus, mem, returncode):
+        with self.lock:
+            job.states[index] = 'COMPLETED' if returncode == 0 else 'FAILED'
+            self.used_cpus -= cpus
+            self.used_mem -= mem
+        self._dispatch()
+
+
 class LocalArrayJob(object):
-    """Local process pool.
-    
-    It only supports jobs which require a single CPU (this is a lot easier
-    to implement, since it works with the multiprocessing package)."""
+    """Local execution of array jobs.
+
+    The jobs given to start_jobs share a budget of max_local_threads CPUs and
+    the physical memory of the machine (see LocalScheduler). The cpus_per_task
+    and mem_per_task attributes are used as the requirements of each task."""
     def __init__(self, arg_lists, jobname, time, stdout_pattern):
         global local_job_id
         self.job_id = local_job_id
@@ -211,52 +567,44 @@ class LocalArrayJob(object):
         self.stdout_pattern = stdout_pattern
         self.summary = {"PENDING": len(arg_lists)}
         self.cwd = None
-        self.results = []
-        self.pool = None
-        self.max_async = 0
+        self.states = ['PENDING'] * len(arg_lists)
+        self.scheduler = None
         self.is_finished = False
         self.mem_per_task = 1024
         self.cpus_per_task = 1
         self.jobname = jobname
         self.comment = None
+        self.task_costs = None
 
     @staticmethod
-    def start_jobs(jobs, max_local_threads=None):
-        pool = multiprocessing.Pool(max_local_threads)
+    def start_jobs(jobs, max_local_threads=None, max_local_mem=None):
+        scheduler = LocalScheduler(
+                max_local_threads or multiprocessing.cpu_count(),
+                max_local_mem or get_local_mem_mb()
+                )
         for job in jobs:
-            job.results = []
-            job.pool = pool
-            job.max_async = max_local_threads
-            for i, arg_list in enumerate(job.arg_lists):
-                logfile = job.stdout_pattern.replace("%a", str(i))
-                res = pool.apply_async(local_execute, [arg_list, logfile, job.cwd])
-                job.results.append(res)
+            job.scheduler = scheduler
+            job.states = ['PENDING'] * len(job.arg_lists)
+            job.is_finished = not job.arg_lists
+        tasks = [(job, i) for job in jobs for i in get_task_order(job)]
+        if any(job.task_costs is not None for job in jobs):
+            # Longest first across all the jobs. Tasks without costs go last.
+            tasks.sort(key=lambda job_i: (0, -job_i[0].task_costs[job_i[1]])
+                    if job_i[0].task_costs is not None else (1, 0))
+        for job, i in tasks:
+            scheduler.submit(job, i)
 
     @staticmethod
     def update_status(jobs):
-        total_running = 0
         for job in jobs:
-            completed, failed, running, pending = 0,0,0,0
-            for i, res in enumerate(job.results):
-                if res.ready():
-                    if res.successful():
-                        completed += 1
-                    else:
-                        failed += 1
-                else:
-                    if total_running < job.max_async:
-                        running += 1
-                        total_running += 1
-                    else:
-                        pending += 1
+            if job.scheduler:
+                with job.scheduler.lock:
+                    states = list(job.states)
+            else:
+                states = job.states
             # Only add to summary if non-zero
-            job.summary = dict(
-                    [(k, v) for k, v in
-                    [("COMPLETED", completed), ("FAILED", failed),
-                     ("RUNNING", running), ("PENDING", pending)]
-                    if v > 0
-                    ])
-            job.is_finished = running == 0 and pending == 0
+            job.summary = dict((key, len(list(group))) for key, group in itertools.groupby(sorted(states)))
+            job.is_finished = all(state in ('COMPLETED', 'FAILED') for state in states)
 
 
 class SerialArrayJob(object):
@@ -275,12 +623,14 @@ class SerialArrayJob(object):
         self.cpus_per_task = 1
         self.jobname = jobname
         self.comment = None
+        self.task_costs = None
 
     @staticmethod
     def start_jobs(jobs, max_local_threads=None):
         for job in jobs:
             job.results = []
-            for i, arg_list in enumerate(job.arg_lists):
+            for i in get_task_order(job):
+                arg_list = job.arg_lists[i]
                 logfile = job.stdout_pattern.replace("%a", str(i))
                 job.summary = {}
                 try:
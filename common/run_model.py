@@ -0,0 +1,151 @@
+# Persistent run-model snapshot
+
+# All tasks after demultiplexing need the project / sample / file tree from
+# the samples module. Building it requires the sample sheet, RunInfo.xml and a
+# number of globs in the BaseCalls directory, which is slow for runs with
+# thousands of samples. The tree is built once, saved as a JSON file in the
+# log directory of the run, and loaded by the following tasks.
+
+# The snapshot is keyed by the inputs it is built from (sample sheet checksum,
+# RunInfo.xml size and modification time, lanes, no-lane-splitting setting, and
+# the FASTQ files which determine the lane layout). If any of these change, the
+# snapshot is rebuilt.
+
+import os
+import glob
+import json
+import hashlib
+
+from . import nsc
+from . import samples
+from . import utilities
+
+# Increment when the format of the snapshot changes
+SNAPSHOT_VERSION = 2
+
+# FASTQ files (relative to BaseCalls) used to detect the lane layout: merged or
+# split lanes, and the lane numbers used for expand_lanes
+LAYOUT_FASTQ_PATTERNS = [
+        "Undetermined_S0_*R1_001.fastq.gz",
+        "*/*_S1_*R1_001.fastq.gz",
+        "*/*/*_S1_*R1_001.fastq.gz"
+        ]
+
+
+def snapshot_path(work_dir, suffix=""):
+    return os.path.join(work_dir, nsc.RUN_LOG_DIR, "run_model{0}.json".format(suffix))
+
+
+def get_fastq_layout(work_dir):
+    """List the FASTQ files which determine the lane layout of the run (sorted
+    paths relative to the BaseCalls directory). Empty if there are no FASTQ
+    files yet."""
+
+    basecalls_dir = os.path.join(work_dir, "Data", "Intensities", "BaseCalls")
+    return sorted(
+            os.path.relpath(path, basecalls_dir)
+            for pattern in LAYOUT_FASTQ_PATTERNS
+            for path in glob.glob(os.path.join(basecalls_dir, pattern))
+            )
+
+
+def get_key(run_id, work_dir, sample_sheet_content, lanes, no_lane_splitting=None):
+    """Get the dict used to check if a snapshot is valid.
+
+    no_lane_splitting should be given if it is set externally (LIMS), and
+    None if it is determined from the files in the run folder."""
+
+    run_info = os.stat(os.path.join(work_dir, "RunInfo.xml"))
+    return {
+            'version': SNAPSHOT_VERSION,
+            'run_id': run_id,
+            'sample_sheet_sha1': hashlib.sha1(sample_sheet_content).hexdigest(),
+            'run_info': [run_info.st_size, run_info.st_mtime_ns],
+            'lanes': lanes,
+            'no_lane_splitting': no_lane_splitting,
+            'fastq_layout': get_fastq_layout(work_dir)
+            }
+
+
+def build(run_id, work_dir, sample_sheet_content, no_lane_splitting, lanes):
+    """Build the run model from the sample sheet and run folder.
+
+    The model is a dict with the keys:
+    num_reads          - number of data reads
+    num_index_reads    - number of index reads
+    no_lane_splitting  - True if the lanes are merged
+    expand_lanes       - lanes used when the sample sheet has no Lane column
+    projects           - the project tree, converted by samples.projects_to_dicts
+    """
+
+    num_reads, index_reads = utilities.get_num_reads(work_dir)
+    sample_sheet = samples.parse_sample_sheet(sample_sheet_content.decode('utf-8'))
+    sample_sheet_data = sample_sheet['data']
+
+    # Supply a list of lanes if lane number isn't given in the sample sheet
+    expand_lanes = None
+    if not no_lane_splitting:
+        instr = utilities.get_instrument_by_runid(run_id)
+        if instr == "nextseq":
+            expand_lanes = [1,2,3,4]
+        elif instr == "miseq":
+            expand_lanes = [1]
+        elif instr == "novaseq":
+            expand_lanes = sorted(samples.get_lane_numbers_from_fastq_files(work_dir))
+        else:
+            expand_lanes = None
+
+    experiment_name = None
+    if 'header' in sample_sheet:
+        experiment_name = sample_sheet['header'].get("Experiment Name")
+
+    projects = samples.get_projects(
+            run_id,
+            sample_sheet_data,
+            num_reads,
+            no_lane_splitting,
+            expand_lanes,
+            experiment_name,
+            lanes
+            )
+
+    return {
+            'num_reads': num_reads,
+            'num_index_reads': index_reads,
+            'no_lane_splitting': no_lane_splitting,
+            'expand_lanes': expand_lanes,
+            'projects': samples.projects_to_dicts(projects)
+            }
+
+
+def load(path, key):
+    """Load the model from the snapshot file, if it exists and matches key.
+
+    Returns None if there is no valid snapshot."""
+
+    try:
+        with open(path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+    except (IOError, ValueError):
+        return None
+    if snapshot.get('key') != key:
+        return None
+    return snapshot.get('model')
+
+
+def save(path, key, model):
+    """Write the snapshot file. The file is first written to a temporary name and
+    then renamed, so concurrent tasks never see a partial file.
+
+    Errors are ignored: the snapshot is only an optimisation."""
+
+    tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as snapshot_file:
+            json.dump({'key': key, 'model': model}, snapshot_file)
+        os.replace(tmp_path, path)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
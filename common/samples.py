@@ -295,6 +295,42 @@ def add_index_read_files(projects, run_dir, force=False):
                                 f.index_sequence, None))
 
 
+def projects_to_dicts(projects):
+    """Convert the project tree to plain dicts and lists, which can be saved
+    as JSON. The attribute names are used as keys (see projects_from_dicts)."""
+
+    project_dicts = []
+    for project in projects:
+        project_dict = dict(project.__dict__)
+        project_dict['samples'] = []
+        for sample in project.samples:
+            sample_dict = dict(sample.__dict__)
+            sample_dict['files'] = [dict(f.__dict__) for f in sample.files]
+            project_dict['samples'].append(sample_dict)
+        project_dicts.append(project_dict)
+    return project_dicts
+
+
+def projects_from_dicts(project_dicts):
+    """Recreate the project tree from the output of projects_to_dicts. New
+    objects are created on each call, so the caller may modify them."""
+
+    projects = []
+    for pd in project_dicts:
+        project_samples = []
+        for sd in pd['samples']:
+            files = []
+            for fd in sd['files']:
+                f = FastqFile(fd['lane'], fd['i_read'], fd['filename'], fd['path'],
+                        fd['index_sequence'], fd['stats'])
+                f.empty = fd['empty']
+                files.append(f)
+            project_samples.append(Sample(sd['sample_index'], sd['sample_id'], sd['name'],
+                    sd['sample_dir'], files, sd['description']))
+        projects.append(Project(pd['name'], pd['proj_dir'], project_samples, pd['is_undetermined']))
+    return projects
+
+
 ################# SAMPLE SHEET ##################
 # Low level sample sheet parsing
 
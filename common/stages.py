@@ -0,0 +1,321 @@
+# Stage runner
+
+# Runs the numbered task scripts as separate processes, starting each script as
+# soon as the scripts which produce its inputs have completed. Independent
+# stages, e.g. md5 checksums and MultiQC, are thus run concurrently.
+
+# Each script reports its progress to the console using the Task class. With a
+# LIMS process ID, the runner owns the LIMS status: the scripts are given the
+# --status-file option, so they write their status updates to a file instead of
+# to LIMS. The runner is the only writer of the LIMS status: it relays the
+# progress of the running stages when it changes, and writes the final status
+# once at the end. If a stage fails, no more stages are started. The
+# running stages are allowed to finish, and the status of the first failed stage
+# is reported as the final status.
+
+# Alternatively, run_in_process runs the scripts one after the other in the
+# current process, sharing the arguments, LIMS session and run model.
+
+import os
+import sys
+import time
+import json
+import shutil
+import datetime
+import tempfile
+import importlib
+import subprocess
+
+from . import nsc
+from . import taskmgr
+
+
+class Stage(object):
+    """Declaration of a task script, with the data it uses and produces.
+
+    threads: the script accepts the --threads option."""
+
+    def __init__(self, script, inputs, outputs, threads=False):
+        self.script = script
+        self.inputs = inputs
+        self.outputs = outputs
+        self.threads = threads
+
+
+# Data not produced by any of the selected stages (fastq, stats) is assumed to be
+# available, as the runner is used after demultiplexing (40_move_results).
+STAGES = [
+    Stage("50_qc_analysis.py", ["fastq"], ["fastqc", "duplication", "md5_cache"], threads=True),
+    Stage("60_emails.py", ["stats", "duplication"], ["email_content"]),
+    Stage("60_update_lims.py", ["stats", "duplication"], []),
+    Stage("60_reports.py", ["stats", "fastqc"], ["pdf"]),
+    Stage("60_demultiplex_stats.py", ["stats"], ["demultiplex_stats"]),
+    Stage("70_multiqc.py", ["fastqc", "email_content"], ["multiqc"], threads=True),
+    Stage("80_md5sum.py", ["fastq", "md5_cache", "pdf"], ["md5"], threads=True),
+    Stage("90_prepare_delivery.py",
+        ["fastq", "fastqc", "duplication", "email_content", "pdf",
+            "demultiplex_stats", "multiqc", "md5"],
+        ["delivery"]),
+    Stage("90_triggers.py", ["delivery"], []),
+    ]
+
+
+# Scripts which change the inputs of the run model (sample sheet, fastq files). The
+# run model is not shared with the scripts after these, when run in one process.
+RUN_MODEL_INPUT_SCRIPTS = ["10_copy_run.py", "20_prepare_sample_sheet.py", "30_demultiplexing.py"]
+
+
+def get_stage(script):
+    for stage in STAGES:
+        if stage.script == os.path.basename(script):
+            return stage
+    raise ValueError("Unknown stage script " + script)
+
+
+def get_dependencies(stages):
+    """Get the scripts that each stage has to wait for: the stages earlier in
+    the list which produce any of its inputs.
+
+    Returns a dict of script name => set of script names."""
+
+    dependencies = {}
+    for i, stage in enumerate(stages):
+        dependencies[stage.script] = set(
+                producer.script
+                for producer in stages[:i]
+                if set(producer.outputs) & set(stage.inputs)
+                )
+    return dependencies
+
+
+def get_stage_args(stage, args):
+    """Get the command line arguments for the stage. The --threads option is
+    removed for scripts which don't accept it."""
+
+    if stage.threads:
+        return list(args)
+    stage_args = []
+    skip_next = False
+    for arg in args:
+        if skip_next:
+            skip_next = False
+        elif arg == "--threads":
+            skip_next = True
+        elif not arg.startswith("--threads="):
+            stage_args.append(arg)
+    return stage_args
+
+
+def run_stages(scripts, args, script_dir=None, python=sys.executable, poll_interval=2, pid=None):
+    """Run the scripts with the arguments args, in parallel where the declared
+    inputs and outputs allow it.
+
+    If pid (LIMS process ID) is given, the runner writes the LIMS status, and
+    the scripts write their status to a file (see Task.status_file). The status
+    of the running scripts is relayed to LIMS when it changes, and the final
+    status is written once, when all the stages have ended.
+
+    Returns the list of the scripts which failed (empty on success)."""
+
+    if script_dir is None:
+        script_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    stages = [get_stage(script) for script in scripts]
+    dependencies = get_dependencies(stages)
+    status_dir = tempfile.mkdtemp(prefix="stages-") if pid else None
+
+    pending = list(stages)
+    running = {}
+    completed = set()
+    failed = []
+    progress = None
+    try:
+        while pending or running:
+            if not failed:
+                for stage in list(pending):
+                    if dependencies[stage.script] <= completed:
+                        stage_args = get_stage_args(stage, args)
+                        if status_dir:
+                            stage_args = ["--status-file=" + os.path.join(status_dir, stage.script + ".json")] + stage_args
+                        running[stage.script] = subprocess.Popen(
+                                [python, os.path.join(script_dir, stage.script)] + stage_args
+                                )
+                        pending.remove(stage)
+            if not running:
+                break
+            if pid:
+                new_progress = get_progress_status(status_dir, sorted(running))
+                if new_progress != progress:
+                    set_lims_status(pid, new_progress)
+                    progress = new_progress
+            time.sleep(poll_interval)
+            for script, process in list(running.items()):
+                if process.poll() is not None:
+                    del running[script]
+                    if process.returncode == 0:
+                        completed.add(script)
+                    else:
+                        failed.append(script)
+                        if running:
+                            print("ERROR  [Stage runner] {0} failed, waiting for {1}".format(
+                                script, ", ".join(sorted(running))), file=sys.stderr)
+        if pid:
+            set_lims_status(pid, get_final_status(status_dir, failed))
+    finally:
+        if status_dir:
+            shutil.rmtree(status_dir)
+    return failed
+
+
+def read_status_file(status_dir, script):
+    """Get the status UDFs last written by the script, or None."""
+
+    try:
+        with open(os.path.join(status_dir, script + ".json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def get_progress_status(status_dir, scripts):
+    """Get the LIMS status UDFs showing the status of the running scripts."""
+
+    jobs = []
+    messages = []
+    for script in scripts:
+        status = read_status_file(status_dir, script) or {}
+        jobs.append(status.get(nsc.CURRENT_JOB_UDF) or script)
+        message = status.get(nsc.JOB_STATUS_UDF) or "Starting"
+        messages.append("[{0}] {1}".format(jobs[-1], message))
+    return {
+            nsc.JOB_STATUS_UDF: " / ".join(messages),
+            nsc.JOB_STATE_CODE_UDF: 'RUNNING',
+            nsc.CURRENT_JOB_UDF: ", ".join(jobs),
+            nsc.ERROR_DETAILS_UDF: ""
+            }
+
+
+def get_final_status(status_dir, failed):
+    """Get the final LIMS status UDFs: the status written by the first failed
+    script, if any, otherwise completed."""
+
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
+    if not failed:
+        return {
+                nsc.JOB_STATUS_UDF: "Completed successfully " + now,
+                nsc.JOB_STATE_CODE_UDF: 'COMPLETED',
+                nsc.ERROR_DETAILS_UDF: ""
+                }
+    status = read_status_file(status_dir, failed[0])
+    if status and status.get(nsc.JOB_STATE_CODE_UDF) == 'FAILED':
+        return status
+    else:
+        # The script exited without reporting its failure (e.g. bad arguments)
+        return {
+                nsc.JOB_STATUS_UDF: "Failed: " + now + ": " + failed[0] + " exited with an error",
+                nsc.JOB_STATE_CODE_UDF: 'FAILED',
+                nsc.CURRENT_JOB_UDF: failed[0],
+                nsc.ERROR_DETAILS_UDF: ""
+                }
+
+
+def set_lims_status(pid, status):
+    """Set the status UDFs of the LIMS process (pid in the same format as
+    --pid) to the values in the dict status."""
+
+    from genologics.lims import Process
+    if ':' in pid:
+        server_id, pid = pid.split(":")[0:2]
+    else:
+        server_id = None
+    process = Process(nsc.get_lims(server_id), id=pid)
+    process.get(force=True)
+    for udf, value in status.items():
+        process.udf[udf] = value
+    process.put()
+
+
+class _OptionsCollected(Exception):
+    pass
+
+
+class _OptionCollector(object):
+    """Stand-in for a Task, recording the options added by a script's main()
+    function. The scripts add their options before calling running(), which
+    stops the script here."""
+
+    def __init__(self):
+        self.options = []
+
+    def add_argument(self, *args, **kwargs):
+        self.options.append((args, kwargs))
+
+    def running(self, info_str=None):
+        raise _OptionsCollected()
+
+
+def get_script_options(module):
+    """Get the (args, kwargs) of the options the script adds with add_argument."""
+
+    collector = _OptionCollector()
+    try:
+        module.main(collector)
+    except _OptionsCollected:
+        pass
+    return collector.options
+
+
+def run_in_process(scripts, args, script_dir=None):
+    """Run the scripts one after the other in this process, by calling their
+    main(task) functions.
+
+    The command line arguments are parsed once, for all the options used by
+    the scripts (positional arguments: src_dir if used by any script, then
+    work_dir), including the options the scripts add themselves. The tasks
+    share one LIMS session and the run model (see Task.for_stage).
+    success_finish() and fail() don't exit; a failure stops the sequence.
+
+    Returns the list of the scripts which failed (empty on success)."""
+
+    if script_dir is None:
+        script_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if script_dir not in sys.path:
+        sys.path.insert(0, script_dir)
+    modules = [
+            importlib.import_module(os.path.splitext(os.path.basename(script))[0])
+            for script in scripts
+            ]
+    arg_names = [
+            name for name in taskmgr.ARG_OPTIONS
+            if any(name in module.TASK_ARGS for module in modules)
+            ]
+
+    shared_task = taskmgr.Task("Pipeline", "Run tasks in one process", arg_names)
+    shared_task.exit_on_finish = False
+    added_options = set()
+    for module in modules:
+        for option_args, option_kwargs in get_script_options(module):
+            if option_args not in added_options:
+                added_options.add(option_args)
+                shared_task.add_argument(*option_args, **option_kwargs)
+    argv = sys.argv
+    sys.argv = [argv[0]] + list(args)
+    try:
+        shared_task.running()
+    except taskmgr.TaskFailed:
+        return [scripts[0]]
+    finally:
+        sys.argv = argv
+
+    for script, module in zip(scripts, modules):
+        task = shared_task.for_stage(module.TASK_NAME, module.TASK_DESCRIPTION, module.TASK_ARGS)
+        task.script_name = os.path.basename(script)
+        try:
+            with task:
+                module.main(task)
+        except taskmgr.TaskFailed:
+            return [script]
+        if os.path.basename(script) in RUN_MODEL_INPUT_SCRIPTS:
+            shared_task._run_model = None
+        else:
+            shared_task._run_model = task._run_model
+    return []
@@ -3,8 +3,268 @@
 import re
 import os
 import json
+from . import nsc
 from . import utilities
 from . import samples
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Stats index
+# Stats.json can be several hundred MB for large runs, and the stats are needed by
+# multiple tasks, and multiple times within some tasks (once per project). The file
+# is parsed once into a compact index, with one record for each (lane, sample, read)
+# in the same order as in Stats.json. The index is saved in the log directory and
+# kept in memory. All combinations of aggregate_lanes / aggregate_reads are computed
+# from the index. It is rebuilt if the size or modification time of Stats.json changes.
+
+# Increment when the format of the index changes
+STATS_INDEX_VERSION = 1
+
+# Fields of the records in the index
+(REC_LANE, REC_SAMPLE_ID, REC_READ, REC_NUMBER_READS, REC_YIELD, REC_YIELD_Q30,
+        REC_QUALITY_SCORE_SUM, REC_MISMATCH0, REC_MISMATCH1) = range(9)
+
+# Size of reads from Stats.json when building the index
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Aggregate with NumPy array operations if it is available. The results are identical
+# to the pure Python implementation.
+USE_NUMPY = numpy is not None
+
+# In-memory cache: Stats.json path => index
+_stats_index_cache = {}
+
+
+def get_stats_path(run_dir, suffix=""):
+    return os.path.join(run_dir, "Data", "Intensities", "BaseCalls", "Stats" + suffix, "Stats.json")
+
+
+def get_stats_index_path(run_dir, suffix=""):
+    return os.path.join(run_dir, nsc.RUN_LOG_DIR, "stats_index{0}.json".format(suffix))
+
+
+def build_stats_index(stats_file_path):
+    """Parse Stats.json and return the index (see get_stats_index).
+
+    The file is read incrementally, and each DemuxResults entry is reduced to index
+    records as soon as it is decoded. Peak memory use depends on the number of
+    samples, not on the size of the file."""
+
+    lanes = []
+    records = []
+    with open(stats_file_path) as statsfile:
+        stream = JsonStream(statsfile)
+        for key in stream.iter_object():
+            if key == 'ConversionResults':
+                for _ in stream.iter_array():
+                    _read_conversion_result(stream, lanes, records)
+            else:
+                stream.skip_value()
+
+    return {'lanes': lanes, 'records': records}
+
+
+def _read_conversion_result(stream, lanes, records):
+    """Read one lane from the ConversionResults list, and add it to lanes / records."""
+
+    lane_info = {}
+    demux_records = []
+    undetermined_records = []
+    for key in stream.iter_object():
+        if key == 'DemuxResults':
+            for _ in stream.iter_array():
+                demux_records += _get_demux_records(stream.read_value(), False)
+        elif key == 'Undetermined':
+            undetermined_records = _get_demux_records(stream.read_value(), True)
+        elif key in ('LaneNumber', 'TotalClustersRaw', 'TotalClustersPF'):
+            lane_info[key] = stream.read_value()
+        else:
+            stream.skip_value()
+
+    lane_number = lane_info['LaneNumber']
+    lanes.append([lane_number, lane_info['TotalClustersRaw'], lane_info['TotalClustersPF']])
+    for record in demux_records + undetermined_records:
+        record[REC_LANE] = lane_number
+        records.append(record)
+
+
+def _get_demux_records(demux_result, is_undetermined):
+    """Get the index records for a DemuxResults entry. The lane is filled in by the caller."""
+
+    if is_undetermined:
+        sample_id = None
+    else:
+        sample_id = demux_result['SampleId']
+    if 'IndexMetrics' in demux_result:
+        mm0 = sum(im['MismatchCounts']['0'] for im in demux_result['IndexMetrics'])
+        mm1 = sum(im['MismatchCounts']['1'] for im in demux_result['IndexMetrics'])
+    else:
+        mm0, mm1 = None, 0
+    return [
+            [
+                None, sample_id, read_metrics['ReadNumber'],
+                demux_result['NumberReads'], read_metrics['Yield'],
+                read_metrics['YieldQ30'], read_metrics['QualityScoreSum'],
+                mm0, mm1
+            ]
+            for read_metrics in demux_result['ReadMetrics']
+        ]
+
+
+class JsonStream(object):
+    """Incremental reader for large JSON files.
+
+    Objects and arrays are walked with iter_object and iter_array, and the values
+    inside them are decoded with read_value (or discarded with skip_value). Only the
+    value being decoded and a read buffer are kept in memory.
+
+    The caller must consume the value for each key / element, before advancing the
+    iterator."""
+
+    _WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, fileobj, chunk_size=None):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size or STREAM_CHUNK_SIZE
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+
+    def _fill(self):
+        """Read more data into the buffer. Returns False at end of file.
+
+        At least as much as is already buffered is read, so a large value is
+        decoded a bounded number of times."""
+
+        data = self.fileobj.read(max(self.chunk_size, len(self.buf) - self.pos))
+        if not data:
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        """Skip whitespace and return the next character, or "" at end of file."""
+
+        while True:
+            self.pos = self._WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def _expect(self, chars):
+        char = self._peek()
+        if not char or char not in chars:
+            raise ValueError("Invalid JSON: expected one of '{0}' at '{1}'".format(
+                chars, self.buf[self.pos:self.pos+20]))
+        self.pos += 1
+        return char
+
+    def read_value(self):
+        """Decode and return the next value."""
+
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if self._fill():
+                    continue
+                raise
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def skip_value(self):
+        """Read past the next value. Arrays and objects are not decoded as a whole."""
+
+        char = self._peek()
+        if char == "[":
+            for _ in self.iter_array():
+                self.skip_value()
+        elif char == "{":
+            for _ in self.iter_object():
+                self.skip_value()
+        else:
+            self.read_value()
+
+    def iter_object(self):
+        """Iterate over the keys of the next value, which must be an object."""
+
+        self._expect("{")
+        if self._peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self._expect(":")
+            yield key
+            if self._expect(",}") == "}":
+                return
+
+    def iter_array(self):
+        """Iterate over the next value, which must be an array. Yields the index
+        of each element."""
+
+        self._expect("[")
+        if self._peek() == "]":
+            self.pos += 1
+            return
+        i = 0
+        while True:
+            yield i
+            i += 1
+            if self._expect(",]") == "]":
+                return
+
+
+def get_stats_index(run_dir, suffix=""):
+    """Get the index of the demultiplexing stats.
+
+    The index is a dict with keys:
+    lanes   - list of [lane number, TotalClustersRaw, TotalClustersPF]
+    records - list of records, lists with the fields given by the REC_*
+              constants above. Mismatch0 is None if there are no IndexMetrics.
+    """
+
+    stats_file_path = get_stats_path(run_dir, suffix)
+    stat = os.stat(stats_file_path)
+    source = [stat.st_size, stat.st_mtime_ns]
+
+    cached = _stats_index_cache.get(stats_file_path)
+    if cached and cached['source'] == source:
+        return cached
+
+    index_path = get_stats_index_path(run_dir, suffix)
+    try:
+        with open(index_path) as index_file:
+            index = json.load(index_file)
+        if index.get('version') != STATS_INDEX_VERSION or index.get('source') != source:
+            index = None
+    except (IOError, ValueError):
+        index = None
+
+    if index is None:
+        index = build_stats_index(stats_file_path)
+        index['version'] = STATS_INDEX_VERSION
+        index['source'] = source
+        if os.path.isdir(os.path.dirname(index_path)):
+            tmp_path = "{0}.{1}.tmp".format(index_path, os.getpid())
+            try:
+                with open(tmp_path, 'w') as index_file:
+                    json.dump(index, index_file, separators=(',', ':'))
+                os.replace(tmp_path, index_path)
+            except (IOError, OSError):
+                pass # The index file is only an optimisation
+
+    _stats_index_cache[stats_file_path] = index
+    return index
+
 
 def get_stats(
         _,  # Instrument
@@ -13,58 +273,51 @@ def get_stats(
         aggregate_reads=False,
         suffix=""
         ):
-    stats_file_path = os.path.join(run_dir, "Data", "Intensities", "BaseCalls", "Stats" + suffix, "Stats.json")
-    with open(stats_file_path) as  statsfile:
-        stats = json.load(statsfile)
+    index = get_stats_index(run_dir, suffix)
+    if USE_NUMPY:
+        return _aggregate_numpy(index, aggregate_lanes, aggregate_reads)
+    else:
+        return _aggregate_python(index, aggregate_lanes, aggregate_reads)
 
-    sums = {}
-    lane_stats = {}
-    for conversion_result in stats['ConversionResults']:
 
-        lane_number = conversion_result['LaneNumber']
+def _aggregate_python(index, aggregate_lanes, aggregate_reads):
+    lane_stats = {}
+    for lane_number, total_clusters_raw, total_clusters_pf in index['lanes']:
         if aggregate_lanes: lane_number = "X"
         lane_metrics = lane_stats.get(lane_number, {
             'TotalClustersRaw': 0,
             'TotalClustersPF': 0
         })
-        lane_metrics['TotalClustersRaw'] += conversion_result['TotalClustersRaw']
-        lane_metrics['TotalClustersPF'] += conversion_result['TotalClustersPF']
+        lane_metrics['TotalClustersRaw'] += total_clusters_raw
+        lane_metrics['TotalClustersPF'] += total_clusters_pf
         lane_stats[lane_number] = lane_metrics
 
-        demux_result_list = [(False, dr) for dr in conversion_result['DemuxResults']]
-        if 'Undetermined' in conversion_result:
-            demux_result_list.append((True, conversion_result['Undetermined']))
+    sums = {}
+    for record in index['records']:
+        lane_number = record[REC_LANE]
+        if aggregate_lanes: lane_number = "X"
+        read_number = record[REC_READ]
+        if aggregate_reads: read_number = 1
+        coordinates = (lane_number, record[REC_SAMPLE_ID], read_number)
 
-        for is_undetermined, demux_result in demux_result_list:
-            if is_undetermined:
-                sample_id = None
+        data = sums.get(coordinates, {
+            'NumberClusters': 0, 'NumberReads': 0, 'Yield': 0,
+            'YieldQ30': 0, 'QualityScoreSum': 0,
+            'Mismatch0': None, 'Mismatch1': 0
+        })
+        if record[REC_READ] == 1 or (not aggregate_reads):
+            data['NumberClusters'] += record[REC_NUMBER_READS]
+        data['NumberReads'] += record[REC_NUMBER_READS]
+        data['Yield'] += record[REC_YIELD]
+        data['YieldQ30'] += record[REC_YIELD_Q30]
+        data['QualityScoreSum'] += record[REC_QUALITY_SCORE_SUM]
+        if record[REC_MISMATCH0] is not None:
+            if data['Mismatch0'] is not None:
+                data['Mismatch0'] += record[REC_MISMATCH0]
             else:
-                sample_id = demux_result['SampleId']
-
-            for read_metrics in demux_result['ReadMetrics']:
-                read_number = read_metrics['ReadNumber']
-                if aggregate_reads: read_number = 1
-                coordinates = (lane_number, sample_id, read_number)
-
-                data = sums.get(coordinates, {
-                    'NumberClusters': 0, 'NumberReads': 0, 'Yield': 0,
-                    'YieldQ30': 0, 'QualityScoreSum': 0,
-                    'Mismatch0': None, 'Mismatch1': 0
-                })
-                if read_metrics['ReadNumber'] == 1 or (not aggregate_reads):
-                    data['NumberClusters'] += demux_result['NumberReads']
-                data['NumberReads'] += demux_result['NumberReads']
-                data['Yield'] += read_metrics['Yield']
-                data['YieldQ30'] += read_metrics['YieldQ30']
-                data['QualityScoreSum'] += read_metrics['QualityScoreSum']
-                if 'IndexMetrics' in demux_result:
-                    mm0 = sum(im['MismatchCounts']['0'] for im in demux_result['IndexMetrics'])
-                    if data['Mismatch0'] is not None:
-                        data['Mismatch0'] += mm0
-                    else:
-                        data['Mismatch0'] = mm0
-                    data['Mismatch1'] += sum(im['MismatchCounts']['1'] for im in demux_result['IndexMetrics'])
-                sums[coordinates] = data
+                data['Mismatch0'] = record[REC_MISMATCH0]
+            data['Mismatch1'] += record[REC_MISMATCH1]
+        sums[coordinates] = data
 
     results = {}
     for coordinates, csums in list(sums.items()):
@@ -86,6 +339,149 @@ def get_stats(
     return results
 
 
+def _get_index_arrays(index):
+    """Get the records of the index as NumPy arrays (one array per field). The
+    arrays are cached in the in-memory index."""
+
+    arrays = index.get('_arrays')
+    if arrays is None:
+        records = index['records']
+        sample_ids = []
+        sample_codes = {}
+        codes = []
+        for record in records:
+            code = sample_codes.get(record[REC_SAMPLE_ID])
+            if code is None:
+                code = sample_codes[record[REC_SAMPLE_ID]] = len(sample_ids)
+                sample_ids.append(record[REC_SAMPLE_ID])
+            codes.append(code)
+        columns = list(zip(*records)) if records else [()] * (REC_MISMATCH1 + 1)
+        arrays = {
+                'sample_ids': sample_ids,
+                'sample_code': numpy.array(codes, dtype=numpy.int64),
+                'has_mismatch0': numpy.array([mm0 is not None for mm0 in columns[REC_MISMATCH0]], dtype=bool),
+                'lane_numbers': [lane[0] for lane in index['lanes']],
+                'lane_clusters': numpy.array([lane[1:] for lane in index['lanes']], dtype=numpy.int64).reshape(-1, 2)
+                }
+        for field, column in [
+                ('lane', REC_LANE), ('read', REC_READ), ('number_reads', REC_NUMBER_READS),
+                ('yield', REC_YIELD), ('yield_q30', REC_YIELD_Q30),
+                ('quality_score_sum', REC_QUALITY_SCORE_SUM), ('mismatch1', REC_MISMATCH1)]:
+            arrays[field] = numpy.array(columns[column], dtype=numpy.int64)
+        arrays['mismatch0'] = numpy.array(
+                [mm0 or 0 for mm0 in columns[REC_MISMATCH0]], dtype=numpy.int64
+                )
+        index['_arrays'] = arrays
+    return arrays
+
+
+def _group_first_seen(keys):
+    """Group the rows of the integer array keys (one row per record).
+
+    Returns (group, first) where group is the group number of each record, and first
+    is the index of the first record in each group. Groups are numbered in order
+    of their first record, like the insertion order of a dict."""
+
+    _, first, inverse = numpy.unique(keys, axis=0, return_index=True, return_inverse=True)
+    order = numpy.argsort(first, kind='stable')
+    rank = numpy.empty_like(order)
+    rank[order] = numpy.arange(len(order))
+    return rank[inverse.reshape(-1)], first[order]
+
+
+def _group_sum(values, group, n_groups):
+    """Exact (integer) sums of values for each group."""
+
+    sums = numpy.zeros(n_groups, dtype=values.dtype)
+    numpy.add.at(sums, group, values)
+    return sums
+
+
+def _aggregate_numpy(index, aggregate_lanes, aggregate_reads):
+    """Same as _aggregate_python, with array operations for the sums and derived
+    metrics."""
+
+    arrays = _get_index_arrays(index)
+    if len(arrays['sample_code']) == 0:
+        return {}
+
+    # Lane totals
+    if aggregate_lanes:
+        lane_keys = ["X"]
+        lane_totals = arrays['lane_clusters'].sum(axis=0, keepdims=True)
+    else:
+        lane_keys = list(dict.fromkeys(arrays['lane_numbers']))
+        lane_group = numpy.array([lane_keys.index(l) for l in arrays['lane_numbers']], dtype=numpy.int64)
+        lane_totals = numpy.zeros((len(lane_keys), 2), dtype=numpy.int64)
+        numpy.add.at(lane_totals, lane_group, arrays['lane_clusters'])
+
+    if not lane_totals.all():
+        return _aggregate_python(index, aggregate_lanes, aggregate_reads) # Raises ZeroDivisionError
+
+    # Coordinates of each record
+    lane = numpy.zeros_like(arrays['lane']) if aggregate_lanes else arrays['lane']
+    read = numpy.ones_like(arrays['read']) if aggregate_reads else arrays['read']
+    group, first = _group_first_seen(numpy.stack([lane, arrays['sample_code'], read], axis=1))
+    n_groups = len(first)
+
+    number_reads = arrays['number_reads']
+    if aggregate_reads:
+        clusters = numpy.where(arrays['read'] == 1, number_reads, 0)
+    else:
+        clusters = number_reads
+    has_mismatch0 = arrays['has_mismatch0']
+    sum_clusters = _group_sum(clusters, group, n_groups)
+    sum_reads = _group_sum(number_reads, group, n_groups)
+    sum_yield = _group_sum(arrays['yield'], group, n_groups)
+    sum_yield_q30 = _group_sum(arrays['yield_q30'], group, n_groups)
+    sum_quality_score = _group_sum(arrays['quality_score_sum'], group, n_groups)
+    sum_mismatch0 = _group_sum(numpy.where(has_mismatch0, arrays['mismatch0'], 0), group, n_groups)
+    sum_mismatch1 = _group_sum(numpy.where(has_mismatch0, arrays['mismatch1'], 0), group, n_groups)
+    any_mismatch0 = _group_sum(has_mismatch0.astype(numpy.int64), group, n_groups) > 0
+
+    # Lane totals for each group
+    if aggregate_lanes:
+        group_lane_totals = numpy.repeat(lane_totals, n_groups, axis=0)
+    else:
+        lane_index = {l: i for i, l in enumerate(lane_keys)}
+        group_lane_totals = lane_totals[[lane_index[l] for l in arrays['lane'][first].tolist()]]
+
+    reads_denominator = numpy.maximum(sum_reads, 1).astype(numpy.float64)
+    yield_denominator = numpy.maximum(sum_yield, 1).astype(numpy.float64)
+    # 100% if there are no IndexMetrics, as in _aggregate_python
+    perfect_index = [
+            value if any_mm0 else 100
+            for value, any_mm0 in zip(
+                (sum_mismatch0 * 100.0 / reads_denominator).tolist(),
+                any_mismatch0.tolist()
+                )
+            ]
+    metrics = [
+            ('# Reads PF', sum_reads.tolist()),
+            ('Yield PF (Gb)', (sum_yield.astype(numpy.float64) / 1e9).tolist()),
+            ('%PF', [100.0] * n_groups),
+            ('% of Raw Clusters Per Lane', (sum_clusters * 100.0 / group_lane_totals[:,0].astype(numpy.float64)).tolist()),
+            ('% of PF Clusters Per Lane', (sum_clusters * 100.0 / group_lane_totals[:,1].astype(numpy.float64)).tolist()),
+            ('% One Mismatch Reads (Index)', (sum_mismatch1 * 100.0 / reads_denominator).tolist()),
+            ('% Bases >=Q30', (sum_yield_q30 * 100.0 / yield_denominator).tolist()),
+            ('Ave Q Score', (sum_quality_score * 1.0 / yield_denominator).tolist()),
+            ('% Perfect Index Read', perfect_index)
+            ]
+
+    sample_ids = arrays['sample_ids']
+    coordinates = zip(
+            ["X"] * n_groups if aggregate_lanes else arrays['lane'][first].tolist(),
+            [sample_ids[code] for code in arrays['sample_code'][first].tolist()],
+            read[first].tolist()
+            )
+    names = [name for name, _ in metrics]
+    results = {
+            coords: dict(zip(names, values))
+            for coords, values in zip(coordinates, zip(*[values for _, values in metrics]))
+            }
+    return results
+
+
 ###################### Other metrics #######################
 
 def add_duplication_results(qc_dir, projects):
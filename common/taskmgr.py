@@ -7,11 +7,13 @@ import traceback
 import argparse
 import datetime
 import time
+import json
 
 # local
 from . import utilities
 from . import samples
 from . import nsc
+from . import run_model
 
 from genologics.lims import *
 
@@ -37,6 +39,12 @@ ARG_OPTIONS = {
         }
 DEFAULT_VAL_INDEX = 3
 
+
+class TaskFailed(Exception):
+    """Raised by Task.fail() instead of exiting, when exit_on_finish is False."""
+    pass
+
+
 class Task(object): 
     """Class to manage the processing tasks (scripts) in a common way for LIMS
     and non-LIMS invocation.
@@ -58,12 +66,42 @@ class Task(object):
         self.script_name = os.path.basename(sys.argv[0])
         self.parser = argparse.ArgumentParser(description=task_description)
         self.parser.add_argument("--pid", dest="pid", default=None, help="Process ID if running within LIMS")
+        self.parser.add_argument("--status-file", dest="status_file", default=None,
+                help="Write the final status to this file instead of to LIMS (used by the stage runner)")
         self.args = None # To be set when argument parser is run
         self.process = None
         self.finished = False
         self.success = False
         self.message = ""
         self.lims = None
+        self._run_model = None # See run_model property
+        # If set, the status is not written to LIMS. The status UDFs are written to
+        # this file instead, for the stage runner, which owns the LIMS status.
+        self.status_file = None
+        # If False, success_finish() returns and fail() raises TaskFailed, instead
+        # of calling sys.exit(). Used when running multiple tasks in one process.
+        self.exit_on_finish = True
+
+
+    def for_stage(self, task_name, task_description, arg_names):
+        """Create a Task for a script run in the same process as this task
+        (see stages.run_in_process).
+
+        The new task shares the parsed arguments, the LIMS connection and process,
+        and the run model with this task. Its running() method only reports the
+        status, without parsing arguments or connecting to LIMS again. This task
+        must already be running, with the options the script adds itself (the
+        script's add_argument calls go to the new task's unused parser)."""
+
+        task = Task(task_name, task_description, arg_names)
+        task.script_name = self.script_name
+        task.args = self.args
+        task.lims = self.lims
+        task.process = self.process
+        task._run_model = self._run_model
+        task.exit_on_finish = self.exit_on_finish
+        task.status_file = self.status_file
+        return task
 
 
     def get_arg(self, arg_name):
@@ -180,39 +218,48 @@ class Task(object):
                     )
 
     @property
-    def projects(self):
-        """Get the list of project objects, defined in the samples module. """
-
-        num_reads, index_reads = utilities.get_num_reads(self.work_dir)
-        sample_sheet = samples.parse_sample_sheet(self.sample_sheet_content.decode('utf-8'))
-        sample_sheet_data = sample_sheet['data']
-
-        # Supply a list of lanes if lane number isn't given in the sample sheet
-        expand_lanes = None
-        if not self.no_lane_splitting:
-            instr = utilities.get_instrument_by_runid(self.run_id)
-            if instr == "nextseq":
-                expand_lanes = [1,2,3,4]
-            elif instr == "miseq":
-                expand_lanes = [1]
-            elif instr == "novaseq":
-                expand_lanes = samples.get_lane_numbers_from_fastq_files(self.work_dir)
+    def run_model(self):
+        """Get the run model (project tree, number of reads, merged lanes option)
+        defined in the run_model module.
+
+        The model is loaded from the snapshot file in the run folder if it is
+        up to date, otherwise it is built and saved for the next tasks. It is
+        also kept in memory, as some tasks access the projects multiple times."""
+
+        if self._run_model is not None:
+            return self._run_model
+
+        sample_sheet_content = self.sample_sheet_content
+        if self.process:
+            no_lane_splitting_udf = self.no_lane_splitting
+        else:
+            no_lane_splitting_udf = None
+        key = run_model.get_key(self.run_id, self.work_dir, sample_sheet_content,
+                self.lanes, no_lane_splitting_udf)
+        path = run_model.snapshot_path(self.work_dir, self.suffix)
+        model = run_model.load(path, key)
+        if model is None:
+            if self.process:
+                no_lane_splitting = no_lane_splitting_udf
+                detected = bool(key['fastq_layout'])
             else:
-                expand_lanes = None
-
-        experiment_name = None
-        if 'header' in sample_sheet:
-            experiment_name = sample_sheet['header'].get("Experiment Name")
-
-        return samples.get_projects(
-                self.run_id,
-                sample_sheet_data,
-                num_reads,
-                self.no_lane_splitting,
-                expand_lanes,
-                experiment_name,
-                self.lanes
-                )
+                no_lane_splitting, detected = self._detect_no_lane_splitting()
+            model = run_model.build(self.run_id, self.work_dir, sample_sheet_content,
+                    no_lane_splitting, self.lanes)
+            # Don't save the snapshot if the FASTQ files are not there (yet), or
+            # if this is not a real run folder (no log dir).
+            if detected and os.path.isdir(os.path.dirname(path)):
+                run_model.save(path, key, model)
+        self._run_model = model
+        return model
+
+    @property
+    def projects(self):
+        """Get the list of project objects, defined in the samples module.
+        
+        New objects are returned each time, so they may be modified."""
+
+        return samples.projects_from_dicts(self.run_model['projects'])
 
     @property
     def no_lane_splitting(self):
@@ -223,11 +270,18 @@ class Task(object):
         if self.process:
             return utilities.get_udf(self.process, nsc.NO_LANE_SPLITTING_UDF, False)
         else:
-            try:
-                return samples.check_files_merged_lanes(self.work_dir)
-            except ValueError as e:
-                self.warn(str(e))
-                return False
+            return self.run_model['no_lane_splitting']
+
+    def _detect_no_lane_splitting(self):
+        """Check the FASTQ files to determine if lanes are merged.
+
+        Returns a tuple (no_lane_splitting, detected). detected is False if
+        there are no FASTQ files to check."""
+        try:
+            return samples.check_files_merged_lanes(self.work_dir), True
+        except ValueError as e:
+            self.warn(str(e))
+            return False, False
     
     @property
     def lanes(self):
@@ -288,7 +342,7 @@ class Task(object):
 
         if etype is None:
             print("Uexpected exit", file=sys.stderr)
-            if self.process:
+            if self.process and not self.status_file:
                 utilities.fail(self.process, "Unexpected exit", "Unexpected exit without exception")
 
         # Note: fail() function calls exit()
@@ -325,6 +379,14 @@ class Task(object):
         This function can then use those arguments to populate the Task
         internal state."""
 
+        if self.args is not None: # Task created by for_stage()
+            if self.process:
+                self._set_lims_running()
+            print("START  [" + self.task_name + "] " + self.script_name, file=sys.stderr)
+            if info_str:
+                self.info(info_str)
+            return
+
         # Initialization code common to all tasks:
         os.umask(7)
 
@@ -353,6 +415,7 @@ class Task(object):
         except SystemExit:
             self.finished = True
             raise
+        self.status_file = self.args.status_file
 
         if not self.args.pid and not self.args.work_dir:
             self.fail("Missing required options", 
@@ -367,12 +430,7 @@ class Task(object):
                 server_id, pid = None, self.args.pid
             self.lims = nsc.get_lims(server_id)
             self.process = Process(self.lims, id=pid)
-            self.process.get()
-            self.process.udf[nsc.JOB_STATUS_UDF] = "Running"
-            self.process.udf[nsc.JOB_STATE_CODE_UDF] = 'RUNNING'
-            self.process.udf[nsc.CURRENT_JOB_UDF] = self.task_name
-            self.process.udf[nsc.ERROR_DETAILS_UDF] = ""
-            self.process.put()
+            self._set_lims_running()
 
             # Set defaults for source & working directories based on run ID
             # (only available for LIMS)
@@ -408,6 +466,18 @@ class Task(object):
             self.info(info_str)
 
 
+    def _set_lims_running(self):
+        if self.status_file:
+            self._write_status_file("Running", 'RUNNING')
+            return
+        self.process.get()
+        self.process.udf[nsc.JOB_STATUS_UDF] = "Running"
+        self.process.udf[nsc.JOB_STATE_CODE_UDF] = 'RUNNING'
+        self.process.udf[nsc.CURRENT_JOB_UDF] = self.task_name
+        self.process.udf[nsc.ERROR_DETAILS_UDF] = ""
+        self.process.put()
+
+
     def info(self, status):
         self.safe_lims_update("Running ({0})".format(status))
         print("INFO   [" + self.task_name + "] " + status, file=sys.stderr)
@@ -451,7 +521,8 @@ class Task(object):
     def fail(self, message, extra_info = None):
         """Report failure.
         
-        NOTE: Calls sys.exit(1) to terminate program.
+        NOTE: Calls sys.exit(1) to terminate program, or raises TaskFailed if
+        exit_on_finish is False.
         
         (this was considered a more convenient protocol at the time of 
         writing this code)"""
@@ -466,24 +537,46 @@ class Task(object):
             print(extra_info, file=sys.stderr)
             print("-----------", file=sys.stderr)
         print("ERROR  [" + self.task_name + "] " + message, file=sys.stderr)
-        sys.exit(1)
+        if self.exit_on_finish:
+            sys.exit(1)
+        else:
+            raise TaskFailed(message)
 
 
     def success_finish(self):
         """Notify LIMS or command line that the job is completed.
         
-        NOTE: Calls sys.exit(0) to terminate program."""
+        NOTE: Calls sys.exit(0) to terminate program, unless exit_on_finish is
+        False."""
 
         self.finished = True
         self.success = True
         complete_str = 'Completed successfully ' + datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
         self.safe_lims_update(complete_str, 'COMPLETED')
         print("SUCCESS[" + self.task_name + "] " + complete_str, file=sys.stderr)
-        sys.exit(0)
+        if self.exit_on_finish:
+            sys.exit(0)
+
+
+    def _write_status_file(self, message, state_code, error_details=None):
+        """Write the status UDFs to the status file. It is written to a temporary
+        name and renamed, so the stage runner never reads a partial file."""
+
+        tmp_path = "{0}.{1}.tmp".format(self.status_file, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                nsc.JOB_STATUS_UDF: message,
+                nsc.JOB_STATE_CODE_UDF: state_code,
+                nsc.CURRENT_JOB_UDF: self.task_name,
+                nsc.ERROR_DETAILS_UDF: error_details or ""
+                }, f)
+        os.replace(tmp_path, self.status_file)
 
 
     def safe_lims_update(self, message, state_code=None, error_details=None, force=False):
-        if self.process:
+        if self.status_file:
+            self._write_status_file(message, state_code or 'RUNNING', error_details)
+        elif self.process:
             started = time.time()
             while time.time() < started + 4*24*3600:
                 try:
@@ -0,0 +1,201 @@
+# Delivery transfer engine
+
+# Links or copies a directory tree to the delivery area. The source tree is
+# enumerated once with os.scandir, the directories are created, and the files are
+# hard-linked by a pool of threads. Files are copied if hard links are not
+# possible, e.g. if the destination is on another file system.
+
+# Each transferred file is appended to a manifest (JSON lines). If the transfer is
+# interrupted, running it again with the same manifest skips the files which are
+# already done. The first line of the manifest records the source and
+# destination, and a manifest for another transfer is ignored.
+
+import os
+import json
+import time
+import errno
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Number of files linked or copied at a time
+TRANSFER_THREADS = 8
+
+# Interval between progress messages (seconds)
+PROGRESS_INTERVAL = 60
+
+# Errors from os.link which mean that the file has to be copied
+LINK_FALLBACK_ERRNOS = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP)
+
+
+def scan_tree(source):
+    """List the contents of the directory source.
+
+    Returns (dirs, files, symlinks): lists of paths relative to source. The
+    directories are in top-down order, and files is a list of (path, size)."""
+
+    dirs = []
+    files = []
+    symlinks = []
+    pending = [""]
+    while pending:
+        rel_dir = pending.pop()
+        for entry in sorted(os.scandir(os.path.join(source, rel_dir)), key=lambda e: e.name):
+            rel_path = os.path.join(rel_dir, entry.name)
+            if entry.is_symlink():
+                symlinks.append(rel_path)
+            elif entry.is_dir():
+                dirs.append(rel_path)
+                pending.append(rel_path)
+            else:
+                files.append((rel_path, entry.stat().st_size))
+    return dirs, files, symlinks
+
+
+def transfer_file(source_path, dest_path, link=True):
+    """Hard-link or copy a file. An existing destination is accepted if it is
+    the same file (from an earlier, interrupted run).
+
+    Returns "link" or "copy"."""
+
+    if link:
+        try:
+            os.link(source_path, dest_path)
+            return "link"
+        except OSError as e:
+            if e.errno == errno.EEXIST and os.path.samefile(source_path, dest_path):
+                return "link"
+            if e.errno not in LINK_FALLBACK_ERRNOS:
+                raise
+    shutil.copy2(source_path, dest_path)
+    return "copy"
+
+
+def read_manifest(manifest_path, header):
+    """Get the set of paths already transferred, if the manifest is for the same
+    transfer (header), else None."""
+
+    try:
+        with open(manifest_path) as manifest_file:
+            lines = manifest_file.readlines()
+    except IOError:
+        return None
+    try:
+        if not lines or json.loads(lines[0]) != header:
+            return None
+    except ValueError:
+        return None
+    done = set()
+    for line in lines[1:]:
+        try:
+            done.add(json.loads(line)[0])
+        except ValueError:
+            # Partially written line: the file is transferred again
+            pass
+    return done
+
+
+def manifest_header(source, dest):
+    return {'source': os.path.abspath(source), 'dest': os.path.abspath(dest)}
+
+
+def transfer_tree(source, dest_parent, manifest_path=None, link=True,
+        threads=TRANSFER_THREADS, task=None):
+    """Link (or copy, if link is False) the directory source into dest_parent,
+    as "cp -rl source dest_parent". Symlinks are recreated, not followed.
+
+    If manifest_path is given, the transferred files are recorded there, and a
+    previous transfer with the same manifest is resumed. If task is given, the
+    progress is reported with task.info.
+
+    Returns (number of files, number of bytes) transferred by this call."""
+
+    source = source.rstrip("/")
+    dest = os.path.join(dest_parent, os.path.basename(source))
+    dirs, files, symlinks = scan_tree(source)
+
+    header = manifest_header(source, dest)
+    done = set()
+    manifest_file = None
+    if manifest_path:
+        done = read_manifest(manifest_path, header)
+        if done is None:
+            done = set()
+            manifest_file = open(manifest_path, 'w')
+            manifest_file.write(json.dumps(header) + "\n")
+            manifest_file.flush()
+        else:
+            manifest_file = open(manifest_path, 'a')
+
+    try:
+        for rel_dir in [""] + dirs:
+            dest_dir = os.path.join(dest, rel_dir)
+            if not os.path.isdir(dest_dir):
+                os.mkdir(dest_dir)
+                shutil.copymode(os.path.join(source, rel_dir), dest_dir)
+        for rel_path in symlinks:
+            dest_path = os.path.join(dest, rel_path)
+            if not os.path.lexists(dest_path):
+                os.symlink(os.readlink(os.path.join(source, rel_path)), dest_path)
+
+        todo = [(rel_path, size) for rel_path, size in files if rel_path not in done]
+        total_bytes = sum(size for _, size in todo)
+        n_files = 0
+        n_bytes = 0
+        errors = []
+        start_time = last_report = time.time()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = dict(
+                    (executor.submit(transfer_file, os.path.join(source, rel_path),
+                        os.path.join(dest, rel_path), link), (rel_path, size))
+                    for rel_path, size in todo
+                    )
+            for future in as_completed(futures):
+                rel_path, size = futures[future]
+                # All the successful transfers are recorded before an error is raised
+                try:
+                    method = future.result()
+                except (IOError, OSError) as e:
+                    errors.append(e)
+                    continue
+                n_files += 1
+                n_bytes += size
+                if manifest_file:
+                    # Flushed at once, so the record survives if the process is killed
+                    manifest_file.write(json.dumps([rel_path, size, method]) + "\n")
+                    manifest_file.flush()
+                now = time.time()
+                if task and now - last_report >= PROGRESS_INTERVAL:
+                    task.info("Transfer {0}: {1}/{2} files, {3:.1f}/{4:.1f} GB ({5:.0f} MB/s)".format(
+                        os.path.basename(source), n_files, len(todo),
+                        n_bytes / 1024.0**3, total_bytes / 1024.0**3,
+                        n_bytes / 1024.0**2 / (now - start_time)))
+                    last_report = now
+        if errors:
+            raise errors[0]
+    finally:
+        if manifest_file:
+            os.fsync(manifest_file.fileno())
+            manifest_file.close()
+    return n_files, n_bytes
+
+
+def move_tree(source, dest_parent, manifest_path=None, threads=TRANSFER_THREADS, task=None):
+    """Move the directory source into dest_parent, as "mv source dest_parent".
+    If it is on another file system, the tree is copied with transfer_tree and
+    the source is deleted.
+
+    An existing destination is an error, unless manifest_path is given and the
+    manifest is for this move: then it is an interrupted copy, which is resumed."""
+
+    source = source.rstrip("/")
+    dest = os.path.join(dest_parent, os.path.basename(source))
+    if os.path.lexists(dest) and (not manifest_path or
+            read_manifest(manifest_path, manifest_header(source, dest)) is None):
+        raise OSError(errno.EEXIST, "Destination already exists", dest)
+    try:
+        os.rename(source, dest)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        transfer_tree(source, dest_parent, manifest_path, link=False, threads=threads, task=task)
+        shutil.rmtree(source)
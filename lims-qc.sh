@@ -10,8 +10,6 @@ then
 	exit 1
 fi
 
-for script in $SCRIPTS
-do
-	nsc-python3 $(dirname $0)/$script --pid=$1
-done
+# Independent scripts are run concurrently
+nsc-python3 $(dirname $0)/run-stages.py $SCRIPTS -- --pid=$1
 
@@ -1,11 +1,17 @@
 import sys
 import os
+import json
+import time
+import errno
+import hashlib
 import logging
 import shutil
+import threading
 import yaml
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from dataclasses import dataclass, field
-from typing import List, Dict
+from typing import Callable, List, Dict, Set, Optional
 
 # Setup logging
 logging.basicConfig(
@@ -49,9 +55,14 @@ TEST_DISABLE_MOVING = os.environ.get("TEST_DISABLE_MOVING", "False").lower() in
 
 ## READNE TROUBLESHOOTING MODE ##
 
-# To fix issues, enable the following two "IGNORE_*" options. Remove QualityControl from all project folders in
-# /boston/diag/nscDelivery and the run folder in /boston/runScratch/demultiplexed first. Fix the root cause.
-# Rerun the file mover or trigger the automation again by removing the automation log.
+# The file mover writes a journal of the planned and completed operations next to the LIMS file
+# (JOURNAL_NAME). If it fails, fix the root cause and rerun the file mover, or trigger the automation
+# again by removing the automation log. The rerun skips the completed steps and operations, and only
+# runs the remaining ones.
+
+# If the journal can't be used, delete it, and enable the following two "IGNORE_*" options. Remove
+# QualityControl from all project folders in /boston/diag/nscDelivery and the run folder in
+# /boston/runScratch/demultiplexed first. Then rerun the file mover.
 
 # The following two options disable the checks and disable errors if the moving commands fail.
 # This option skips over files when the source does not exist. This can be used to recover failed
@@ -60,6 +71,20 @@ IGNORE_MISSING = os.environ.get("IGNORE_MISSING", "False").lower() in ("1", "tru
 # Continue even if the destination files exist.
 IGNORE_EXISTING = os.environ.get("IGNORE_EXISTING", "False").lower() in ("1", "true", "yes")
 
+# Number of rename / link operations to run at the same time. The operations are metadata
+# operations on network storage, and are limited by the latency, not the bandwidth.
+MAX_THREADS = int(os.environ.get("FILE_MOVER_THREADS", "16"))
+
+# Journal file name, in the analysis directory
+JOURNAL_NAME = 'FileMoverJournal.jsonl'
+
+# Moves between filesystems (e.g. to /boston/diag) are done by copying, using COPY_THREADS threads
+# to copy chunks of COPY_CHUNK_SIZE bytes in parallel. Progress is logged every COPY_PROGRESS_INTERVAL
+# seconds.
+COPY_THREADS = int(os.environ.get("FILE_MOVER_COPY_THREADS", "8"))
+COPY_CHUNK_SIZE = 16 * 1024 * 1024
+COPY_PROGRESS_INTERVAL = 60
+
 @dataclass
 class Project:
     name: str
@@ -158,6 +183,282 @@ class Sample:
         return f"Dragen{suffix}"
 
 
+@dataclass
+class Operation:
+    """A planned file system operation: 'move' (rename) or 'link' (hard link)"""
+    kind: str
+    src: Path
+    dest: Path
+
+
+class Journal:
+    """Append-only journal of the completed steps, and the planned and completed operations
+
+    Each entry is a line of JSON, written as soon as the step or operation is done. When the file
+    mover is run again, the journal is loaded, and the completed work is skipped. If path is None,
+    nothing is written (test mode).
+
+    A plan of operations of a kind is only used when it is complete: it starts with a 'plan' entry,
+    and ends with the step 'planned_<kind>'. An incomplete plan is replaced when planning again.
+
+    A move across filesystems is recorded as 'copied' when the copy is verified, before the source
+    is removed, so that the removal can be finished if the file mover is interrupted.
+    """
+
+    def __init__(self, path: Optional[Path]):
+        self.path = path
+        self.steps_done: Set[str] = set()
+        self.planned: Dict[str, List[Operation]] = {}
+        self.plans_started: Set[str] = set()
+        self.done: Set[tuple] = set()
+        self.copied: Set[tuple] = set()
+        self.resuming = False
+        self.file = None
+        self.lock = threading.Lock()
+        if path:
+            if path.exists():
+                self._load()
+            self.file = open(path, 'a')
+
+    @staticmethod
+    def _key(op: Operation) -> tuple:
+        return (op.kind, str(op.src), str(op.dest))
+
+    def _load(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # Partially written line, from a crash
+                self.resuming = True
+                if entry['event'] == 'step':
+                    self.steps_done.add(entry['step'])
+                elif entry['event'] == 'plan':
+                    self.planned[entry['kind']] = []
+                    self.plans_started.add(entry['kind'])
+                else:
+                    op = Operation(entry['kind'], Path(entry['src']), Path(entry['dest']))
+                    if entry['event'] == 'planned':
+                        self.planned.setdefault(op.kind, []).append(op)
+                    elif entry['event'] == 'copied':
+                        self.copied.add(self._key(op))
+                    else:
+                        self.done.add(self._key(op))
+
+    def _write(self, entry: dict):
+        with self.lock:
+            if self.file:
+                self.file.write(json.dumps(entry) + "\n")
+                self.file.flush()
+
+    def step_done(self, step: str):
+        self.steps_done.add(step)
+        self._write({'event': 'step', 'step': step})
+
+    def is_step_done(self, step: str) -> bool:
+        return step in self.steps_done
+
+    def start_plan(self, kind: str):
+        """Start planning the operations of a kind, replacing any incomplete plan."""
+        self.planned[kind] = []
+        self.plans_started.add(kind)
+        self._write({'event': 'plan', 'kind': kind})
+
+    def is_plan_started(self, kind: str) -> bool:
+        return kind in self.plans_started
+
+    def plan(self, kind: str, operations: List[Operation]):
+        """Record the operations of the plan started with start_plan, and mark it as complete."""
+        for op in operations:
+            self.planned[kind].append(op)
+            self._write({'event': 'planned', 'kind': op.kind, 'src': str(op.src), 'dest': str(op.dest)})
+        self.step_done('planned_' + kind)
+
+    def has_plan(self, kind: str) -> bool:
+        return self.is_step_done('planned_' + kind)
+
+    def remaining(self, kind: str) -> List[Operation]:
+        return [op for op in self.planned.get(kind, []) if not self.is_done(op)]
+
+    def complete(self, op: Operation):
+        self.done.add(self._key(op))
+        self._write({'event': 'done', 'kind': op.kind, 'src': str(op.src), 'dest': str(op.dest)})
+
+    def is_done(self, op: Operation) -> bool:
+        return self._key(op) in self.done
+
+    def copy_done(self, op: Operation):
+        """Record that the destination of a move across filesystems is a verified copy."""
+        self.copied.add(self._key(op))
+        self._write({'event': 'copied', 'kind': op.kind, 'src': str(op.src), 'dest': str(op.dest)})
+
+    def is_copied(self, op: Operation) -> bool:
+        return self._key(op) in self.copied
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+class CrossDeviceCopier:
+    """Moves files and directories to another filesystem, where rename is not possible
+
+    The files are copied in chunks by a pool of threads. The MD5 of each chunk is computed when it
+    is read from the source, and compared with the MD5 of the chunk read back from the destination
+    after it is synced to disk. The copy is made under a temporary name (.partial) and renamed
+    when it is complete, then the source is deleted. The copied callback is called when the copy
+    is verified, before the rename, so an interrupted move can be finished with finish_move.
+    """
+
+    def __init__(self, threads: int):
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.lock = threading.Lock()
+        self.bytes_copied = 0
+        self.start_time = None
+        self.last_report = 0
+
+    def move(self, src: Path, dest: Path, copied: Optional[Callable[[], None]] = None):
+        partial = self._partial_path(dest)
+        self._remove(partial) # From an interrupted run
+        start_time = time.time()
+        with self.lock:
+            if self.start_time is None:
+                self.start_time = self.last_report = start_time
+        size = self._copy(src, partial)
+        if copied:
+            copied()
+        self.finish_move(src, dest)
+        elapsed = max(time.time() - start_time, 0.001)
+        logger.info(f"Copied {src} -> {dest} across filesystems and removed the source: "
+                    f"{size / 1024**3:.2f} GB in {elapsed:.0f} s ({size / 1024**2 / elapsed:.0f} MB/s)")
+
+    def finish_move(self, src: Path, dest: Path):
+        """Rename the verified copy to dest, if not already done, and remove what is left of the
+        source."""
+
+        partial = self._partial_path(dest)
+        if not dest.exists() and (partial.exists() or partial.is_symlink()):
+            partial.rename(dest)
+        self._remove(src)
+
+    @staticmethod
+    def _partial_path(dest: Path) -> Path:
+        return dest.with_name(dest.name + '.partial')
+
+    @staticmethod
+    def _remove(path: Path):
+        if path.is_dir() and not path.is_symlink():
+            shutil.rmtree(path)
+        elif path.exists() or path.is_symlink():
+            path.unlink()
+
+    def _copy(self, src: Path, dest: Path) -> int:
+        """Copy a file, or a directory recursively. Returns the number of bytes copied."""
+
+        if src.is_symlink():
+            os.symlink(os.readlink(src), dest)
+            return 0
+        if src.is_dir():
+            dest.mkdir()
+            size = sum(self._copy(src / entry.name, dest / entry.name) for entry in os.scandir(src))
+            shutil.copystat(src, dest)
+            return size
+        return self._copy_file(src, dest)
+
+    def _copy_file(self, src: Path, dest: Path) -> int:
+        size = src.stat().st_size
+        offsets = range(0, size, COPY_CHUNK_SIZE)
+        with open(src, 'rb') as fsrc, open(dest, 'wb') as fdst:
+            os.ftruncate(fdst.fileno(), size)
+            digests = list(self.executor.map(
+                lambda offset: self._copy_chunk(fsrc.fileno(), fdst.fileno(), offset, size), offsets))
+            os.fsync(fdst.fileno())
+        with open(dest, 'rb') as fcheck:
+            if hasattr(os, 'posix_fadvise'):
+                # Read the data from the storage, not from the page cache
+                os.posix_fadvise(fcheck.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            check_digests = list(self.executor.map(
+                lambda offset: self._chunk_digest(fcheck.fileno(), offset, size), offsets))
+        if check_digests != digests:
+            raise OSError(errno.EIO, f"Checksum mismatch after copying {src} to {dest}")
+        shutil.copystat(src, dest)
+        return size
+
+    @staticmethod
+    def _read_chunk(fd: int, offset: int, size: int) -> bytes:
+        length = min(COPY_CHUNK_SIZE, size - offset)
+        data = os.pread(fd, length, offset)
+        if len(data) != length:
+            raise OSError(errno.EIO, f"Short read at offset {offset}")
+        return data
+
+    def _chunk_digest(self, fd: int, offset: int, size: int) -> bytes:
+        return hashlib.md5(self._read_chunk(fd, offset, size)).digest()
+
+    def _copy_chunk(self, fd_in: int, fd_out: int, offset: int, size: int) -> bytes:
+        data = self._read_chunk(fd_in, offset, size)
+        view = memoryview(data)
+        written = 0
+        while written < len(data):
+            written += os.pwrite(fd_out, view[written:], offset + written)
+        self._progress(len(data))
+        return hashlib.md5(data).digest()
+
+    def _progress(self, n_bytes: int):
+        with self.lock:
+            self.bytes_copied += n_bytes
+            now = time.time()
+            if now - self.last_report >= COPY_PROGRESS_INTERVAL:
+                self.last_report = now
+                logger.info(f"Cross-filesystem copy: {self.bytes_copied / 1024**3:.1f} GB copied "
+                            f"({self.bytes_copied / 1024**2 / (now - self.start_time):.0f} MB/s)")
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class DirectoryIndex:
+    """Answers existence checks from directory listings
+
+    Each directory is listed once with os.scandir, instead of a stat call per file, which is a
+    round trip on network filesystems. The listings must be updated with add() and remove() when
+    files are moved.
+    """
+
+    def __init__(self):
+        self.entries: Dict[Path, Set[str]] = {}
+        self.lookups = 0
+        self.scans = 0
+
+    def _listing(self, directory: Path) -> Set[str]:
+        if directory not in self.entries:
+            self.scans += 1
+            try:
+                with os.scandir(directory) as it:
+                    self.entries[directory] = {entry.name for entry in it}
+            except (FileNotFoundError, NotADirectoryError):
+                self.entries[directory] = set()
+        return self.entries[directory]
+
+    def exists(self, path: Path) -> bool:
+        self.lookups += 1
+        return path.name in self._listing(path.parent)
+
+    def add(self, path: Path):
+        if path.parent in self.entries:
+            self.entries[path.parent].add(path.name)
+
+    def remove(self, path: Path):
+        if path.parent in self.entries:
+            self.entries[path.parent].discard(path.name)
+
+    def log_stats(self):
+        logger.info(f"Existence checks: {self.lookups} lookups answered by {self.scans} directory scans "
+                    f"({self.lookups - self.scans} metadata operations saved)")
+
+
 class FileMover:
     """Main class that does the work of this script
     
@@ -199,7 +500,16 @@ class FileMover:
         self.projects: Dict[str, Project] = {}
         self.is_onboard = False
         self.compute_platform = None
-        # Group projects
+        # Existence checks for source and destination files
+        self.index = DirectoryIndex()
+        # Hard links planned by copy_demux_qc
+        self.link_operations: List[Operation] = []
+        # Planning the links again after an interrupted run (see copy_all_demux_qc)
+        self.replanning_links = False
+        # Set up by run()
+        self.journal = Journal(None)
+        # Moves which can't be done by rename
+        self.copier = CrossDeviceCopier(COPY_THREADS)
 
 
     def load_lims_file(self):
@@ -256,22 +566,23 @@ class FileMover:
         for s in self.samples:
             # Check fastq paths
             for src in self._original_fastq_paths(s):
-                if not src.exists():
+                if not self.index.exists(src):
                     missing.append(src)
             # Check sample-level analysis folders
             if self.is_onboard:
                 src_dir = self.analysis_dir / 'Data' / s.app_dir() / s.samplesheet_sample_id
-                if not src_dir.exists():
+                if not self.index.exists(src_dir):
                     missing.append(src_dir)
         # check destinations
         for s in self.samples:
             for name in self._dest_fastq_names(s):
                 dest = s.project.fastq_path / name
-                if dest.exists():
+                if self.index.exists(dest):
                     conflicts.append(dest)
         for p in self.projects.values():
-            if p.analysis_path.exists():
+            if self.index.exists(p.analysis_path):
                 conflicts.append(p.analysis_path)
+        self.index.log_stats()
         if missing and not IGNORE_MISSING:
             for m in missing: logger.error(f"Missing source: {m}")
             sys.exit(1)
@@ -291,31 +602,55 @@ class FileMover:
         logger.info("Directory structure created")
 
 
-    def move_sample_files(self):
-        """Move all fastq and analysis files related to all samples"""
+    def plan_sample_moves(self) -> List[Operation]:
+        """Get the moves of all fastq and analysis files related to all samples"""
 
+        operations = []
         moved_analysis_sampleids = set()
 
         for s in self.samples:
-            logger.info(f"Processing sample {s.sample_name}")
-            self._move_fastqs(s)
+            operations += self._plan_fastq_moves(s)
             if self.is_onboard:
                 # Onboard DRAGEN: Creates an analysis folder for each sample, even if only BCL Convert, it creates FastQC
                 if not s.project.is_mik(): # Analysis outputs not included for MIK, to simplify folder
                     if s.samplesheet_sample_id not in moved_analysis_sampleids:
-                        self._move_analysis(s)
+                        operations.append(self._plan_analysis_move(s))
                         moved_analysis_sampleids.add(s.samplesheet_sample_id)
-            
+        return operations
+
+
+    def move_sample_files(self):
+        """Move all fastq and analysis files related to all samples
+
+        All the moves are checked before any file is moved, then the moves are run in parallel."""
 
-    def _move_fastqs(self, s: Sample):
-        for from_path, to_name in zip(self._original_fastq_paths(s), self._dest_fastq_names(s)):
-            self._move(from_path, s.project.fastq_path / to_name)
+        if self.journal.has_plan('move'):
+            operations = [op for op in self.journal.remaining('move') if self._check_resumed_move(op)]
+            logger.info(f"Resuming: moving {len(operations)} remaining sample files and folders")
+        else:
+            self.journal.start_plan('move')
+            operations = self.plan_sample_moves()
+            logger.info(f"Moving {len(operations)} sample files and folders")
+            if TEST_MODE:
+                for op in operations:
+                    logger.info(f"[TEST] mv {op.src} -> {op.dest}")
+                return
+            operations = [op for op in operations if self._check_move(op)]
+            self.journal.plan('move', operations)
+        self.run_operations(operations)
 
 
-    def _move_analysis(self, s: Sample):
+    def _plan_fastq_moves(self, s: Sample) -> List[Operation]:
+        return [
+            Operation('move', from_path, s.project.fastq_path / to_name)
+            for from_path, to_name in zip(self._original_fastq_paths(s), self._dest_fastq_names(s))
+        ]
+
+
+    def _plan_analysis_move(self, s: Sample) -> Operation:
         src = self.analysis_dir / 'Data' / s.app_dir() / s.samplesheet_sample_id
         dest = s.project.analysis_path / s.new_sample_id()
-        self._move(src, dest)
+        return Operation('move', src, dest)
 
 
     def _original_fastq_names(self, s: Sample) -> List[str]:
@@ -395,6 +730,17 @@ class FileMover:
 
 
     def copy_all_demux_qc(self):
+        if self.journal.has_plan('link'):
+            # Interrupted while linking: the other files are already copied
+            operations = self.journal.remaining('link')
+            logger.info(f"Resuming: linking {len(operations)} remaining QC files")
+            self.run_operations(operations)
+            return
+
+        # If a previous run was interrupted while planning, the destination directories may
+        # already have been created by it. They are then planned again, instead of skipped.
+        self.replanning_links = self.journal.is_plan_started('link')
+        self.journal.start_plan('link')
         demux_qc_dest_projects = {} # De-duplicate the destination paths
         for project in self.projects.values():
             if project.is_mik():
@@ -403,6 +749,11 @@ class FileMover:
                 demux_qc_dest_projects[project.demux_qc_path] = project
         for project in demux_qc_dest_projects.values():
             self.copy_demux_qc(project)
+        # The hard links planned by copy_demux_qc are made in parallel
+        logger.info(f"Linking {len(self.link_operations)} QC files")
+        self.journal.plan('link', self.link_operations)
+        self.run_operations(self.link_operations)
+        self.link_operations = []
 
 
     def copy_demux_qc(self, p: Project):
@@ -417,19 +768,21 @@ class FileMover:
         demux_dst = p.demux_qc_path / 'Demux'
         if self.is_onboard:
             demux_src = self.analysis_dir / 'Data' / 'Demux'
-            if demux_src.exists() and not demux_dst.exists():
-                shutil.copytree(demux_src, demux_dst, copy_function=os.link)
+            if demux_src.exists() and (self.replanning_links or not demux_dst.exists()):
+                self._plan_link_tree(demux_src, demux_dst)
         else:
             # BCL Convert doesn't create a Demux dir, so we soft-link the files from Reports
-            (p.demux_qc_path / "Demux").mkdir()
-            (p.demux_qc_path / "Demux" / "Demultiplex_Stats.csv").symlink_to("../BCLConvert/fastq/Reports/Demultiplex_Stats.csv")
-            (p.demux_qc_path / "Demux" / "Top_Unknown_Barcodes.csv").symlink_to("../BCLConvert/fastq/Reports/Top_Unknown_Barcodes.csv")
+            (p.demux_qc_path / "Demux").mkdir(exist_ok=self.replanning_links)
+            for name in ["Demultiplex_Stats.csv", "Top_Unknown_Barcodes.csv"]:
+                link = p.demux_qc_path / "Demux" / name
+                if not (self.replanning_links and link.is_symlink()):
+                    link.symlink_to("../BCLConvert/fastq/Reports/" + name)
 
         # summary
         sum_src = self.analysis_dir / 'Data' / 'summary'
         sum_dst = p.demux_qc_path / 'summary'
-        if sum_src.exists() and not sum_dst.exists():
-            shutil.copytree(sum_src, sum_dst, copy_function=os.link)
+        if sum_src.exists() and (self.replanning_links or not sum_dst.exists()):
+            self._plan_link_tree(sum_src, sum_dst)
         # sample sheet
         ss_src = self.analysis_dir / 'Data' / 'SampleSheet.csv'
         ss_dst = p.demux_qc_path / 'SampleSheet.csv'
@@ -445,21 +798,35 @@ class FileMover:
         # for each app.
         for app_dir in project_app_dirs:
             demux_qc_destination = p.demux_qc_path / app_dir / fastq_dir
-            if not demux_qc_destination.exists(): # If exists, we assume it has the right info
+            # If exists, we assume it has the right info
+            if self.replanning_links or not demux_qc_destination.exists():
                 demux_qc_destination.mkdir(exist_ok=True, parents=True)
-                shutil.copytree(
+                self._plan_link_tree(
                     self.analysis_dir / "Data" / app_dir / fastq_dir / "Reports",
-                    demux_qc_destination / "Reports",
-                    copy_function=os.link
+                    demux_qc_destination / "Reports"
                 )
             if self.is_onboard:
-                shutil.copytree(
+                self._plan_link_tree(
                     self.analysis_dir / "Data" / app_dir / "AggregateReports",
-                    p.demux_qc_path / app_dir / "AggregateReports",
-                    copy_function=os.link
+                    p.demux_qc_path / app_dir / "AggregateReports"
                 )
 
 
+    def _plan_link_tree(self, src: Path, dest: Path):
+        """Create the directory structure of src at dest, and plan hard links for the files.
+
+        Equivalent to shutil.copytree(src, dest, copy_function=os.link, dirs_exist_ok=True), when
+        the links are run."""
+
+        dest.mkdir(parents=True, exist_ok=True)
+        for dirpath, dirnames, filenames in os.walk(src):
+            rel_dir = Path(dirpath).relative_to(src)
+            for dirname in dirnames:
+                (dest / rel_dir / dirname).mkdir(exist_ok=True)
+            for filename in filenames:
+                self.link_operations.append(Operation('link', Path(dirpath) / filename, dest / rel_dir / filename))
+
+
     def _filter_file(self, source_path: Path, dest_path: Path, project: Project):
         sample_ids = set(sample.samplesheet_sample_id for sample in self.samples if sample.project == project)
         with open(source_path) as source:
@@ -508,35 +875,120 @@ class FileMover:
         self._filter_file(qual_src, qual_dst, p)
 
 
-    def _move(self, src: Path, dest: Path):
-        if TEST_MODE:
-            logger.info(f"[TEST] mv {src} -> {dest}")
-            return
-        if not src.exists():
-            msg = f"Missing source: {src}"
+    def _check_move(self, op: Operation) -> bool:
+        """Check the source and destination of a move. Returns False if the move should be skipped
+        (IGNORE_MISSING / IGNORE_EXISTING), and exits on errors."""
+
+        if not self.index.exists(op.src):
+            msg = f"Missing source: {op.src}"
             if IGNORE_MISSING:
                 logger.warning(msg + " (skipped)")
-                return
+                return False
             logger.error(msg)
             sys.exit(1)
-        if dest.exists():
-            msg = f"Destination exists: {dest}"
+        if self.index.exists(op.dest):
+            msg = f"Destination exists: {op.dest}"
             if IGNORE_EXISTING:
                 logger.warning(msg + " (skipped)")
-                return
+                return False
             logger.error(msg)
             sys.exit(1)
-        src.rename(dest)
-        logger.info(f"Moved {src} -> {dest}")
+        return True
+
+
+    def _check_resumed_move(self, op: Operation) -> bool:
+        """Check a move from the journal. It may have been done without being recorded, if the
+        file mover was interrupted. If the copy to another filesystem was completed, only the
+        rename and the removal of the source are finished."""
+
+        if self.journal.is_copied(op):
+            try:
+                self.copier.finish_move(op.src, op.dest)
+            except OSError as e:
+                logger.error(f"Failed to finish the move {op.src} -> {op.dest}: {e}")
+                sys.exit(1)
+            logger.info(f"Finished interrupted move: {op.src} -> {op.dest}")
+            self.journal.complete(op)
+            self.index.remove(op.src)
+            self.index.add(op.dest)
+            return False
+        if not self.index.exists(op.src) and self.index.exists(op.dest):
+            logger.info(f"Already moved: {op.src} -> {op.dest}")
+            self.journal.complete(op)
+            return False
+        return self._check_move(op)
+
+
+    def _execute(self, op: Operation):
+        if op.kind == 'move':
+            try:
+                op.src.rename(op.dest)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                self.copier.move(op.src, op.dest, lambda: self.journal.copy_done(op))
+        else:
+            try:
+                os.link(op.src, op.dest)
+            except FileExistsError:
+                # Linked by an interrupted run
+                if not os.path.samefile(op.src, op.dest):
+                    raise
+
+
+    def run_operations(self, operations: List[Operation]):
+        """Run the operations using up to MAX_THREADS threads. Stops at the first error: the
+        operations which have not started are cancelled, and the script exits."""
+
+        failed = False
+        with ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
+            futures = {executor.submit(self._execute, op): op for op in operations}
+            for future in as_completed(futures):
+                op = futures[future]
+                if future.cancelled():
+                    continue
+                try:
+                    future.result()
+                except OSError as e:
+                    logger.error(f"Failed to {op.kind} {op.src} -> {op.dest}: {e}")
+                    if not failed:
+                        failed = True
+                        for other in futures:
+                            other.cancel()
+                    continue
+                self.journal.complete(op)
+                if op.kind == 'move':
+                    self.index.remove(op.src)
+                    self.index.add(op.dest)
+                    logger.info(f"Moved {op.src} -> {op.dest}")
+        if failed:
+            sys.exit(1)
 
 
     def run(self):
         self.load_lims_file()
-        self.check_sources_and_destinations()
-        self.prepare_directories()
-        self.link_sav_files()
-        self.copy_all_demux_qc()
-        self.move_sample_files()
+        self.journal = Journal(None if TEST_MODE else self.analysis_dir / JOURNAL_NAME)
+        try:
+            if self.journal.is_step_done('complete'):
+                logger.info(f"The journal {self.journal.path} shows that the files are already moved")
+                return
+            if self.journal.resuming:
+                logger.info(f"Resuming from journal {self.journal.path}: {len(self.journal.done)} "
+                            f"operations were completed")
+            if not self.journal.is_step_done('check'):
+                self.check_sources_and_destinations()
+                self.journal.step_done('check')
+            self.prepare_directories()
+            self.link_sav_files()
+            if not self.journal.is_step_done('copy_demux_qc'):
+                self.copy_all_demux_qc()
+                self.journal.step_done('copy_demux_qc')
+            self.move_sample_files()
+            self.journal.step_done('complete')
+        finally:
+            self.journal.close()
+            self.copier.close()
+        self.index.log_stats()
 
 
 def main():
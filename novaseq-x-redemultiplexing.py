@@ -2,6 +2,13 @@
 # It is called on the "Generate BCL Convert Samplesheet" step, and receives the process ID
 # of this step as an argument.
 
+# The script runs in two phases. The submit phase (called from LIMS) writes the sample sheet,
+# submits the demultiplexing job to Slurm, records the job ID on the BCL Convert step and exits.
+# It also submits the import phase as a Slurm job, which starts when the demultiplexing job has
+# finished (successfully or not). The import phase checks the result and imports the
+# demultiplexing stats into LIMS. It can be run again by hand if it fails:
+#   novaseq-x-redemultiplexing.py --import <process_id> <logfile_name> [dev]
+
 
 import os
 import sys
@@ -18,13 +25,26 @@ from collections import defaultdict
 from genologics.lims import *
 from genologics import config
 
+import novaseq_x_projects
+
 
 RUN_FOLDER_LOCATION = "/data/runScratch.boston/NovaSeqX"
 CPU_BCL_CONVERT_CONTAINER_IMAGE = "/data/common/tools/bclconvert/bclconvert-4.3.6.sif"
 
-def main(process_id):
-    
-    lims = Lims(config.BASEURI, config.USERNAME, config.PASSWORD)
+# The demultiplexing job writes the exit code of BCL Convert / DRAGEN to this file in the
+# BCLConvert folder. It is missing if the job was cancelled or timed out.
+EXIT_CODE_FILE_NAME = "exit_code.txt"
+IMPORT_JOB_TIME_LIMIT = "02:00:00"
+# The import job runs on a compute node, with the site Python command and the deployed copy of
+# this script on shared storage (not the interpreter and checkout used by LIMS). The node also
+# needs the genologics configuration of the LIMS user, and network access to LIMS.
+IMPORT_PYTHON_COMMAND = "nsc-python3"
+IMPORT_SCRIPT_PATH = Path("/data/runScratch.boston/scripts/pipeline/novaseq-x-redemultiplexing.py")
+
+
+def get_processes(lims, process_id):
+    """Get the sample sheet process (process_id) and the BCL Convert process."""
+
     samplesheet_process = Process(lims, id=process_id)
     samplesheet_process.get() # Fail here if the process does not exist
 
@@ -35,6 +55,27 @@ def main(process_id):
         sys.exit(1)
     bcl_convert_process = Process(lims, id=bcl_convert_process_id)
     bcl_convert_process.get()
+    return samplesheet_process, bcl_convert_process
+
+
+def get_output_folders(analysis_path, data_compression_type):
+    """Get the BCLConvert folder and the BCL Convert output folder."""
+
+    output_folder_parent = analysis_path / "Data" / "BCLConvert"
+    if data_compression_type == "dragen":
+        output_folder = output_folder_parent / "ora_fastq"
+    else:
+        output_folder = output_folder_parent / "fastq"
+    return output_folder_parent, output_folder
+
+
+def main(process_id, dev_env=False):
+    """Submit phase: check the parameters, write the sample sheet and submit the demultiplexing
+    and import jobs."""
+
+    lims = Lims(config.BASEURI, config.USERNAME, config.PASSWORD)
+    samplesheet_process, bcl_convert_process = get_processes(lims, process_id)
+    bcl_convert_process_id = bcl_convert_process.id
 
 
     # The Run ID may be available on an earlier instance of the BCL Convert step,
@@ -55,6 +96,9 @@ def main(process_id):
     if not compute_type in ['External DRAGEN', 'CPU']:
         print(f"Unsupported compute type '{compute_type}' for off-board redemultiplexing")
         sys.exit(1)
+    if not IMPORT_SCRIPT_PATH.is_file():
+        print(f"The script for the import job, {IMPORT_SCRIPT_PATH}, was not found on shared storage")
+        sys.exit(1)
     bcl_convert_process.udf["Compute platform"] = compute_type
     bcl_convert_process.udf["Run ID"] = run_id
     run_folder_udf = bcl_convert_process.udf.get('Sequencing Output Folder')
@@ -88,11 +132,7 @@ def main(process_id):
         sys.exit(1)
 
     # Get output path. BCL Convert will crash if it exists, so we check this.
-    output_folder_parent = analysis_path / "Data" / "BCLConvert"
-    if data_compression_type == "dragen":
-        output_folder = output_folder_parent / "ora_fastq"
-    else:
-        output_folder = output_folder_parent / "fastq"
+    output_folder_parent, output_folder = get_output_folders(analysis_path, data_compression_type)
     if output_folder.exists():
         print(f"Error: output folder {output_folder} already exists.")
         sys.exit(1)
@@ -120,16 +160,55 @@ def main(process_id):
 
     extra_options = samplesheet_process.udf.get("BCL Convert / DRAGEN command line options", "")
 
-    # Create demultiplexing script file and run demultiplexing
+    # Create demultiplexing script file and submit the demultiplexing and import jobs
     job_name = f"{analysis_id}.{run_id}"
+    (output_folder_parent / EXIT_CODE_FILE_NAME).unlink(missing_ok=True) # From a previous attempt
+    try:
+        if compute_type == "External DRAGEN":
+            job_id = run_demultiplexing_dragen(job_name, run_folder_path, samplesheet_path, output_folder_parent, output_folder, extra_options)
+        else:
+            job_id = run_demultiplexing_cpu(job_name, run_folder_path, samplesheet_path, output_folder_parent, output_folder, extra_options)
+    except subprocess.CalledProcessError as e:
+        print("ERROR: Failed to submit the demultiplexing job:", e.stderr)
+        bcl_convert_process.udf['Status'] = "FAILED"
+        bcl_convert_process.put()
+        sys.exit(1)
+    bcl_convert_process.udf['Slurm job ID'] = job_id
     bcl_convert_process.udf['Status'] = "RUNNING"
     bcl_convert_process.put()
-    print("RUNNING", job_name)
-    if compute_type == "External DRAGEN":
-        returncode = run_demultiplexing_dragen(job_name, run_folder_path, samplesheet_path, output_folder_parent, output_folder, extra_options)
-    else:
-        returncode = run_demultiplexing_cpu(job_name, run_folder_path, samplesheet_path, output_folder_parent, output_folder, extra_options)
+    print("RUNNING", job_name, "as Slurm job", job_id)
 
+    try:
+        submit_import_job(job_name, process_id, output_folder_parent, job_id, dev_env)
+    except subprocess.CalledProcessError as e:
+        print("ERROR: Failed to submit the import job:", e.stderr)
+        print(f"Run the import by hand when job {job_id} has finished: {sys.argv[0]} --import {process_id} <logfile_name>")
+        sys.exit(1)
+
+
+def import_demultiplexing_results(process_id):
+    """Import phase: check the result of the demultiplexing job, and import the results into
+    LIMS and the yaml file for the file mover. All the updates are overwritten if it is
+    run again."""
+
+    lims = Lims(config.BASEURI, config.USERNAME, config.PASSWORD)
+    samplesheet_process, bcl_convert_process = get_processes(lims, process_id)
+    bcl_convert_process_id = bcl_convert_process.id
+
+    # The parameters were saved on the BCL Convert step by the submit phase
+    compute_type = bcl_convert_process.udf["Compute platform"]
+    run_folder_path = Path(bcl_convert_process.udf['Sequencing Output Folder'])
+    analysis_path = run_folder_path / "Analysis" / bcl_convert_process.udf['Analysis ID']
+    data_compression_type = samplesheet_process.udf['FASTQ Compression Format']
+    output_folder_parent, output_folder = get_output_folders(analysis_path, data_compression_type)
+
+    try:
+        returncode = int((output_folder_parent / EXIT_CODE_FILE_NAME).read_text())
+    except (OSError, ValueError):
+        print("ERROR: The BCL Conversion job did not finish (no exit code). It may have been cancelled or timed out.")
+        bcl_convert_process.udf['Status'] = "FAILED"
+        bcl_convert_process.put()
+        sys.exit(1)
     if returncode != 0:
         print("ERROR: BCL Conversion returned non-zero exit code", returncode, ".")
         bcl_convert_process.udf['Status'] = "FAILED"
@@ -141,7 +220,6 @@ def main(process_id):
         bcl_convert_process.put()
         sys.exit(1)
 
-
     # Import BCL convert / DRAGEN version and run ID
     bcl_convert_version = get_bclconvert_version(output_folder)
 
@@ -153,9 +231,10 @@ def main(process_id):
     for lane_sample_info in demultiplexed_lane_sample_info:
         lane_sample_info['ora_compression'] = (data_compression_type == "dragen")
 
-    # Determine file names / S number
+    # Determine file names / S number. Each project folder is listed once.
+    fastq_indexes = {}
     for lane_sample_info in demultiplexed_lane_sample_info:
-        lane_sample_info['samplesheet_position'] = lookup_sample_s_number(output_folder, lane_sample_info)
+        lane_sample_info['samplesheet_position'] = lookup_sample_s_number(output_folder, lane_sample_info, fastq_indexes)
     
     # Save the demultiplexing results and QC to LIMS, and put the artifact IDs in the sample info list.
     exchange_output_artifact_info(lims, bcl_convert_process, demultiplexed_lane_sample_info)
@@ -214,6 +293,49 @@ def get_analysis_id_and_path(bcl_convert_process, run_folder_path, compute_type)
     return analysis_id, analysis_path
 
 
+def submit_job(script_path, cwd, after_job_id=None):
+    """Submit a job script to Slurm without waiting for it. Returns the job ID.
+
+    If after_job_id is given, the job starts when that job has ended, whatever its result."""
+
+    args = ['sbatch', '--parsable']
+    if after_job_id:
+        args.append(f'--dependency=afterany:{after_job_id}')
+    result = subprocess.run(
+            args + [str(script_path)],
+            cwd=cwd, capture_output=True, text=True, check=True
+    )
+    # The output is "<job_id>" or "<job_id>;<cluster>"
+    return result.stdout.strip().split(";")[0]
+
+
+def exit_code_commands(output_folder_parent):
+    """Shell commands for the end of the demultiplexing job script, to save the exit code for the
+    import phase."""
+
+    return f"""status=$?
+echo $status > {output_folder_parent / EXIT_CODE_FILE_NAME}
+exit $status
+"""
+
+
+def submit_import_job(job_name, process_id, output_folder_parent, demultiplexing_job_id, dev_env):
+    """Submit the import phase of this script, to run when the demultiplexing job has ended."""
+
+    dev_arg = " dev" if dev_env else ""
+    script_content = f"""#!/bin/bash
+#SBATCH --job-name={job_name}.import
+#SBATCH --time={IMPORT_JOB_TIME_LIMIT}
+#SBATCH --output={output_folder_parent}/import-%j.out
+
+{IMPORT_PYTHON_COMMAND} {IMPORT_SCRIPT_PATH} --import {process_id} {output_folder_parent / "import.log"}{dev_arg}
+"""
+    script_path = output_folder_parent / "import.sh"
+    with open(script_path, "w") as script_file:
+        script_file.write(script_content)
+    return submit_job(script_path, output_folder_parent, after_job_id=demultiplexing_job_id)
+
+
 def run_demultiplexing_dragen(job_name, run_folder_path, samplesheet_path, output_folder_parent, output_folder, extra_options):
     script_content = f"""#!/bin/bash
 #SBATCH --job-name={job_name}
@@ -227,15 +349,11 @@ def run_demultiplexing_dragen(job_name, run_folder_path, samplesheet_path, outpu
         --output-directory {output_folder} \\
         --bcl-sampleproject-subdirectories true \\
         --sample-sheet {samplesheet_path} {extra_options}
-"""
+{exit_code_commands(output_folder_parent)}"""
     script_path = output_folder_parent / "script.sh"
     with open(script_path, "w") as script_file:
         script_file.write(script_content)
-    result = subprocess.run(
-            ['sbatch', '--wait', script_path],
-            cwd=output_folder_parent
-    )
-    return result.returncode
+    return submit_job(script_path, output_folder_parent)
 
 
 def run_demultiplexing_cpu(job_name, run_folder_path, samplesheet_path, output_folder_parent, output_folder, extra_options):
@@ -258,37 +376,64 @@ apptainer exec \\
         --output-directory {output_folder} \\
         --bcl-sampleproject-subdirectories true \\
         --sample-sheet {samplesheet_path} {extra_options}
-"""
+{exit_code_commands(output_folder_parent)}"""
     script_path = output_folder_parent / "script.sh"
     with open(script_path, "w") as script_file:
         script_file.write(script_content)
-    result = subprocess.run(
-            ['sbatch', '--wait', script_path],
-            cwd=output_folder_parent
-    )
-    return result.returncode
+    return submit_job(script_path, output_folder_parent)
+
+
+# R1 fastq file names written by BCL Convert: <sample_id>_S<n>_L<lane>_R1_001.fastq.<ora|gz>
+FASTQ_R1_NAME_RE = re.compile(r"^(.+)_S(\d+)_L(\d{3})_R1_001\.fastq\.(ora|gz)$")
 
 
-def lookup_sample_s_number(output_folder, lane_sample_info):
+def index_fastq_s_numbers(search_path):
+    """List the R1 fastq files in a project's output folder, with a single directory scan.
+
+    Returns a dict of (sample_id, lane, compression extension) -> list of S-numbers. The dict
+    is empty if the folder does not exist."""
+
+    fastq_index = defaultdict(list)
+    try:
+        entries = list(os.scandir(search_path))
+    except FileNotFoundError:
+        return fastq_index
+    for entry in entries:
+        m = FASTQ_R1_NAME_RE.match(entry.name)
+        if m:
+            fastq_index[(m.group(1), int(m.group(3)), m.group(4))].append(int(m.group(2)))
+    return fastq_index
+
+
+def lookup_sample_s_number(output_folder, lane_sample_info, fastq_indexes=None):
+    """Get the S-number of a sample from the name of its fastq file.
+
+    fastq_indexes is a dict of project name -> result of index_fastq_s_numbers, which is filled
+    in as needed. Pass the same dict for all the samples, so each project folder is scanned once."""
+
     # Edvardsen-gDNA12-2024-11-19/1-RBE-1_S104_L003_R1_001.fastq.gz
     if lane_sample_info['samplesheet_sample_id'] == "Undetermined":
         # BCL Convert doesn't allow any normal sample to be called "Undetermined"
         # and the lookup below doesn't work for undetermined. S0 is always correct.
         return 0
+    if fastq_indexes is None:
+        fastq_indexes = {}
+    extension = "ora" if lane_sample_info['ora_compression'] else "gz"
     fastq_pattern = \
                 lane_sample_info['samplesheet_sample_id'] +\
-                f"_S*_L{lane_sample_info['lane']:03}_R1_001.fastq." +\
-                ("ora" if lane_sample_info['ora_compression'] else "gz")
+                f"_S*_L{lane_sample_info['lane']:03}_R1_001.fastq." + extension
     search_path = (output_folder / lane_sample_info['project_name'])
-    fastq_glob = list(search_path.glob(fastq_pattern))
-    if len(fastq_glob) == 1:
-        m = re.search(r"_S(\d+)_L\d+_R1_001.fastq.(ora|gz)$", fastq_glob[0].name)
-        if m:
-            return int(m.group(1))
-        else:
-            raise RuntimeError(f"Found a fastq path {fastq_glob[0]} but can't extract S-number.")
+    fastq_index = fastq_indexes.get(lane_sample_info['project_name'])
+    if fastq_index is None:
+        fastq_index = index_fastq_s_numbers(search_path)
+        fastq_indexes[lane_sample_info['project_name']] = fastq_index
+    s_numbers = fastq_index.get(
+            (lane_sample_info['samplesheet_sample_id'], lane_sample_info['lane'], extension), []
+            )
+    if len(s_numbers) == 1:
+        return s_numbers[0]
     else:
-        raise RuntimeError(f"Found {len(fastq_glob)} matches for {fastq_pattern} inside {search_path}, expected one match")
+        raise RuntimeError(f"Found {len(s_numbers)} matches for {fastq_pattern} inside {search_path}, expected one match")
 
 
 def parse_demultiplexing_stats(output_folder):
@@ -304,26 +449,21 @@ def parse_demultiplexing_stats(output_folder):
     for demultiplex_stats_row in demultiplex_stats:
         lane_total_read_count[demultiplex_stats_row['Lane']] += float(demultiplex_stats_row['# Reads'])
 
-    # Determine a list of unique lane, sample_id, sample_project. They are not unique in case
+    # Group the rows by unique lane, sample_id, sample_project. They are not unique in case
     # a sample has multiple different indexes, like some 10x libraries using a mix of 4 indexes.
-    # The data are always merged by BCL Convert, so the following list corresponds to the list of
+    # The data are always merged by BCL Convert, so the groups correspond to the list of
     # output files. (This is an unusual edge case messing up our simple code)
-    dedup_lane_sample_project = list(dict.fromkeys(
-        (row['Lane'], row['SampleID'], row['Sample_Project'])
-        for row in demultiplex_stats
-    ))
-
-    for lane, sampleid, project in dedup_lane_sample_project:
-        demultiplex_stats_rows = [row for row in demultiplex_stats
-                if row['Lane'] == lane and
-                row['SampleID'] == sampleid and
-                row['Sample_Project'] == project
-        ]
-        quality_metrics_rows = [row for row in quality_metrics
-                if row['Lane'] == lane and
-                row['SampleID'] == sampleid and
-                row['Sample_Project'] == project
-        ]
+    # The rows are grouped in a single pass over each file, in the order of first appearance
+    # in Demultiplex_Stats.csv.
+    demultiplex_stats_groups = defaultdict(list)
+    for row in demultiplex_stats:
+        demultiplex_stats_groups[(row['Lane'], row['SampleID'], row['Sample_Project'])].append(row)
+    quality_metrics_groups = defaultdict(list)
+    for row in quality_metrics:
+        quality_metrics_groups[(row['Lane'], row['SampleID'], row['Sample_Project'])].append(row)
+
+    for (lane, sampleid, project), demultiplex_stats_rows in demultiplex_stats_groups.items():
+        quality_metrics_rows = quality_metrics_groups.get((lane, sampleid, project), [])
 
         # Sample S-number depends only on the unique sample ID. It is reused for samples from
         # different projects with the same name.
@@ -397,48 +537,43 @@ def add_project_info_from_lims(lims, demultiplexed_lane_sample_info):
     """Lookup project information based on project name and add this to the sample records.
     
     It uses the project name directly from the sample sheet, bypassing the artifact hierarchy,
-    so the project information can be corrected when re-demultiplexing if required."""
+    so the project information can be corrected when re-demultiplexing if required. The cached
+    project lookups are bypassed, so that corrections made in LIMS are always used."""
 
-    project_details_cache = {}
+    project_names = set(row['project_name'] for row in demultiplexed_lane_sample_info
+                        if row['project_name'] != "Undetermined")
+    project_details = novaseq_x_projects.get_project_details(lims, project_names, refresh=True)
     for lane_sample_info in demultiplexed_lane_sample_info:
         project_name = lane_sample_info['project_name']
         if project_name != "Undetermined":
-            if project_name in project_details_cache:
-                project_details = project_details_cache[project_name]
-            else:
-                projects = lims.get_projects(name=project_name)
-                if projects:
-                    # Just pick the last project if there are multiple projects with the same name. This shouldn't
-                    # happen for real samples.
-                    project = projects[-1]
-                    # This information will be added to the demultiplexed (lane, sample) entries
-                    project_details = {
-                        'delivery_method': project.udf.get('Delivery method'),
-                        'project_id': project.id,
-                        'project_name': project_name,
-                        # Note that the file mover will crash if the project type is unknown
-                        # (can then be fixed in the yaml file)
-                        'project_type': project.udf.get('Project type')
-                    }
-                else:
-                    project_details = {}
-                project_details_cache[project_name] = project_details
-            lane_sample_info.update(project_details)
+            lane_sample_info.update(project_details[project_name])
 
 
 def exchange_output_artifact_info(lims, bcl_convert_process, demultiplexed_lane_sample_info):
+    artifact_pairs = [
+        (iparam['uri'], oparam['uri'])
+        for iparam, oparam in bcl_convert_process.input_output_maps
+        if oparam is not None and oparam['output-generation-type'] == "PerReagentLabel"
+    ]
+    # Load all the artifacts and their samples with batch requests. Otherwise the properties
+    # accessed below would be loaded with one request per artifact and per sample.
+    lims.get_batch(list(set(artifact for pair in artifact_pairs for artifact in pair)))
+    lims.get_batch(list(set(o.samples[0] for i, o in artifact_pairs if o.samples)))
+
+    # Index the demultiplexing results by lane and sample ID. There may be multiple records
+    # with the same sample ID in different projects.
+    records_by_lane_sample = defaultdict(list)
+    for row in demultiplexed_lane_sample_info:
+        records_by_lane_sample[(row['lane'], row['samplesheet_sample_id'])].append(row)
+
     update_artifacts = set()
     # Lookup data for each output artifact
-    for iparam, oparam in bcl_convert_process.input_output_maps:
-        if oparam  == None or  oparam['output-generation-type'] != "PerReagentLabel": continue
-        o = oparam['uri']
-        i = iparam['uri']
+    for i, o in artifact_pairs:
         sample_id = o.udf.get("SampleSheet Sample_ID")
         if sample_id:
             artifact_lane = int(i.location[1].split(":")[0])
             # Lookup result for this sample by lane and sample ID
-            matching_records = [row for row in demultiplexed_lane_sample_info
-                    if row['lane'] == artifact_lane and row['samplesheet_sample_id'] == sample_id]
+            matching_records = records_by_lane_sample.get((artifact_lane, sample_id), [])
 
             if len(matching_records) > 1:
                 # We need to find the correct record based on project name. We only do this if there is an
@@ -499,7 +634,12 @@ def add_undetermined_percent_to_lims(lims, input_artifacts, demultiplexed_lane_s
 
 if __name__ == "__main__":
     try:
-        dev_env = len(sys.argv) > 3 and sys.argv[3] == "dev"
+        args = sys.argv[1:]
+        # The import phase is run by the Slurm job submitted by the submit phase
+        import_phase = args[:1] == ["--import"]
+        if import_phase:
+            args = args[1:]
+        dev_env = len(args) > 2 and args[2] == "dev"
         if dev_env:
             config.BASEURI = "https://dev-lims.sequencing.uio.no"
             config.PASSWORD = open("/data/runScratch.boston/scripts/etc/seq-user/dev-apiuser-password.txt").read().strip()
@@ -507,16 +647,19 @@ if __name__ == "__main__":
         # Identification of demultiplexing parameters. Errors in this section are fatal and will
         # cause an immediate error message in LIMS.
         try:
-            process_id = sys.argv[1]
-            logfile_name = sys.argv[2]
+            process_id = args[0]
+            logfile_name = args[1]
         except IndexError:
-            print("Usage: %s <process_id> <logfile_name>" % sys.argv[0])
+            print("Usage: %s [--import] <process_id> <logfile_name>" % sys.argv[0])
             print(" -- or --")
-            print("Usage: %s <process_id> <logfile_name> dev" % sys.argv[0])
+            print("Usage: %s [--import] <process_id> <logfile_name> dev" % sys.argv[0])
             sys.exit(1)
 
         logging.basicConfig(filename=logfile_name, filemode="w")
-        main(process_id)
+        if import_phase:
+            import_demultiplexing_results(process_id)
+        else:
+            main(process_id, dev_env)
     except Exception as e:
         logging.exception(e)
         raise
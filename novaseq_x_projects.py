@@ -0,0 +1,106 @@
+# Project lookups in LIMS for the NovaSeq X scripts
+
+# Gets the details of projects by name (project ID, type and delivery method). The distinct
+# names are looked up concurrently, by a bounded pool of threads. Each thread also loads
+# the project with its UDFs, as projects are not supported by the LIMS batch API.
+
+# The results are stored in a JSON file with a short time-to-live, so the scripts which
+# process the same run shortly after each other don't repeat the lookups. Projects which
+# are not found are not cached. The cache is only an optimisation, and errors reading or
+# writing it are ignored. Callers which must see changes made in LIMS since the last lookup
+# use refresh=True: the projects are then looked up again, and the cache is updated.
+
+import os
+import json
+import time
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+# Maximum number of concurrent requests to LIMS
+LOOKUP_THREADS = 8
+
+# Cached project details are used for this many seconds
+CACHE_TTL = 600
+
+DEFAULT_CACHE_PATH = Path(os.environ.get(
+    "NOVASEQX_PROJECT_CACHE",
+    Path(tempfile.gettempdir()) / "novaseq-x-project-cache.json"
+))
+
+
+def lookup_project(lims, project_name):
+    """Get the details of a single project from LIMS, or an empty dict if it doesn't exist."""
+
+    projects = lims.get_projects(name=project_name)
+    if not projects:
+        return {}
+    # Just pick the last project if there are multiple projects with the same name. This shouldn't
+    # happen for real samples.
+    project = projects[-1]
+    project.get()
+    return {
+        'delivery_method': project.udf.get('Delivery method'),
+        'project_id': project.id,
+        'project_name': project_name,
+        # Note that the file mover will crash if the project type is unknown
+        # (can then be fixed in the yaml file)
+        'project_type': project.udf.get('Project type')
+    }
+
+
+def load_cache(cache_path):
+    try:
+        with open(cache_path) as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def save_cache(cache_path, cache):
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(cache, cache_file)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def get_project_details(lims, project_names, cache_path=DEFAULT_CACHE_PATH, ttl=CACHE_TTL,
+                        threads=LOOKUP_THREADS, refresh=False):
+    """Get the details of the projects with the given names.
+
+    Returns a dict of project name -> details dict, with keys delivery_method, project_id,
+    project_name and project_type. The details are an empty dict for projects which are not
+    found. Set cache_path to None to disable the on-disk cache, or refresh to True to ignore
+    the cached entries (the cache is still updated with the results)."""
+
+    project_names = list(dict.fromkeys(project_names))
+    now = time.time()
+    cache = load_cache(cache_path) if cache_path else {}
+    # Cache entries are specific to the LIMS server (production or dev)
+    key_prefix = lims.baseuri + " "
+    # Drop expired entries, so the cache doesn't grow
+    cache = {k: v for k, v in cache.items() if isinstance(v, dict) and now - v.get('time', 0) < ttl}
+
+    result = {}
+    for name in project_names:
+        entry = None if refresh else cache.get(key_prefix + name)
+        if entry:
+            result[name] = entry['details']
+
+    missing = [name for name in project_names if name not in result]
+    if missing:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for name, details in zip(missing, executor.map(lambda n: lookup_project(lims, n), missing)):
+                result[name] = details
+                if details:
+                    cache[key_prefix + name] = {'time': now, 'details': details}
+        if cache_path:
+            save_cache(cache_path, cache)
+    return result
@@ -46,10 +46,6 @@ else
 	nsc-python3 $DIR/30_demultiplexing.py $THREADS "$EXTRA_OPTIONS" $LANES "$SOURCE" "$DEST"
 fi
 nsc-python3 $DIR/40_move_results.py $LANES "$DEST"
-nsc-python3 $DIR/50_qc_analysis.py $THREADS $LANES "$DEST"
-nsc-python3 $DIR/60_emails.py $LANES "$DEST"
-nsc-python3 $DIR/60_reports.py $LANES "$DEST"
-nsc-python3 $DIR/80_md5sum.py $THREADS $LANES "$DEST"
-nsc-python3 $DIR/70_multiqc.py $THREADS $LANES "$DEST"
-nsc-python3 $DIR/90_prepare_delivery.py $LANES "$DEST"
+nsc-python3 $DIR/run-stages.py 50_qc_analysis.py 60_emails.py 60_reports.py 80_md5sum.py \
+	70_multiqc.py 90_prepare_delivery.py -- $THREADS $LANES "$DEST"
 
@@ -0,0 +1,36 @@
+# Run task scripts, concurrently where possible
+
+# The scripts are started as soon as the scripts producing their inputs have
+# completed; see common/stages.py for the declared inputs and outputs. The
+# arguments after "--" are given to all the scripts (--threads is only given
+# to the scripts which accept it).
+
+# With --in-process, the scripts are instead run one after the other in this
+# Python process, with a shared LIMS session and run model.
+
+# Use:
+# nsc-python3 run-stages.py [--in-process] SCRIPT [SCRIPT ...] -- [OPTIONS] [WORK_DIR]
+
+import sys
+from common import stages
+
+if __name__ == "__main__":
+    if "--" not in sys.argv[1:]:
+        print("Use: run-stages.py [--in-process] SCRIPT [SCRIPT ...] -- [OPTIONS] [WORK_DIR]")
+        sys.exit(1)
+    separator = sys.argv.index("--")
+    scripts = sys.argv[1:separator]
+    args = sys.argv[separator+1:]
+    in_process = "--in-process" in scripts
+    scripts = [script for script in scripts if script != "--in-process"]
+    if in_process:
+        failed = stages.run_in_process(scripts, args)
+    else:
+        pid = None
+        for arg in args:
+            if arg.startswith("--pid="):
+                pid = arg[len("--pid="):]
+        failed = stages.run_stages(scripts, args, pid=pid)
+    if failed:
+        print("ERROR  [Stage runner] Failed: " + ", ".join(failed), file=sys.stderr)
+        sys.exit(1)
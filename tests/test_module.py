@@ -12,6 +12,8 @@ import string
 import random
 import shutil
 import glob
+import hashlib
+import tarfile
 from contextlib import contextmanager
 sys.path.append('..')
 
@@ -195,6 +197,32 @@ class TestTaskFramework(unittest.TestCase):
                 self.assertIsNotNone(task.process)
 
 
+    def test_status_file(self):
+        """With --status-file the status is written to the file, not to LIMS."""
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            status_path = os.path.join(tempdir, "status.json")
+            with patch.object(nsc, 'get_lims'), patch.object(Process, 'put') as put:
+                task = taskmgr.Task("TEST_NAME", "TEST_DESCRIPTION", ["work_dir", "lanes"])
+                task.exit_on_finish = False
+                testargs = ["script", "--pid=TEST_ID", "--status-file=" + status_path]
+                with patch.object(sys, 'argv', testargs):
+                    task.__enter__()
+                    task.running()
+                    task.info("Test")
+                    with open(status_path) as f:
+                        self.assertEqual(json.load(f)[nsc.JOB_STATUS_UDF], "Running (Test)")
+                    task.success_finish()
+                put.assert_not_called()
+            with open(status_path) as f:
+                status = json.load(f)
+            self.assertEqual(status[nsc.JOB_STATE_CODE_UDF], 'COMPLETED')
+            self.assertEqual(status[nsc.CURRENT_JOB_UDF], "TEST_NAME")
+        finally:
+            shutil.rmtree(tempdir)
+
+
     def test_sample_sheet_parsing_no_index(self):
         with open("files/samples/no-index.json") as jsonfile:
             correct_projects = json.load(jsonfile)
@@ -278,6 +306,582 @@ class TestTaskFramework(unittest.TestCase):
             task.running()
             self.assertEqual(projects_to_dicts(task.projects), correct_projects)
 
+    def test_run_model_snapshot(self):
+        """The project tree is saved once, reused by the next task, and rebuilt
+        when the FASTQ lane layout or the sample sheet changes."""
+
+        run_model_module = taskmgr.run_model
+
+        with open("files/samples/hi4000.json") as jsonfile:
+            correct_projects = json.load(jsonfile)
+        RUN_ID = "180502_E00401_0001_BQCTEST"
+        tempparent = tempfile.mkdtemp()
+        try:
+            run_dir = os.path.join(tempparent, RUN_ID)
+            shutil.copytree(os.path.join("files/runs", RUN_ID), run_dir)
+            snapshot_path = os.path.join(run_dir, "DemultiplexLogs", "run_model.json")
+            if os.path.exists(snapshot_path):
+                os.remove(snapshot_path)
+            with patch.object(sys, 'argv', ["script", run_dir]):
+                task = taskmgr.Task("SnapshotWrite", "TEST_DESCRIPTION", ["work_dir", "sample_sheet"])
+                task.__enter__()
+                task.running()
+                self.assertEqual(projects_to_dicts(task.projects), correct_projects)
+                self.assertTrue(os.path.isfile(snapshot_path))
+
+                task = taskmgr.Task("SnapshotRead", "TEST_DESCRIPTION", ["work_dir", "sample_sheet"])
+                task.__enter__()
+                task.running()
+                with patch.object(samples, 'get_projects') as get_projects:
+                    self.assertEqual(projects_to_dicts(task.projects), correct_projects)
+                    get_projects.assert_not_called()
+
+                # Demultiplexed again with another lane layout
+                open(os.path.join(run_dir, "Data", "Intensities", "BaseCalls",
+                    "Undetermined_S0_L004_R1_001.fastq.gz"), "w").close()
+                task = taskmgr.Task("SnapshotLayout", "TEST_DESCRIPTION", ["work_dir", "sample_sheet"])
+                with patch.object(run_model_module, 'build', wraps=run_model_module.build) as build:
+                    task.__enter__()
+                    task.running()
+                    self.assertEqual(projects_to_dicts(task.projects), correct_projects)
+                    build.assert_called_once()
+
+                with open(os.path.join(run_dir, "DemultiplexingSampleSheet.csv"), "a") as f:
+                    f.write("\n")
+                task = taskmgr.Task("SnapshotInvalid", "TEST_DESCRIPTION", ["work_dir", "sample_sheet"])
+                task.__enter__()
+                task.running()
+                with patch.object(samples, 'get_projects', return_value=[]) as get_projects:
+                    self.assertEqual(task.projects, [])
+                    get_projects.assert_called_once()
+        finally:
+            shutil.rmtree(tempparent)
+
+class TestStats(unittest.TestCase):
+
+    def setUp(self):
+        warnings.simplefilter("ignore", ResourceWarning)
+
+    def test_stats_index_reused(self):
+        """Stats.json is parsed once, and again only when it changes."""
+
+        from common import stats
+        RUN_ID = "180502_E00401_0001_BQCTEST"
+        tempparent = tempfile.mkdtemp()
+        try:
+            run_dir = os.path.join(tempparent, RUN_ID)
+            shutil.copytree(os.path.join("files/runs", RUN_ID), run_dir)
+            stats._stats_index_cache.clear()
+            reference = stats.get_stats(None, run_dir, aggregate_lanes=False, aggregate_reads=False)
+            self.assertTrue(os.path.isfile(stats.get_stats_index_path(run_dir)))
+
+            stats._stats_index_cache.clear() # Force loading the index from the file
+            with patch.object(stats, 'build_stats_index') as build_stats_index:
+                for aggregate_lanes in [True, False]:
+                    for aggregate_reads in [True, False]:
+                        stats.get_stats(None, run_dir, aggregate_lanes, aggregate_reads)
+                build_stats_index.assert_not_called()
+            self.assertEqual(stats.get_stats(None, run_dir, False, False), reference)
+
+            stats_path = stats.get_stats_path(run_dir)
+            os.utime(stats_path, (0, 0))
+            with patch.object(stats, 'build_stats_index', wraps=stats.build_stats_index) as build_stats_index:
+                self.assertEqual(stats.get_stats(None, run_dir, False, False), reference)
+                build_stats_index.assert_called_once_with(stats_path)
+        finally:
+            stats._stats_index_cache.clear()
+            shutil.rmtree(tempparent)
+
+    def test_stats_index_streaming(self):
+        """The incremental reader gives the same index for any read size."""
+
+        from common import stats
+        import io
+        stream = stats.JsonStream(io.StringIO('{"a": [1, 12345, {"b": "x y"}], "c": {}, "d": []}'), chunk_size=2)
+        keys = []
+        for key in stream.iter_object():
+            keys.append(key)
+            if key == 'a':
+                self.assertEqual([stream.read_value() for _ in stream.iter_array()], [1, 12345, {"b": "x y"}])
+            else:
+                stream.skip_value()
+        self.assertEqual(keys, ['a', 'c', 'd'])
+
+        for run_id in ["180502_E00401_0001_BQCTEST", "191119_A00943_0005_AHMNCHDMXX"]:
+            stats_path = stats.get_stats_path(os.path.join("files/runs", run_id))
+            reference = stats.build_stats_index(stats_path)
+            with patch.object(stats, 'STREAM_CHUNK_SIZE', 7):
+                self.assertEqual(stats.build_stats_index(stats_path), reference)
+            with open(stats_path) as stats_file:
+                stats_data = json.load(stats_file)
+            self.assertEqual(
+                    [lane[0] for lane in reference['lanes']],
+                    [cr['LaneNumber'] for cr in stats_data['ConversionResults']]
+                    )
+
+    def test_stats_numpy_backend(self):
+        """The NumPy aggregation gives exactly the same results as the Python code."""
+
+        from common import stats
+        if stats.numpy is None:
+            self.skipTest("NumPy is not installed")
+        for run_id in ["180502_E00401_0001_BQCTEST", "191119_A00943_0005_AMERGDLANS", "210223_NS500336_0474_AHF3LWBGXG"]:
+            run_dir = os.path.join("files/runs", run_id)
+            for aggregate_lanes in [True, False]:
+                for aggregate_reads in [True, False]:
+                    with patch.object(stats, 'USE_NUMPY', False):
+                        reference = stats.get_stats(None, run_dir, aggregate_lanes, aggregate_reads)
+                    with patch.object(stats, 'USE_NUMPY', True):
+                        result = stats.get_stats(None, run_dir, aggregate_lanes, aggregate_reads)
+                    self.assertEqual(list(result.items()), list(reference.items()))
+        stats._stats_index_cache.clear()
+
+
+class TestRemote(unittest.TestCase):
+
+    def test_slurm_poller(self):
+        """One squeue command for all jobs, and sacct for jobs that left the queue."""
+
+        poller = remote.SlurmPoller()
+        poller.subscribe("100")
+        poller.subscribe("200")
+        outputs = {
+            'squeue': "100|N/A|RUNNING|node1\n200|0|COMPLETED|node2\n200|1|PENDING|\n",
+            'sacct': ""
+            }
+        def check_output(args, **kwargs):
+            return outputs[os.path.basename(args[0])]
+        with patch.object(remote.utilities, 'check_output', side_effect=check_output) as co, \
+                patch.object(remote.nsc, 'SQUEUE', ['squeue'], create=True), \
+                patch.object(remote.nsc, 'SACCT', ['sacct'], create=True):
+            poller.poll()
+            co.assert_called_once()
+            self.assertIn("100,200", co.call_args[0][0])
+            self.assertEqual(poller.get_states("100"), {None: ("RUNNING", "node1")})
+            self.assertEqual(poller.get_states("200"), {"0": ("COMPLETED", "node2"), "1": ("PENDING", None)})
+
+            # Not due yet
+            poller.poll()
+            co.assert_called_once()
+
+            # Job 100 left the queue, and is found with sacct
+            outputs['squeue'] = "200|1|RUNNING|node3\n"
+            outputs['sacct'] = "100|CANCELLED by 0|node1\n"
+            poller.poll(force=True)
+            self.assertEqual(co.call_count, 3)
+            self.assertIn("100", co.call_args[0][0])
+            self.assertEqual(poller.get_states("100"), {None: ("CANCELLED", "node1")})
+            self.assertEqual(poller.get_states("200"), {"0": ("COMPLETED", "node2"), "1": ("RUNNING", "node3")})
+            self.assertEqual(poller.delay, remote.SlurmPoller.MIN_DELAY)
+
+            # Back off when nothing changes
+            outputs['sacct'] = "100|CANCELLED|node1\n"
+            poller.poll(force=True)
+            self.assertGreater(poller.delay, remote.SlurmPoller.MIN_DELAY)
+
+            poller.unsubscribe("100")
+            poller.unsubscribe("200")
+            poller.poll(force=True)
+            self.assertEqual(co.call_count, 5)
+
+    def test_slurm_array_job_args_file(self):
+        """Each array task gets its own arguments from the arguments file, unchanged."""
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            arg_lists = [
+                    [sys.executable, "-c", "import sys, json; print(json.dumps(sys.argv[1:]))", "task {0}".format(i)]
+                    for i in range(12)
+                    ]
+            arg_lists[3] += ["it's \"quoted\" $HOME `ls` *", "", "line1\nline2", "\u00e6\u00f8\u00e5"]
+            job = remote.SlurmArrayJob(arg_lists, "testjob", "1:00:00", os.path.join(tempdir, "testjob.%a.txt"))
+            job.task_costs = [i % 5 for i in range(len(arg_lists))]
+            order = remote.get_task_order(job)
+            scripts = []
+            def sbatch(args, **kwargs):
+                with open(args[-1]) as script_file:
+                    scripts.append(script_file.read())
+                return "1234\n"
+            with patch.object(remote.utilities, 'check_output', side_effect=sbatch), \
+                    patch.object(remote.nsc, 'SBATCH_ARGLIST', ['sbatch'], create=True), \
+                    patch.object(remote, 'slurm_poller', remote.SlurmPoller()):
+                remote.SlurmArrayJob.start_jobs([job], None)
+                self.assertEqual(job.job_id, "1234")
+                self.assertTrue(os.path.isfile(job.args_path))
+                fallback_pattern = re.search(r'#SBATCH --output="(.*)"', scripts[0]).group(1)
+                def run_task(i):
+                    # Output to the fallback log, as Slurm does
+                    fallback_path = fallback_pattern.replace("%A", "1234").replace("%a", str(i))
+                    with open(fallback_path, "w") as fallback_log:
+                        rcode = subprocess.call(
+                                ["bash", "-c", scripts[0]], stdout=fallback_log, stderr=fallback_log,
+                                env=dict(os.environ, SLURM_ARRAY_JOB_ID="1234", SLURM_ARRAY_TASK_ID=str(i))
+                                )
+                    return rcode, fallback_path
+                for i, j in enumerate(order):
+                    rcode, fallback_path = run_task(i)
+                    self.assertEqual(rcode, 0)
+                    self.assertFalse(os.path.exists(fallback_path))
+                    # The log file is named by the original index, as for local jobs
+                    with open(os.path.join(tempdir, "testjob.{0}.txt".format(j))) as log_file:
+                        self.assertEqual(json.loads(log_file.read()), arg_lists[j][3:])
+                # A task which fails before the redirection leaves its fallback log
+                rcode, fallback_path = run_task(len(arg_lists))
+                self.assertNotEqual(rcode, 0)
+                with open(fallback_path) as fallback_log:
+                    self.assertIn("No arguments for task", fallback_log.read())
+                os.remove(fallback_path)
+                job.states = dict((str(i), 'COMPLETED') for i in range(len(arg_lists)))
+                with patch.object(remote.SlurmPoller, '_query_squeue', return_value={}), \
+                        patch.object(remote.SlurmPoller, '_query_sacct', return_value={}):
+                    job._check_status()
+                self.assertFalse(os.path.exists(job.args_path or os.path.join(tempdir, "x")))
+                self.assertEqual(
+                        sorted(os.listdir(tempdir)),
+                        sorted("testjob.{0}.txt".format(i) for i in range(len(arg_lists)))
+                        )
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_local_scheduler_budget(self):
+        """Local array jobs share the CPU and memory budget, and report exact states."""
+
+        import threading
+        import time
+        lock = threading.Lock()
+        usage = {'cpus': 0, 'mem': 0, 'max_cpus': 0, 'max_mem': 0}
+        requirements = {}
+        def local_execute(arg_list, logfile, cwd):
+            cpus, mem = requirements[arg_list[0]]
+            with lock:
+                usage['cpus'] += cpus
+                usage['mem'] += mem
+                usage['max_cpus'] = max(usage['max_cpus'], usage['cpus'])
+                usage['max_mem'] = max(usage['max_mem'], usage['mem'])
+            time.sleep(0.05)
+            with lock:
+                usage['cpus'] -= cpus
+                usage['mem'] -= mem
+            if arg_list[1] == "fail":
+                raise subprocess.CalledProcessError(1, str(arg_list))
+
+        big = remote.LocalArrayJob([["big", "ok"]] * 3, "big", "1:00:00", "/dev/null")
+        big.mem_per_task = "0.6G"
+        requirements["big"] = (1, 614)
+        small = remote.LocalArrayJob([["small", "ok"], ["small", "fail"], ["small", "ok"]], "small", "1:00:00", "/dev/null")
+        small.mem_per_task = 100
+        small.cpus_per_task = 2
+        requirements["small"] = (2, 100)
+        class FakeExecutor(object):
+            def submit(self, args, logfile, cwd, callback):
+                def run():
+                    try:
+                        local_execute(args, logfile, cwd)
+                        callback(0)
+                    except subprocess.CalledProcessError:
+                        callback(1)
+                threading.Thread(target=run).start()
+
+        with patch.object(remote, 'local_executor', FakeExecutor()):
+            remote.LocalArrayJob.start_jobs([big, small], max_local_threads=3, max_local_mem=1000)
+            remote.LocalArrayJob.update_status([big, small])
+            self.assertEqual(sum(big.summary.values()), 3)
+            self.assertLessEqual(big.summary.get('RUNNING', 0), 1)
+            for _ in range(100):
+                if big.is_finished and small.is_finished:
+                    break
+                time.sleep(0.05)
+                remote.LocalArrayJob.update_status([big, small])
+        self.assertEqual(big.summary, {'COMPLETED': 3})
+        self.assertEqual(small.summary, {'COMPLETED': 2, 'FAILED': 1})
+        self.assertLessEqual(usage['max_cpus'], 3)
+        self.assertLessEqual(usage['max_mem'], 1000)
+
+    def test_local_executor(self):
+        """Commands are run from the event loop, with output in the log file."""
+
+        import threading
+        tempdir = tempfile.mkdtemp()
+        try:
+            results = {}
+            done = threading.Event()
+            def callback(name, returncode):
+                results[name] = returncode
+                if len(results) == 3:
+                    done.set()
+            executor = remote.LocalExecutor()
+            for name, args in [
+                    ("ok", ["sh", "-c", "echo out; echo err >&2; pwd"]),
+                    ("fail", ["sh", "-c", "exit 3"]),
+                    ("missing", ["/nonexistent/command"])
+                    ]:
+                executor.submit(args, os.path.join(tempdir, name + ".txt"), tempdir,
+                        lambda returncode, name=name: callback(name, returncode))
+            self.assertTrue(done.wait(10))
+            self.assertEqual(results, {"ok": 0, "fail": 3, "missing": None})
+            with open(os.path.join(tempdir, "ok.txt")) as log:
+                self.assertEqual(log.read().split(), ["out", "err", os.path.realpath(tempdir)])
+            executor.loop.call_soon_threadsafe(executor.loop.stop)
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_task_order_longest_first(self):
+        """Tasks with the largest cost estimates are started first."""
+
+        import threading
+        import time
+        started = []
+        class FakeExecutor(object):
+            def submit(self, args, logfile, cwd, callback):
+                started.append(args[0])
+                threading.Thread(target=callback, args=(0,)).start()
+
+        fqc = remote.LocalArrayJob([["fqc0"], ["fqc1"], ["fqc2"]], "fastqc", "1:00:00", "/dev/null")
+        fqc.task_costs = [10, 30, 20]
+        dup = remote.LocalArrayJob([["dup0"], ["dup1"]], "suprDUPr", "1:00:00", "/dev/null")
+        dup.task_costs = [25, 5]
+        other = remote.LocalArrayJob([["other0"]], "other", "1:00:00", "/dev/null")
+        self.assertEqual(remote.get_task_order(fqc), [1, 2, 0])
+        self.assertEqual(remote.get_task_order(other), [0])
+        with patch.object(remote, 'local_executor', FakeExecutor()):
+            remote.LocalArrayJob.start_jobs([other, fqc, dup], max_local_threads=1)
+            for _ in range(100):
+                remote.LocalArrayJob.update_status([other, fqc, dup])
+                if all(job.is_finished for job in [other, fqc, dup]):
+                    break
+                time.sleep(0.01)
+        self.assertEqual(started, ["fqc1", "dup0", "fqc2", "fqc0", "dup1", "other0"])
+
+
+class TestTransfer(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.source = os.path.join(self.tempdir, "source", "Project")
+        os.makedirs(os.path.join(self.source, "Sample_A"))
+        os.makedirs(os.path.join(self.source, "Empty"))
+        for name in ["Sample_A/A_R1.fastq.gz", "Sample_A/A_R2.fastq.gz", "md5sum.txt"]:
+            with open(os.path.join(self.source, name), 'w') as f:
+                f.write(name)
+        os.symlink("Sample_A", os.path.join(self.source, "link"))
+        self.dest_parent = os.path.join(self.tempdir, "delivery")
+        os.mkdir(self.dest_parent)
+
+    def test_transfer_tree_resume(self):
+        """Files are hard-linked, and an interrupted transfer is resumed from the manifest."""
+
+        from common import transfer
+        manifest = os.path.join(self.tempdir, "manifest.json")
+        original_link = os.link
+        def fail_on_r2(src, dst):
+            if src.endswith("A_R2.fastq.gz"):
+                raise IOError("Simulated failure")
+            return original_link(src, dst)
+        with patch.object(os, 'link', side_effect=fail_on_r2):
+            with self.assertRaises(IOError):
+                transfer.transfer_tree(self.source, self.dest_parent, manifest, threads=1)
+        with patch.object(transfer, 'transfer_file', wraps=transfer.transfer_file) as transfer_file:
+            n_files, n_bytes = transfer.transfer_tree(self.source, self.dest_parent, manifest)
+            self.assertEqual(n_files, 1)
+            transfer_file.assert_called_once()
+        dest = os.path.join(self.dest_parent, "Project")
+        for name in ["Sample_A/A_R1.fastq.gz", "Sample_A/A_R2.fastq.gz", "md5sum.txt"]:
+            self.assertTrue(os.path.samefile(os.path.join(self.source, name), os.path.join(dest, name)))
+        self.assertTrue(os.path.isdir(os.path.join(dest, "Empty")))
+        self.assertEqual(os.readlink(os.path.join(dest, "link")), "Sample_A")
+        with open(manifest) as f:
+            self.assertEqual(len(f.readlines()), 4) # Header and three files
+
+    def test_copy_and_move_across_file_systems(self):
+        """Files are copied if they can't be linked, and moves across file systems copy
+        and delete the source."""
+
+        from common import transfer
+        import errno
+        with patch.object(os, 'link', side_effect=OSError(errno.EXDEV, "Cross-device link")), \
+                patch.object(os, 'rename', side_effect=OSError(errno.EXDEV, "Cross-device link")):
+            transfer.move_tree(self.source, self.dest_parent)
+        dest = os.path.join(self.dest_parent, "Project")
+        self.assertFalse(os.path.exists(self.source))
+        with open(os.path.join(dest, "Sample_A", "A_R2.fastq.gz")) as f:
+            self.assertEqual(f.read(), "Sample_A/A_R2.fastq.gz")
+
+    def test_move_across_file_systems_resume(self):
+        """An interrupted move across file systems is resumed, but an unrelated existing
+        destination is an error."""
+
+        from common import transfer
+        import errno
+        manifest = os.path.join(self.tempdir, "manifest.json")
+        original_copy2 = shutil.copy2
+        def fail_on_r2(src, dst):
+            if src.endswith("A_R2.fastq.gz"):
+                raise IOError("Simulated failure")
+            return original_copy2(src, dst)
+        with patch.object(os, 'rename', side_effect=OSError(errno.EXDEV, "Cross-device link")):
+            with patch.object(shutil, 'copy2', side_effect=fail_on_r2):
+                with self.assertRaises(IOError):
+                    transfer.move_tree(self.source, self.dest_parent, manifest, threads=1)
+            with open(manifest) as f:
+                self.assertEqual(len(f.readlines()), 3) # Header and two files
+            with self.assertRaises(OSError):
+                transfer.move_tree(self.source, self.dest_parent)
+            transfer.move_tree(self.source, self.dest_parent, manifest)
+        self.assertFalse(os.path.exists(self.source))
+        with open(os.path.join(self.dest_parent, "Project", "Sample_A", "A_R2.fastq.gz")) as f:
+            self.assertEqual(f.read(), "Sample_A/A_R2.fastq.gz")
+
+
+class TestStages(unittest.TestCase):
+
+    def test_dependencies(self):
+        from common import stages
+        scripts = ["50_qc_analysis.py", "60_emails.py", "60_reports.py", "60_demultiplex_stats.py",
+                "70_multiqc.py", "80_md5sum.py", "90_prepare_delivery.py"]
+        deps = stages.get_dependencies([stages.get_stage(s) for s in scripts])
+        self.assertEqual(deps["50_qc_analysis.py"], set())
+        self.assertEqual(deps["60_demultiplex_stats.py"], set())
+        self.assertEqual(deps["80_md5sum.py"], {"50_qc_analysis.py", "60_reports.py"})
+        self.assertEqual(deps["70_multiqc.py"], {"50_qc_analysis.py", "60_emails.py"})
+        self.assertEqual(deps["90_prepare_delivery.py"], set(scripts[:-1]))
+        self.assertEqual(
+                stages.get_stage_args(stages.get_stage("60_emails.py"), ["--threads=4", "--threads", "2", "dir"]),
+                ["dir"]
+                )
+        self.assertEqual(
+                stages.get_stage_args(stages.get_stage("80_md5sum.py"), ["--threads=4", "dir"]),
+                ["--threads=4", "dir"]
+                )
+
+    def test_run_stages(self):
+        """Independent stages run concurrently; a failure stops further stages. The
+        runner relays the status of the stages to LIMS."""
+
+        from common import stages
+        tempdir = tempfile.mkdtemp()
+        try:
+            log_path = os.path.join(tempdir, "log")
+            # The stages wait for each other, to check that they run at the same time.
+            # 50_qc_analysis also waits until its progress is relayed to LIMS.
+            for script, wait_for, rcode in [
+                    ("50_qc_analysis.py", ["end 60_demultiplex_stats.py",
+                        "lims [50_qc_analysis.py] Running (progress)"], 0),
+                    ("60_demultiplex_stats.py", ["start 50_qc_analysis.py"], 0),
+                    ("60_reports.py", [], 1), ("80_md5sum.py", [], 0)]:
+                with open(os.path.join(tempdir, script), "w") as f:
+                    f.write("import os, sys, time, json\n"
+                            "args = [a for a in sys.argv[1:] if not a.startswith('--status-file=')]\n"
+                            "status_files = [a.split('=', 1)[1] for a in sys.argv[1:] if a.startswith('--status-file=')]\n"
+                            "def write_status(message, state):\n"
+                            "    for path in status_files:\n"
+                            "        json.dump({{'Job status': message, 'Job state code': state}}, open(path + '.tmp', 'w'))\n"
+                            "        os.replace(path + '.tmp', path)\n"
+                            "open({log!r}, 'a').write('start {script} ' + ' '.join(args) + '\\n')\n"
+                            "write_status('Running (progress)', 'RUNNING')\n"
+                            "for i in range(200):\n"
+                            "    if all(w in open({log!r}).read() for w in {wait_for!r}): break\n"
+                            "    time.sleep(0.05)\n"
+                            "open({log!r}, 'a').write('end {script}\\n')\n"
+                            "write_status({script!r} + ' rc={rcode}', 'FAILED' if {rcode} else 'COMPLETED')\n"
+                            "sys.exit({rcode})\n".format(log=log_path, script=script, wait_for=wait_for, rcode=rcode))
+            def set_lims_status(pid, status):
+                with open(log_path, 'a') as log_file:
+                    log_file.write("lims " + status[nsc.JOB_STATUS_UDF] + "\n")
+            with patch.object(stages, 'set_lims_status', side_effect=set_lims_status) as lims_status:
+                failed = stages.run_stages(
+                        ["50_qc_analysis.py", "60_reports.py", "60_demultiplex_stats.py", "80_md5sum.py"],
+                        ["--threads=2", "workdir"], script_dir=tempdir, poll_interval=0.05, pid="1234"
+                        )
+            self.assertEqual(failed, ["60_reports.py"])
+            with open(log_path) as f:
+                log = [line for line in f.read().splitlines() if not line.startswith("lims ")]
+            self.assertEqual(sorted(log[0:2]), ["start 50_qc_analysis.py --threads=2 workdir", "start 60_demultiplex_stats.py workdir"])
+            self.assertLess(log.index("end 60_demultiplex_stats.py"), log.index("end 50_qc_analysis.py"))
+            self.assertLess(log.index("end 50_qc_analysis.py"), log.index("start 60_reports.py workdir"))
+            self.assertNotIn("start 80_md5sum.py --threads=2 workdir", log)
+            # The progress is written as RUNNING, and the final status once, from the
+            # failed stage
+            statuses = [c[0][1] for c in lims_status.call_args_list]
+            self.assertTrue(all(status[nsc.JOB_STATE_CODE_UDF] == 'RUNNING' for status in statuses[:-1]))
+            self.assertEqual(statuses[-1], {'Job status': '60_reports.py rc=1', 'Job state code': 'FAILED'})
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_run_in_process(self):
+        """Scripts run in one process share the Task state, and don't exit."""
+
+        from common import stages
+        RUN_ID = "180502_E00401_0001_BQCTEST"
+        tempdir = tempfile.mkdtemp()
+        try:
+            run_dir = os.path.join(tempdir, RUN_ID)
+            shutil.copytree(os.path.join("files/runs", RUN_ID), run_dir)
+            if os.path.exists(taskmgr.run_model.snapshot_path(run_dir)):
+                os.remove(taskmgr.run_model.snapshot_path(run_dir))
+            for name, body in [
+                    ("60_stage_a", "    task.projects\n    task.success_finish()\n"),
+                    ("60_stage_b", "    task.projects\n    task.fail('Test failure')\n"),
+                    ("60_stage_c", "    task.success_finish()\n")]:
+                with open(os.path.join(tempdir, name + ".py"), "w") as f:
+                    f.write("TASK_NAME = {0!r}\nTASK_DESCRIPTION = ''\n"
+                            "TASK_ARGS = ['work_dir', 'sample_sheet', 'threads']\n"
+                            "tasks = []\n"
+                            "def main(task):\n"
+                            "    task.running()\n"
+                            "    tasks.append(task)\n".format(name) + body)
+            with patch.object(sys, 'exit') as exit, \
+                    patch.object(taskmgr.run_model, 'build', wraps=taskmgr.run_model.build) as build:
+                failed = stages.run_in_process(
+                        ["60_stage_a.py", "60_stage_b.py", "60_stage_c.py"],
+                        ["--threads=2", run_dir], script_dir=tempdir
+                        )
+                exit.assert_not_called()
+                build.assert_called_once()
+            self.assertEqual(failed, ["60_stage_b.py"])
+            task_a, = sys.modules["60_stage_a"].tasks
+            task_b, = sys.modules["60_stage_b"].tasks
+            self.assertEqual(sys.modules["60_stage_c"].tasks, [])
+            self.assertTrue(task_a.success)
+            self.assertFalse(task_b.success)
+            self.assertIs(task_a.run_model, task_b.run_model)
+            self.assertEqual(task_b.threads, 2)
+            self.assertEqual(task_b.task_name, "60_stage_b")
+        finally:
+            for name in ["60_stage_a", "60_stage_b", "60_stage_c"]:
+                sys.modules.pop(name, None)
+            sys.path.remove(tempdir)
+            shutil.rmtree(tempdir)
+
+    def test_run_in_process_script_options(self):
+        """The options added by the scripts themselves are parsed in one process."""
+
+        from common import stages
+        RUN_ID = "180502_NS500336_0001_ANOINDEX"
+        SOURCE_DIR = "files/runs/{}".format(RUN_ID)
+        tempdir = tempfile.mkdtemp()
+        try:
+            work_dir = os.path.join(tempdir, RUN_ID)
+            os.mkdir(work_dir)
+            input_sample_sheet = os.path.join(tempdir, "Input.csv")
+            shutil.copy("files/samplesheet/ns-indexed.csv", input_sample_sheet)
+            with patch.object(sys, 'exit') as exit, patch('subprocess.call') as call:
+                call.return_value = 0
+                failed = stages.run_in_process(
+                        ["20_prepare_sample_sheet.py", "30_demultiplexing.py"],
+                        ["--input-sample-sheet", input_sample_sheet,
+                            "--extra-options=--no-bgzf-compression", SOURCE_DIR, work_dir]
+                        )
+                exit.assert_not_called()
+            self.assertEqual(failed, [])
+            with open(input_sample_sheet) as f_in, \
+                    open(os.path.join(work_dir, "DemultiplexingSampleSheet.csv")) as f_out:
+                self.assertEqual(f_in.read(), f_out.read())
+            self.assertIn("--no-bgzf-compression", call.call_args[0][0])
+        finally:
+            shutil.rmtree(tempdir)
+
+
 # 2. Test of the individual "Task" scipts
 
 class Test10CopyRun(TaskTestCase):
@@ -421,20 +1025,88 @@ class Test50QcAnalysis(TaskTestCase):
 
         with self.qc_dir(self.H4RUN) as tempdir:
             testargs = ["script", tempdir]
-            # Replace multiprocessing.Pool.map with plain map
-            object_mock = Mock()
-            object_mock.map = lambda f, *args: list(map(f, *args))  # Force immediate execution
-            fake_pool = Mock(return_value=object_mock)
+            # Run the array jobs serially with subprocess.call, instead of the
+            # local executor
             with patch.object(sys, 'argv', testargs), \
                     patch('subprocess.call') as call, \
-                    patch('multiprocessing.Pool', fake_pool):
+                    patch.object(remote, 'ArrayJob', remote.SerialArrayJob):
                 call.return_value = 0
                 self.module.main(self.task)
-                # This test is quite incomplete: because the local array job
-                # uses subprocess, we don't get the args back! Can only test
-                # that it didn't crash.
+                # This test is quite incomplete: only tests that it didn't crash.
                 self.task.success_finish.assert_called_once()
 
+    def test_qc_analysis_failure(self):
+        """Pack jobs request one CPU per file, and no temporary files are left when
+        a job fails."""
+
+        jobs = []
+        class RecordingArrayJob(remote.SerialArrayJob):
+            def __init__(self, *args):
+                super().__init__(*args)
+                jobs.append(self)
+        def failing_call(args, **kwargs):
+            # Partial output of the checksum command
+            for md5_tmp in re.findall(r"> (\S+\.tmp) &", args[-1]):
+                open(md5_tmp, "w").close()
+            return 1
+        with self.qc_dir(self.H4RUN) as tempdir:
+            testargs = ["script", tempdir]
+            with patch.object(sys, 'argv', testargs), \
+                    patch('subprocess.call', side_effect=failing_call), \
+                    patch.object(remote, 'ArrayJob', RecordingArrayJob):
+                with self.assertRaises(SystemExit):
+                    self.module.main(self.task)
+            pack_jobs = [job for job in jobs if job.jobname == "fastqc_pack"]
+            self.assertTrue(pack_jobs)
+            for job in pack_jobs:
+                for arg_list in job.arg_lists:
+                    self.assertIn("-t {0} ".format(job.cpus_per_task), arg_list[-1])
+            self.assertEqual(
+                    [name for name in os.listdir(self.qualitycontrol)
+                        if name.startswith("fastqc_pack") or name.startswith("fastqc_md5")],
+                    []
+                    )
+
+    def test_md5_with_fastqc(self):
+        """The checksums computed with the FastQC command are added to the cache."""
+
+        from common import checksums
+        tempdir = tempfile.mkdtemp()
+        try:
+            fq_paths = []
+            for name in ["A_R1.fastq.gz", "B it's $HOME `ls` *.fastq.gz"]:
+                fq_paths.append(os.path.join(tempdir, name))
+                with open(fq_paths[-1], "wb") as f:
+                    f.write(name.encode() * 1000)
+            md5_path = os.path.join(tempdir, "md5.txt")
+            with patch.object(nsc, 'MD5', ["md5sum"]):
+                command = self.module.with_md5(["true"], fq_paths, md5_path)
+            self.assertEqual(subprocess.call(command), 0)
+            cache = checksums.DigestCache()
+            self.module.import_md5([md5_path, os.path.join(tempdir, "missing.txt")], cache)
+            for fq_path in fq_paths:
+                with open(fq_path, "rb") as f:
+                    self.assertEqual(cache.get(os.stat(fq_path)), hashlib.md5(f.read()).hexdigest())
+            self.assertFalse(os.path.exists(md5_path))
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_pack_files(self):
+        """Small files are packed in bins of similar size, without name clashes."""
+
+        paths = ["p/A_R1.fastq.gz", "p/B_R1.fastq.gz", "q/A_R1.fastq.gz", "p/C_R1.fastq.gz",
+                "p/D_R1.fastq.gz", "p/E_R1.fastq.gz", "p/F_R1.fastq.gz"]
+        sizes = [50, 40, 30, 20, 10, 5, 45]
+        bins = self.module.pack_files(paths, sizes, 3)
+        self.assertEqual(sorted(i for b in bins for i in b), list(range(len(paths))))
+        self.assertTrue(all(len(b) <= 3 for b in bins))
+        self.assertEqual(len(bins), 3)
+        for b in bins:
+            names = [os.path.basename(paths[i]) for i in b]
+            self.assertEqual(len(names), len(set(names)))
+        totals = [sum(sizes[i] for i in b) for b in bins]
+        self.assertLessEqual(max(totals) - min(totals), 30)
+
 
 class Test60DemultiplexStats(TaskTestCase):
     module = __import__("60_demultiplex_stats")
@@ -665,67 +1337,97 @@ class Test70MultiQC(TaskTestCase):
 
 
 class Test80md5sum(TaskTestCase):
-    """Check that md5sum was called on all fastq files. It does not currently check that
-    the md5sum file also contains the checksums of the QC reports in PDF format."""
+    """Check that the checksums of all fastq files are in md5sum.txt. It does not check
+    the checksums of the QC reports in PDF format, which are empty files in the test."""
 
     module = __import__("80_md5sum")
 
-    def test_md5_h4k(self):
-        with open("files/samples/hi4000.json") as jsonfile:
+    def create_qc_pdfs(self, tempdir):
+        """Create empty files for the QC reports, which are made by 60_reports."""
+
+        with patch.object(sys, 'argv', ["script", tempdir]):
+            self.task.running()
+        projects = self.task.projects
+        samples.flag_empty_files(projects, tempdir)
+        samples.add_index_read_files(projects, tempdir)
+        for project in projects:
+            if not project.is_undetermined:
+                project_dir = os.path.join(self.basecalls, project.proj_dir)
+                paths = self.module.paths_for_project(self.task.run_id, project)
+                for path in paths:
+                    if path.endswith(".pdf"):
+                        open(os.path.join(project_dir, path), 'w').close()
+        return projects
+
+    def check_md5sum_files(self, projects_json):
+        with open(projects_json) as jsonfile:
             projects = json.load(jsonfile)
+        for project in projects:
+            if not project['is_undetermined']:
+                project_dir = os.path.join(self.basecalls, project['proj_dir'])
+                with open(os.path.join(project_dir, "md5sum.txt")) as md5file:
+                    digests = dict(reversed(line.rstrip("\n").split("  ", 1)) for line in md5file)
+                for s in project['samples']:
+                    for f in s['files']:
+                        fpath = str(os.path.basename(f['path']))
+                        if s['sample_dir']:
+                            fpath = os.path.join(s['sample_dir'], fpath)
+                        with open(os.path.join(project_dir, fpath), 'rb') as fq:
+                            self.assertEqual(digests[fpath], hashlib.md5(fq.read()).hexdigest())
+
+    def test_md5_h4k(self):
         with self.qc_dir(self.H4RUN) as tempdir:
-            testargs = ["script", tempdir]
-            with patch.object(sys, 'argv', testargs), patch('subprocess.call') as sub_call:
-                sub_call.return_value = 0
+            self.create_qc_pdfs(tempdir)
+            with patch.object(sys, 'argv', ["script", tempdir]):
                 self.module.main(self.task)
-                calls = [] # list of expected calls to md5sum
-                for project in projects:
-                    if not project['is_undetermined']:
-                        files = []
-                        # Note: this test is too strict. File names could be in any order. If this
-                        # test fails, it may need to be rewritten, but then we can't use assert_has_calls.
-                        # Paths for QC PDF files are not tested.
-                        for s in project['samples']:
-                            for f in s['files']:
-                                fname = str(os.path.basename(f['path']))
-                                sname = "Sample_" + str(s['name'])
-                                fpath = os.path.join(sname, fname)
-                                files.append(fpath)
-                                files.append(ANY)
-                        calls.append(
-                            call(nsc.MD5 + files,
-                                cwd=os.path.join(self.basecalls, project['proj_dir']),
-                                stderr=ANY, stdout=ANY)
-                            )
-                sub_call.assert_has_calls(calls, any_order=True)
-                self.task.success_finish.assert_called_once()
-
+            self.task.success_finish.assert_called_once()
+            self.check_md5sum_files("files/samples/hi4000.json")
 
     def test_md5_nsq(self):
-        with open("files/samples/nsqctest-indexfiles.json") as jsonfile:
-            projects = json.load(jsonfile)
         with self.qc_dir(self.NSRUN) as tempdir:
-            testargs = ["script", tempdir]
-            with patch.object(sys, 'argv', testargs), patch('subprocess.call') as sub_call:
-                sub_call.return_value = 0
+            self.create_qc_pdfs(tempdir)
+            with patch.object(sys, 'argv', ["script", tempdir]):
                 self.module.main(self.task)
-                calls = [] # list of expected calls to md5sum
-                for project in projects:
-                    if not project['is_undetermined']:
-                        files = []
-                        # Same note as for HiSeq 4000 applies here. Too specific test.
-                        for s in project['samples']:
-                            for f in s['files']:
-                                fname = str(os.path.basename(f['path']))
-                                files.append(fname)
-                                files.append(ANY)
-                        calls.append(
-                            call(nsc.MD5 + files,
-                                cwd=os.path.join(self.basecalls, project['proj_dir']),
-                                stderr=ANY, stdout=ANY)
-                            )
-                sub_call.assert_has_calls(calls, any_order=True)
-                self.task.success_finish.assert_called_once()
+            self.task.success_finish.assert_called_once()
+            self.check_md5sum_files("files/samples/nsqctest-indexfiles.json")
+
+    def test_md5_missing_file(self):
+        """The task fails if a file can't be read (here the QC reports)."""
+
+        with self.qc_dir(self.H4RUN) as tempdir:
+            with patch.object(sys, 'argv', ["script", tempdir]), \
+                    patch.object(self.task, 'fail', side_effect=SystemExit(1)) as fail:
+                with self.assertRaises(SystemExit):
+                    self.module.main(self.task)
+                fail.assert_called_once()
+
+    def test_md5_from_cache(self):
+        """Checksums in the cache, e.g. from the QC analysis, are used."""
+
+        from common import checksums
+        fake_digest = "0" * 32
+        with self.qc_dir(self.H4RUN) as tempdir:
+            projects = self.create_qc_pdfs(tempdir)
+            cache = checksums.DigestCache(checksums.get_cache_path(tempdir))
+            for project in projects:
+                for sample in project.samples:
+                    for f in sample.files:
+                        fq_path = os.path.join(self.basecalls, f.path)
+                        if os.path.exists(fq_path):
+                            # Fake checksum, to see that the file isn't read again
+                            cache.add_file(fq_path, fake_digest)
+            cache.save()
+            with patch.object(sys, 'argv', ["script", tempdir]):
+                self.module.main(self.task)
+            for project in projects:
+                if not project.is_undetermined:
+                    with open(os.path.join(self.basecalls, project.proj_dir, "md5sum.txt")) as md5file:
+                        lines = [line.split("  ") for line in md5file]
+                    self.assertTrue(lines)
+                    for md5, path in lines:
+                        if path.strip().endswith(".fastq.gz"):
+                            self.assertEqual(md5, fake_digest)
+            self.task.success_finish.assert_called_once()
 
 
 class Test90PrepareDelivery(TaskTestCase):
@@ -785,27 +1487,26 @@ class Test90PrepareDelivery(TaskTestCase):
             deliv_test_dir = os.path.join(self.tempparent, "delivery")
             os.mkdir(deliv_test_dir)
             with patch.object(nsc, 'DELIVERY_DIR', deliv_test_dir, create=True),\
-                    patch.object(nsc, 'DEFAULT_DELIVERY_MODE', 'Norstore', create=True),\
-                    patch('subprocess.call') as sub_call:
-                sub_call.return_value = 0
+                    patch.object(nsc, 'DEFAULT_DELIVERY_MODE', 'Norstore', create=True):
                 self.module.main(self.task)
                 self.task.success_finish.assert_called_once()
-                expected_calls = []
+                self.check_files_with_reference(deliv_test_dir, ref_dir)
                 for project in projects:
                     if not project['is_undetermined']:
                         proj_dir = str(project['proj_dir'])
                         deliv_project_dir = os.path.join(deliv_test_dir, proj_dir)
                         tar_name = proj_dir + ".tar"
-                        expected_calls.append(
-                               call(['/bin/tar', 'cf', os.path.join(deliv_project_dir, tar_name),
-                                   proj_dir], cwd=self.basecalls, stderr=ANY, stdout=ANY) 
-                                )
-                        expected_calls.append(
-                               call(nsc.MD5 + [tar_name],
-                                   cwd=deliv_project_dir, stderr=ANY, stdout=ANY) 
-                                )
-                self.check_files_with_reference(deliv_test_dir, ref_dir)
-                sub_call.assert_has_calls(expected_calls, any_order=True)
+                        tar_path = os.path.join(deliv_project_dir, tar_name)
+                        # The checksum computed while writing is that of the file
+                        with open(tar_path, 'rb') as tar_file:
+                            digest = hashlib.md5(tar_file.read()).hexdigest()
+                        with open(os.path.join(deliv_project_dir, "md5sum.txt")) as md5file:
+                            self.assertEqual(md5file.read(), "{0}  {1}\n".format(digest, tar_name))
+                        with tarfile.open(tar_path) as tar:
+                            names = tar.getnames()
+                        for s in project['samples']:
+                            for f in s['files']:
+                                self.assertIn(str(f['path']), names)
 
     def diag_delivery_check(self, run_id, jsonpath, ref_dir):
         """Diag delivery is quite different from others, and requires copying and renaming of
@@ -6,10 +6,15 @@ import importlib
 import sys
 import importlib.util
 import subprocess
+import errno
 from pathlib import Path
-from unittest.mock import patch
+from unittest.mock import patch, Mock
 import yaml
 
+# The NovaSeq X scripts import shared modules from the repository root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import novaseq_x_projects
+
 EXAMPLE_YAML = """bcl_convert_version: 4.3.16
 compute_platform: Onboard DRAGEN
 demultiplexing_process_id: 24-1081653
@@ -235,6 +240,245 @@ class FileMoverTest(unittest.TestCase):
             self.assertTrue(p.fastq_path.is_dir())
             self.assertTrue(p.demux_qc_path.is_dir())
 
+    def test_check_sources_uses_directory_index(self):
+        """Existence checks are answered from one listing per directory, without stat calls."""
+        mover = self.fm_mod.FileMover(self.analysis_dir, self.fm_mod.DEST_PATHS)
+        mover.load_lims_file()
+        with patch.object(Path, "exists", side_effect=AssertionError("stat call")):
+            mover.check_sources_and_destinations()
+        # 3 samples x (2 fastq + analysis dir) sources, 3 x 2 fastq destinations, 2 analysis dirs
+        self.assertEqual(mover.index.lookups, 17)
+        self.assertLess(mover.index.scans, mover.index.lookups)
+
+        next((self.analysis_dir / "Data" / "BCLConvert" / "fastq").glob("*_R2_001.fastq.gz")).unlink()
+        mover = self.fm_mod.FileMover(self.analysis_dir, self.fm_mod.DEST_PATHS)
+        mover.load_lims_file()
+        with self.assertRaises(SystemExit):
+            mover.check_sources_and_destinations()
+
+    def test_run_moves_files(self):
+        """Planned moves and QC links are run in parallel, outside test mode."""
+        mover = self.fm_mod.FileMover(self.analysis_dir, self.fm_mod.DEST_PATHS)
+        with patch.object(self.fm_mod, "TEST_MODE", False):
+            mover.run()
+        fastq_dir = self.analysis_dir / "Data" / "BCLConvert" / "fastq"
+        self.assertEqual(list(fastq_dir.glob("*.fastq.gz")), [])
+        for s in mover.samples:
+            for name in mover._dest_fastq_names(s):
+                self.assertTrue((s.project.fastq_path / name).is_file())
+            self.assertTrue((s.project.analysis_path / s.new_sample_id()).is_dir())
+        for p in mover.projects.values():
+            report = p.demux_qc_path / "BCLConvert" / "fastq" / "Reports" / "Demultiplex_Stats.csv"
+            self.assertTrue(report.samefile(fastq_dir / "Reports" / "Demultiplex_Stats.csv"))
+            self.assertTrue((p.demux_qc_path / "BCLConvert" / "AggregateReports" / "dummy.txt").is_file())
+
+    def test_run_stops_on_failed_move(self):
+        mover = self.fm_mod.FileMover(self.analysis_dir, self.fm_mod.DEST_PATHS)
+        original_rename = Path.rename
+        def failing_rename(src, dest):
+            if src.name.startswith("156-416"):
+                raise OSError("Simulated failure")
+            return original_rename(src, dest)
+        with patch.object(self.fm_mod, "TEST_MODE", False), \
+                patch.object(Path, "rename", failing_rename):
+            with self.assertRaises(SystemExit):
+                mover.run()
+
+    def test_resume_from_journal(self):
+        """A rerun after a failure only runs the remaining operations from the journal."""
+        mover = self.fm_mod.FileMover(self.analysis_dir, self.fm_mod.DEST_PATHS)
+        original_rename = Path.rename
+        first_run_renamed = []
+        def failing_rename(src, dest):
+            if src.name.startswith("156-416"):
+                raise OSError("Simulated failure")
+            first_run_renamed.append(src.name)
+            return original_rename(src, dest)
+        with patch.object(self.fm_mod, "TEST_MODE", False):
+            with patch.object(Path, "rename", failing_rename):
+                with self.assertRaises(SystemExit):
+                    mover.run()
+            journal_path = self.analysis_dir / self.fm_mod.JOURNAL_NAME
+            self.assertTrue(journal_path.is_file())
+
+            # The QC is already copied, and the checks are not repeated (sources are moved)
+            mover = self.fm_mod.FileMover(self.analysis_dir, self.fm_mod.DEST_PATHS)
+            with patch.object(mover, "copy_demux_qc") as copy_demux_qc, \
+                    patch.object(Path, "rename", autospec=True, side_effect=original_rename) as rename:
+                mover.run()
+            copy_demux_qc.assert_not_called()
+            renamed = [call_args[0][0].name for call_args in rename.call_args_list]
+            self.assertTrue(any(name.startswith("156-416") for name in renamed))
+            self.assertFalse(set(renamed) & set(first_run_renamed))
+            for s in mover.samples:
+                for name in mover._dest_fastq_names(s):
+                    self.assertTrue((s.project.fastq_path / name).is_file())
+
+            # Nothing to do when the journal shows that the run is complete
+            mover = self.fm_mod.FileMover(self.analysis_dir, self.fm_mod.DEST_PATHS)
+            with patch.object(mover, "move_sample_files") as move_sample_files:
+                mover.run()
+            move_sample_files.assert_not_called()
+
+    def _resume_after_interrupted_planning(self, kind):
+        """A plan which was not completely written to the journal is made again."""
+        original_write = self.fm_mod.Journal._write
+        planned = []
+        def failing_write(journal, entry):
+            if entry['event'] == 'planned' and entry['kind'] == kind:
+                planned.append(entry)
+                if len(planned) == 2:
+                    raise OSError("Simulated failure")
+            original_write(journal, entry)
+        with patch.object(self.fm_mod, "TEST_MODE", False):
+            mover = self.fm_mod.FileMover(self.analysis_dir, self.fm_mod.DEST_PATHS)
+            with patch.object(self.fm_mod.Journal, "_write", failing_write):
+                with self.assertRaises(OSError):
+                    mover.run()
+            mover = self.fm_mod.FileMover(self.analysis_dir, self.fm_mod.DEST_PATHS)
+            mover.run()
+        fastq_dir = self.analysis_dir / "Data" / "BCLConvert" / "fastq"
+        self.assertEqual(list(fastq_dir.glob("*.fastq.gz")), [])
+        for s in mover.samples:
+            for name in mover._dest_fastq_names(s):
+                self.assertTrue((s.project.fastq_path / name).is_file())
+        for p in mover.projects.values():
+            report = p.demux_qc_path / "BCLConvert" / "fastq" / "Reports" / "Demultiplex_Stats.csv"
+            self.assertTrue(report.samefile(fastq_dir / "Reports" / "Demultiplex_Stats.csv"))
+            self.assertTrue((p.demux_qc_path / "BCLConvert" / "AggregateReports" / "dummy.txt").is_file())
+
+    def test_resume_after_interrupted_link_planning(self):
+        self._resume_after_interrupted_planning("link")
+
+    def test_resume_after_interrupted_move_planning(self):
+        self._resume_after_interrupted_planning("move")
+
+    def _cross_device_rename(self):
+        """Path.rename replacement which fails like a move to another filesystem, except for the
+        rename of the finished copy."""
+        original_rename = Path.rename
+        def rename(src, dest):
+            if not src.name.endswith(".partial"):
+                raise OSError(errno.EXDEV, "Invalid cross-device link")
+            return original_rename(src, dest)
+        return rename
+
+    def test_cross_device_move_copies_and_verifies(self):
+        fastq_dir = self.analysis_dir / "Data" / "BCLConvert" / "fastq"
+        contents = {}
+        for i, path in enumerate(sorted(fastq_dir.glob("*.fastq.gz"))):
+            contents[path.name] = os.urandom(1000 + i * 37)
+            path.write_bytes(contents[path.name])
+        mover = self.fm_mod.FileMover(self.analysis_dir, self.fm_mod.DEST_PATHS)
+        with patch.object(self.fm_mod, "TEST_MODE", False), \
+                patch.object(self.fm_mod, "COPY_CHUNK_SIZE", 256), \
+                patch.object(Path, "rename", self._cross_device_rename()):
+            mover.run()
+        self.assertEqual(list(fastq_dir.glob("*.fastq.gz")), [])
+        for s in mover.samples:
+            for source_name, name in zip(mover._original_fastq_names(s), mover._dest_fastq_names(s)):
+                self.assertEqual((s.project.fastq_path / name).read_bytes(), contents[source_name])
+            self.assertTrue((s.project.analysis_path / s.new_sample_id()).is_dir())
+        self.assertEqual(list(self.tmpdir.rglob("*.partial")), [])
+
+    def test_resume_after_interrupted_source_removal(self):
+        """A cross-device move interrupted while removing the source is finished on resume."""
+        original_remove = self.fm_mod.CrossDeviceCopier._remove
+        interrupted = []
+        def failing_remove(path):
+            if not interrupted and path.name.endswith(".fastq.gz"):
+                interrupted.append(path)
+                raise OSError("Simulated failure")
+            original_remove(path)
+        with patch.object(self.fm_mod, "TEST_MODE", False), \
+                patch.object(Path, "rename", self._cross_device_rename()):
+            mover = self.fm_mod.FileMover(self.analysis_dir, self.fm_mod.DEST_PATHS)
+            with patch.object(self.fm_mod.CrossDeviceCopier, "_remove", staticmethod(failing_remove)):
+                with self.assertRaises(SystemExit):
+                    mover.run()
+            self.assertTrue(interrupted[0].exists())
+            mover = self.fm_mod.FileMover(self.analysis_dir, self.fm_mod.DEST_PATHS)
+            mover.run()
+        self.assertFalse(interrupted[0].exists())
+        fastq_dir = self.analysis_dir / "Data" / "BCLConvert" / "fastq"
+        self.assertEqual(list(fastq_dir.glob("*.fastq.gz")), [])
+        for s in mover.samples:
+            for name in mover._dest_fastq_names(s):
+                self.assertTrue((s.project.fastq_path / name).is_file())
+            self.assertTrue((s.project.analysis_path / s.new_sample_id()).is_dir())
+        self.assertEqual(list(self.tmpdir.rglob("*.partial")), [])
+
+    def test_cross_device_move_keeps_source_on_checksum_mismatch(self):
+        fastq_dir = self.analysis_dir / "Data" / "BCLConvert" / "fastq"
+        for path in fastq_dir.glob("*.fastq.gz"):
+            path.write_bytes(b"@read\nACGT\n+\nIIII\n" * 100)
+        original_pwrite = os.pwrite
+        def corrupting_pwrite(fd, data, offset):
+            return original_pwrite(fd, bytes(len(data)), offset)
+        mover = self.fm_mod.FileMover(self.analysis_dir, self.fm_mod.DEST_PATHS)
+        with patch.object(self.fm_mod, "TEST_MODE", False), \
+                patch.object(Path, "rename", self._cross_device_rename()), \
+                patch("os.pwrite", corrupting_pwrite):
+            with self.assertRaises(SystemExit):
+                mover.run()
+        self.assertEqual(len(list(fastq_dir.glob("*.fastq.gz"))), 6)
+        for s in mover.samples:
+            for name in mover._dest_fastq_names(s):
+                self.assertFalse((s.project.fastq_path / name).exists())
+
+class ProjectLookupTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+        self.cache_path = self.tmpdir / "project-cache.json"
+        self.lims = Mock(baseuri="https://lims.example/")
+        def get_projects(name):
+            if name == "Missing":
+                return []
+            project = Mock(id=f"ID-{name}", udf={'Delivery method': "NeLS project", 'Project type': "Sensitive"})
+            return [Mock(), project]
+        self.lims.get_projects.side_effect = get_projects
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_project_details_uses_cache(self):
+        names = ["Proj-A", "Proj-B", "Proj-A", "Missing"]
+        result = novaseq_x_projects.get_project_details(self.lims, names, self.cache_path)
+        self.assertEqual(set(result), {"Proj-A", "Proj-B", "Missing"})
+        self.assertEqual(result["Missing"], {})
+        self.assertEqual(result["Proj-B"], {
+            'delivery_method': "NeLS project", 'project_id': "ID-Proj-B",
+            'project_name': "Proj-B", 'project_type': "Sensitive"
+        })
+        self.assertEqual(self.lims.get_projects.call_count, 3)
+
+        # Found projects are cached on disk, missing projects are looked up again
+        self.lims.get_projects.reset_mock()
+        self.assertEqual(novaseq_x_projects.get_project_details(self.lims, names, self.cache_path), result)
+        self.lims.get_projects.assert_called_once_with(name="Missing")
+
+        # Entries for another LIMS server and expired entries are not used
+        self.lims.get_projects.reset_mock()
+        self.lims.baseuri = "https://dev-lims.example/"
+        novaseq_x_projects.get_project_details(self.lims, ["Proj-B"], self.cache_path)
+        self.lims.get_projects.assert_called_once_with(name="Proj-B")
+        self.lims.get_projects.reset_mock()
+        novaseq_x_projects.get_project_details(self.lims, ["Proj-B"], self.cache_path, ttl=0)
+        self.lims.get_projects.assert_called_once_with(name="Proj-B")
+
+    def test_get_project_details_refresh_bypasses_cache(self):
+        novaseq_x_projects.get_project_details(self.lims, ["Proj-A"], self.cache_path)
+        # The project type is corrected in LIMS
+        self.lims.get_projects.side_effect = lambda name: [Mock(
+            id=f"ID-{name}", udf={'Delivery method': "NeLS project", 'Project type': "Non-Sensitive"})]
+        result = novaseq_x_projects.get_project_details(self.lims, ["Proj-A"], self.cache_path, refresh=True)
+        self.assertEqual(result["Proj-A"]['project_type'], "Non-Sensitive")
+        # The cache is updated with the refreshed details
+        self.lims.get_projects.reset_mock()
+        self.assertEqual(novaseq_x_projects.get_project_details(self.lims, ["Proj-A"], self.cache_path), result)
+        self.lims.get_projects.assert_not_called()
+
+
 class AutomationCronTest(unittest.TestCase):
     def setUp(self):
         self.tmpdir = Path(tempfile.mkdtemp())
@@ -334,5 +578,131 @@ class AutomationCronTest(unittest.TestCase):
         # Verify source and destination paths are included
         self.assertEqual(len(move_call[0]), 5)  # sbatch, --dependency, mv.sh, src, dest
 
+class RedemultiplexingTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+        spec = importlib.util.spec_from_file_location(
+            "novaseq_x_redemultiplexing",
+            (Path(__file__).resolve().parent.parent / "novaseq-x-redemultiplexing.py")
+        )
+        self.rd_mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.rd_mod)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parse_demultiplexing_stats_groups_rows(self):
+        """Rows of a sample with multiple indexes are aggregated, in order of first appearance."""
+        reports = self.tmpdir / "Reports"
+        reports.mkdir()
+        (reports / "Demultiplex_Stats.csv").write_text(
+            "Lane,SampleID,Sample_Project,Index,# Reads,% Reads,% Perfect Index Reads,% One Mismatch Index Reads\n"
+            "1,B,P,AAAA,100,0.25,1.0,0.0\n"
+            "1,A,P,CCCC,100,0.25,0.5,0.5\n"
+            "1,A,P,GGGG,300,0.5,1.0,0.0\n"
+            "2,A,P,CCCC,50,1.0,1.0,0.0\n"
+        )
+        (reports / "Quality_Metrics.csv").write_text(
+            "Lane,SampleID,Sample_Project,ReadNumber,Yield,YieldQ30,Mean Quality Score (PF)\n"
+            "1,A,P,1,1000,900,30\n"
+            "1,A,P,2,1000,800,40\n"
+            "1,A,P,I1,80,80,40\n"
+            "1,B,P,1,500,500,35\n"
+            "2,A,P,1,200,100,20\n"
+        )
+        result = self.rd_mod.parse_demultiplexing_stats(self.tmpdir)
+        self.assertEqual(
+            [(r['lane'], r['samplesheet_sample_id']) for r in result],
+            [(1, "B"), (1, "A"), (2, "A")]
+        )
+        sample_a = result[1]
+        self.assertEqual(sample_a['num_data_read_passes'], 2)
+        self.assertEqual(sample_a['num_index_reads_written_as_fastq'], 1)
+        self.assertEqual(sample_a['qc']['# Reads'], 400 * 3)
+        self.assertAlmostEqual(sample_a['qc']['% of PF Clusters Per Lane'], 75.0)
+        self.assertAlmostEqual(sample_a['qc']['% Perfect Index Read'], 87.5)
+        self.assertAlmostEqual(sample_a['qc']['% Bases >=Q30'], 1780 * 100 / 2080)
+        self.assertEqual(result[2]['qc']['Yield PF (Gb)'], 200 / 1e9)
+
+    def test_lookup_sample_s_number_scans_each_project_once(self):
+        project_dir = self.tmpdir / "Proj-2025-01-01"
+        project_dir.mkdir()
+        for name in ["S-1_S3_L001_R1_001.fastq.gz", "S-1_S3_L001_R2_001.fastq.gz",
+                     "S-1_S3_L002_R1_001.fastq.gz", "S-1_S4_L003_R1_001.fastq.gz",
+                     "S-1_S5_L003_R1_001.fastq.gz", "S-12_S7_L001_R1_001.fastq.gz",
+                     "S-2_S9_L001_R1_001.fastq.ora"]:
+            (project_dir / name).touch()
+        def info(sample_id, lane, ora=False):
+            return {'samplesheet_sample_id': sample_id, 'lane': lane,
+                    'project_name': "Proj-2025-01-01", 'ora_compression': ora}
+        fastq_indexes = {}
+        with patch.object(self.rd_mod.os, "scandir", wraps=os.scandir) as scandir:
+            lookup = lambda *args: self.rd_mod.lookup_sample_s_number(self.tmpdir, info(*args), fastq_indexes)
+            self.assertEqual(lookup("S-1", 1), 3)
+            self.assertEqual(lookup("S-1", 2), 3)
+            self.assertEqual(lookup("S-12", 1), 7)
+            self.assertEqual(lookup("S-2", 1, True), 9)
+            self.assertEqual(lookup("Undetermined", 1), 0)
+            with self.assertRaisesRegex(RuntimeError, "Found 0 matches"):
+                lookup("S-2", 1)
+            with self.assertRaisesRegex(RuntimeError, "Found 2 matches"):
+                lookup("S-1", 3)
+        self.assertEqual(scandir.call_count, 1)
+        with self.assertRaisesRegex(RuntimeError, "Found 0 matches"):
+            self.rd_mod.lookup_sample_s_number(self.tmpdir, dict(info("S-1", 1), project_name="Missing"))
+
+    def test_exchange_output_artifact_info_uses_batch_requests(self):
+        class FakeEntity:
+            def __init__(self, id, **kwargs):
+                self.id = id
+                self.name = id
+                self.udf = {}
+                self.__dict__.update(kwargs)
+        lims = Mock()
+        inputs = [FakeEntity(f"lane{lane}", location=(None, f"{lane}:1")) for lane in (1, 2)]
+        pairs = []
+        for lane_input in inputs:
+            for sample_id in ["A", "B"]:
+                output = FakeEntity(f"{lane_input.id}-{sample_id}", samples=[FakeEntity(f"smp-{sample_id}")])
+                output.udf["SampleSheet Sample_ID"] = sample_id
+                pairs.append(({'uri': lane_input}, {'uri': output, 'output-generation-type': "PerReagentLabel"}))
+        pairs.append(({'uri': inputs[0]}, {'uri': FakeEntity("shared"), 'output-generation-type': "PerInput"}))
+        process = Mock(input_output_maps=pairs)
+        records = [
+            {'lane': lane, 'samplesheet_sample_id': "A", 'qc': {'# Reads': lane * 100},
+             'samplesheet_position': 1, 'num_data_read_passes': 2, 'ora_compression': False}
+            for lane in (1, 2)
+        ]
+        self.rd_mod.exchange_output_artifact_info(lims, process, records)
+
+        self.assertEqual(lims.get_batch.call_count, 2)
+        self.assertEqual(len(lims.get_batch.call_args_list[0][0][0]), 6)
+        lims.put_batch.assert_called_once()
+        updated = {o.id: o for o in lims.put_batch.call_args[0][0]}
+        self.assertEqual(set(updated), {"lane1-A", "lane1-B", "lane2-A", "lane2-B"})
+        self.assertEqual(updated["lane2-A"].udf['# Reads'], 200)
+        self.assertEqual(updated["lane1-B"].udf['# Reads'], 0)
+        self.assertEqual(records[1]['artifact_id'], "lane2-A")
+        self.assertEqual(records[1]['lane_artifact'], "lane2")
+        self.assertEqual(records[1]['sample_id'], "smp-A")
+
+    def test_demultiplexing_and_import_jobs_are_submitted_without_waiting(self):
+        calls = []
+        def fake_sbatch(args, **kwargs):
+            calls.append(args)
+            return subprocess.CompletedProcess(args, 0, stdout=f"{1000 + len(calls)};cluster\n")
+        parent = self.tmpdir / "Data" / "BCLConvert"
+        parent.mkdir(parents=True)
+        with patch.object(self.rd_mod.subprocess, "run", side_effect=fake_sbatch):
+            job_id = self.rd_mod.run_demultiplexing_cpu("c1.RUN", self.tmpdir, self.tmpdir / "SampleSheet.csv",
+                                                        parent, parent / "fastq", "")
+            self.rd_mod.submit_import_job("c1.RUN", "24-123", parent, job_id, False)
+        self.assertEqual(job_id, "1001")
+        self.assertEqual(calls[0], ['sbatch', '--parsable', str(parent / "script.sh")])
+        self.assertEqual(calls[1], ['sbatch', '--parsable', '--dependency=afterany:1001', str(parent / "import.sh")])
+        self.assertIn(f"> {parent / self.rd_mod.EXIT_CODE_FILE_NAME}", (parent / "script.sh").read_text())
+        import_command = (parent / "import.sh").read_text().splitlines()[-1].split()
+        self.assertEqual(import_command[:4], ["nsc-python3", str(self.rd_mod.IMPORT_SCRIPT_PATH), "--import", "24-123"])
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,173 @@
+# Benchmark of parse_demultiplexing_stats in novaseq-x-redemultiplexing.py.
+
+# Writes synthetic Demultiplex_Stats.csv and Quality_Metrics.csv files for a
+# flowcell with many samples to a temporary directory, and times the grouped
+# implementation against the previous implementation, which scanned all the rows
+# for each sample. The results of the two implementations are also compared.
+
+# USAGE:
+# python tools/benchmark_redemultiplexing_stats.py [NUM_SAMPLES [NUM_LANES]]
+
+import sys
+import os
+import csv
+import time
+import random
+import shutil
+import tempfile
+import importlib.util
+from pathlib import Path
+from collections import defaultdict
+
+# The script imports shared modules from the repository root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                    "novaseq-x-redemultiplexing.py")
+
+DEMULTIPLEX_STATS_HEADER = ["Lane", "SampleID", "Sample_Project", "Index", "# Reads",
+        "# Perfect Index Reads", "# One Mismatch Index Reads", "# Two Mismatch Index Reads",
+        "% Reads", "% Perfect Index Reads", "% One Mismatch Index Reads", "% Two Mismatch Index Reads"]
+QUALITY_METRICS_HEADER = ["Lane", "SampleID", "Sample_Project", "index", "index2", "ReadNumber",
+        "Yield", "YieldQ30", "QualityScoreSum", "Mean Quality Score (PF)", "% Q30"]
+READ_NUMBERS = ["1", "2", "I1", "I2"]
+
+
+def load_script():
+    spec = importlib.util.spec_from_file_location("novaseq_x_redemultiplexing", SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_reports(reports_dir, num_samples, num_lanes):
+    with open(reports_dir / "Demultiplex_Stats.csv", "w", newline='') as ds_file, \
+            open(reports_dir / "Quality_Metrics.csv", "w", newline='') as qm_file:
+        ds_writer = csv.writer(ds_file)
+        qm_writer = csv.writer(qm_file)
+        ds_writer.writerow(DEMULTIPLEX_STATS_HEADER)
+        qm_writer.writerow(QUALITY_METRICS_HEADER)
+        for lane in range(1, num_lanes+1):
+            lane_reads = [random.randint(0, 2000000) for _ in range(num_samples)]
+            total = max(1, sum(lane_reads))
+            for i, reads in enumerate(lane_reads):
+                sample_id = "Sample-{0}".format(i)
+                project = "Project-{0}".format(i % 20)
+                perfect = reads - reads // 20
+                ds_writer.writerow([lane, sample_id, project, "ACGTACGT-TGCATGCA", reads,
+                        perfect, reads // 20, 0, "{0:.4f}".format(reads / total),
+                        "{0:.4f}".format(perfect / max(1, reads)),
+                        "{0:.4f}".format((reads // 20) / max(1, reads)), "0.0000"])
+                for read_number in READ_NUMBERS:
+                    length = 8 if read_number.startswith("I") else 151
+                    yield_ = reads * length
+                    qm_writer.writerow([lane, sample_id, project, "ACGTACGT", "TGCATGCA",
+                            read_number, yield_, int(yield_ * 0.93), yield_ * 36,
+                            "{0:.2f}".format(random.uniform(30, 40)), "0.93"])
+
+
+def parse_demultiplexing_stats_scan(output_folder):
+    """Previous implementation, for comparison: the rows of each sample are
+    found by scanning all the rows."""
+
+    with open(output_folder / "Reports" / "Demultiplex_Stats.csv", newline='') as f:
+        demultiplex_stats = list(csv.DictReader(f))
+    with open(output_folder / "Reports" / "Quality_Metrics.csv", newline='') as f:
+        quality_metrics = list(csv.DictReader(f))
+
+    demultiplexed_lane_sample_info = []
+    sample_id_positions = {"Undetermined": 0}
+    lane_total_read_count = defaultdict(int)
+    for demultiplex_stats_row in demultiplex_stats:
+        lane_total_read_count[demultiplex_stats_row['Lane']] += float(demultiplex_stats_row['# Reads'])
+
+    dedup_lane_sample_project = list(dict.fromkeys(
+        (row['Lane'], row['SampleID'], row['Sample_Project'])
+        for row in demultiplex_stats
+    ))
+
+    for lane, sampleid, project in dedup_lane_sample_project:
+        demultiplex_stats_rows = [row for row in demultiplex_stats
+                if row['Lane'] == lane and
+                row['SampleID'] == sampleid and
+                row['Sample_Project'] == project
+        ]
+        quality_metrics_rows = [row for row in quality_metrics
+                if row['Lane'] == lane and
+                row['SampleID'] == sampleid and
+                row['Sample_Project'] == project
+        ]
+
+        sample_id_position = sample_id_positions.get(sampleid)
+        if not sample_id_position:
+            sample_id_position = len(sample_id_positions)
+            sample_id_positions[sampleid] = sample_id_position
+
+        num_data_read_passes = len(set(row['ReadNumber'] for row in quality_metrics_rows if "I" not in row['ReadNumber']))
+        num_index_reads_written_as_fastq = len(set(row['ReadNumber'] for row in quality_metrics_rows if "I" in row['ReadNumber']))
+        read_count = sum(int(row['# Reads']) for row in demultiplex_stats_rows)
+        sample_yield = sum(float(row['Yield']) for row in quality_metrics_rows)
+        qc = {
+            '# Reads': read_count * (num_data_read_passes + num_index_reads_written_as_fastq),
+            '# Reads PF': read_count * (num_data_read_passes + num_index_reads_written_as_fastq),
+            'Yield PF (Gb)': sample_yield / 1e9,
+            '% of PF Clusters Per Lane': 100 * sum(float(row['% Reads']) for row in demultiplex_stats_rows),
+            '% Perfect Index Read': 100 * sum(
+                float(row['% Perfect Index Reads'])*float(row['# Reads'])
+                for row in demultiplex_stats_rows) / max(1, read_count),
+            '% One Mismatch Reads (Index)':  100 * sum(
+                float(row['% One Mismatch Index Reads'])*float(row['# Reads'])
+                for row in demultiplex_stats_rows) / max(1, read_count),
+            '% Bases >=Q30': sum(float(row['YieldQ30']) for row in quality_metrics_rows) * 100 / max(1, sample_yield),
+            'Ave Q Score': sum(float(row['Mean Quality Score (PF)'])*float(row['Yield']) for row in quality_metrics_rows) / max(1, sample_yield),
+        }
+        demultiplexed_lane_sample_info.append({
+            'lane': int(lane),
+            'samplesheet_sample_id': sampleid,
+            'samplesheet_sample_project': project,
+            'num_data_read_passes': num_data_read_passes,
+            'num_index_reads_written_as_fastq': num_index_reads_written_as_fastq,
+            'project_name': project,
+            'sample_name': sampleid,
+            'qc': qc
+        })
+
+    return demultiplexed_lane_sample_info
+
+
+def time_function(function, output_folder, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = function(output_folder)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main(num_samples, num_lanes):
+    script = load_script()
+    output_folder = Path(tempfile.mkdtemp())
+    try:
+        reports_dir = output_folder / "Reports"
+        reports_dir.mkdir()
+        write_reports(reports_dir, num_samples, num_lanes)
+        print("Reports: {0} samples, {1} lanes, {2} read numbers, {3:.1f} MB".format(
+            num_samples, num_lanes, len(READ_NUMBERS),
+            sum(p.stat().st_size for p in reports_dir.iterdir()) / 1e6))
+
+        scan_time, scan_result = time_function(parse_demultiplexing_stats_scan, output_folder, repeat=1)
+        grouped_time, grouped_result = time_function(script.parse_demultiplexing_stats, output_folder)
+        print("Scan per sample: {0:.2f} s".format(scan_time))
+        print("Grouped:         {0:.2f} s".format(grouped_time))
+        print("Speedup:         {0:.1f}x".format(scan_time / grouped_time))
+        assert scan_result == grouped_result, "Results differ"
+        print("Results are identical")
+    finally:
+        shutil.rmtree(output_folder)
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 1500,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 8
+        )
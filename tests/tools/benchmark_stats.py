@@ -0,0 +1,110 @@
+# Benchmark of the aggregation backends in common/stats.py.
+
+# Writes a synthetic Stats.json with many samples to a temporary run directory, and
+# times get_stats with the pure Python and NumPy backends. The results of the two
+# backends are also compared.
+
+# USAGE:
+# python tools/benchmark_stats.py [NUM_SAMPLES [NUM_LANES]]
+
+import sys
+import os
+import json
+import time
+import random
+import shutil
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from common import stats
+
+
+def make_stats(num_samples, num_lanes, num_reads=2):
+    conversion_results = []
+    for lane in range(1, num_lanes+1):
+        demux_results = []
+        for i in range(num_samples):
+            number_reads = random.randint(0, 1000000)
+            demux_results.append({
+                'SampleId': "Sample-{0}".format(i),
+                'SampleName': "Sample-{0}".format(i),
+                'IndexMetrics': [{
+                    'IndexSequence': "ACGTACGT+TGCATGCA",
+                    'MismatchCounts': {'0': number_reads - number_reads // 20, '1': number_reads // 20}
+                    }],
+                'NumberReads': number_reads,
+                'Yield': number_reads * 151,
+                'ReadMetrics': [{
+                    'ReadNumber': read,
+                    'Yield': number_reads * 151,
+                    'YieldQ30': number_reads * 140,
+                    'QualityScoreSum': number_reads * 151 * 36,
+                    'TrimmedBases': 0
+                    } for read in range(1, num_reads+1)]
+                })
+        conversion_results.append({
+            'LaneNumber': lane,
+            'TotalClustersRaw': sum(dr['NumberReads'] for dr in demux_results) * 2,
+            'TotalClustersPF': sum(dr['NumberReads'] for dr in demux_results) + 1000,
+            'Yield': 0,
+            'DemuxResults': demux_results,
+            'Undetermined': {
+                'NumberReads': 1000,
+                'Yield': 151000,
+                'ReadMetrics': [{
+                    'ReadNumber': read, 'Yield': 151000, 'YieldQ30': 140000,
+                    'QualityScoreSum': 151000 * 30, 'TrimmedBases': 0
+                    } for read in range(1, num_reads+1)]
+                }
+            })
+    return {'Flowcell': "SYNTHETIC", 'RunNumber': 1, 'RunId': "SYNTHETIC",
+            'ConversionResults': conversion_results}
+
+
+def time_backend(run_dir, use_numpy, repeat=3):
+    stats.USE_NUMPY = use_numpy
+    best = None
+    for _ in range(repeat):
+        stats.get_stats_index(run_dir).pop('_arrays', None) # Include array conversion
+        start = time.time()
+        for aggregate_lanes in [True, False]:
+            for aggregate_reads in [True, False]:
+                result = stats.get_stats(None, run_dir, aggregate_lanes, aggregate_reads)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main(num_samples, num_lanes):
+    if stats.numpy is None:
+        print("NumPy is not installed")
+        sys.exit(1)
+    run_dir = tempfile.mkdtemp()
+    try:
+        stats_path = stats.get_stats_path(run_dir)
+        os.makedirs(os.path.dirname(stats_path))
+        with open(stats_path, 'w') as stats_file:
+            json.dump(make_stats(num_samples, num_lanes), stats_file)
+        print("Stats.json: {0} samples, {1} lanes, {2:.1f} MB".format(
+            num_samples, num_lanes, os.path.getsize(stats_path) / 1e6))
+
+        start = time.time()
+        stats.get_stats_index(run_dir)
+        print("Build index:     {0:.2f} s".format(time.time() - start))
+
+        python_time, python_result = time_backend(run_dir, False)
+        numpy_time, numpy_result = time_backend(run_dir, True)
+        print("Python backend:  {0:.2f} s".format(python_time))
+        print("NumPy backend:   {0:.2f} s".format(numpy_time))
+        print("Speedup:         {0:.1f}x".format(python_time / numpy_time))
+        assert list(python_result.items()) == list(numpy_result.items()), "Results differ"
+        print("Results are identical")
+    finally:
+        shutil.rmtree(run_dir)
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 10000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 4
+        )